@@ -1,17 +1,48 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import requests
-from bs4 import BeautifulSoup
+import base64
+import bisect
+import hashlib
+import heapq
+import importlib
 import json
+import math
+import multiprocessing
+import os
 import re
-import pandas as pd
+import sqlite3
+import sys
+import tempfile
+from collections import OrderedDict, deque
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from itertools import islice
+import threading
 import time
+import queue
 import random
-from urllib.parse import quote, urlencode
+from urllib.parse import quote, urlencode, urlparse
 import logging
 
+
+class LazyModule:
+    """Stand-in for a heavy module that is only imported on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Scraping dependencies stay unloaded until the scraper actually talks to 28car
+requests = LazyModule('requests')
+
 app = Flask(__name__)
 CORS(app)
 
@@ -19,110 +50,491 @@ CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Outbound HTTP configuration (shared by every code path that talks to 28car)
+BASE_URL = "https://dj1jklak2e.28car.com"
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))  # Distinct hosts kept alive
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '16'))  # Connections per host
+HTTP_RETRY_TOTAL = int(os.environ.get('HTTP_RETRY_TOTAL', '3'))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', '0.5'))  # 0.5s, 1s, 2s, ...
+HTTP_RETRY_BACKOFF_MAX = float(os.environ.get('HTTP_RETRY_BACKOFF_MAX', '10'))
+HTTP_RETRY_JITTER = float(os.environ.get('HTTP_RETRY_JITTER', '0.5'))  # Up to +0.5s random per retry
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)  # Retried by fetch_page, where the caller's deadline is known
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def build_http_session():
+    """Build a requests session with a sized keep-alive pool and a reconnect-only retry policy
+
+    Status retries are not left to urllib3, which sleeps through backoff and Retry-After without
+    knowing the caller's deadline; CarDataScraper.fetch_page retries them within the budget.
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    retry = Retry(
+        total=HTTP_RETRY_TOTAL,
+        connect=1,  # A single reconnect covers stale keep-alive sockets
+        read=0,  # A read timeout already spent its budget, don't repeat it
+        status=0,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,  # Hand the last response back so raise_for_status reports it
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def retry_wait(response, attempt):
+    """Seconds to wait before retrying a response: its Retry-After, else exponential backoff with jitter"""
+    value = response.headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return min(HTTP_RETRY_BACKOFF_MAX, HTTP_RETRY_BACKOFF * 2 ** attempt) + random.uniform(0, HTTP_RETRY_JITTER)
+
+
+def get_http_session():
+    """Return the process-wide HTTP session, creating it on first use"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = build_http_session()
+    return _http_session
+
+
+def prewarm_http_session(timeout=5):
+    """Open a keep-alive connection to 28car so the first scrape skips DNS and TLS setup"""
+    try:
+        get_http_session().head(f"{BASE_URL}/", timeout=timeout, allow_redirects=False)
+        logger.info("HTTP connection pool pre-warmed")
+        return True
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Could not pre-warm HTTP connection pool: {e}")
+        return False
+
+
+# Circuit breaker configuration for the 28car upstream
+BREAKER_WINDOW_SECONDS = float(os.environ.get('BREAKER_WINDOW_SECONDS', '60'))  # Outcomes considered
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '4'))  # Calls needed before tripping
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', '0.5'))  # Error/timeout share that trips
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', '30'))  # Cool-down before probing
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('BREAKER_HALF_OPEN_PROBES', '1'))  # Successes needed to close
+
+
+class CircuitOpenError(Exception):
+    """Raised when an upstream call is short-circuited by an open breaker"""
+
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker driven by recent timeout and error rates"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, window_seconds=BREAKER_WINDOW_SECONDS, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, open_seconds=BREAKER_OPEN_SECONDS,
+                 half_open_probes=BREAKER_HALF_OPEN_PROBES, clock=time.monotonic):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Return to the closed state and forget all recorded outcomes"""
+        with self._lock:
+            self._outcomes = deque()  # (timestamp, outcome) where outcome is 'success', 'timeout' or 'error'
+            self._state = self.CLOSED
+            self._opened_at = None
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+            self.trip_count = 0
+            self.short_circuit_count = 0
+            self.last_failure = None
+
+    def _prune(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
+
+    def _advance(self, now):
+        # An open breaker becomes half-open once its cool-down has elapsed
+        if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+            logger.info(f"Circuit '{self.name}' half-open, probing upstream")
+
+    def _trip(self, now):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.trip_count += 1
+        logger.warning(f"Circuit '{self.name}' opened (trip #{self.trip_count}), failing fast for {self.open_seconds:.0f}s")
+
+    @property
+    def state(self):
+        with self._lock:
+            self._advance(self.clock())
+            return self._state
+
+    def is_open(self):
+        """True while calls are being short-circuited (half-open still lets probes through)"""
+        return self.state == self.OPEN
+
+    def allow_request(self):
+        """Decide whether a call may go upstream; half-open admits a limited number of probes"""
+        with self._lock:
+            self._advance(self.clock())
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+            self.short_circuit_count += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            now = self.clock()
+            if self._state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self._state = self.CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Circuit '{self.name}' closed, upstream recovered")
+                return
+            self._outcomes.append((now, 'success'))
+            self._prune(now)
+
+    def record_failure(self, timeout=False):
+        with self._lock:
+            now = self.clock()
+            self.last_failure = 'timeout' if timeout else 'error'
+            if self._state == self.HALF_OPEN:
+                # A failed probe re-opens the breaker for another cool-down
+                self._trip(now)
+                return
+            if self._state == self.OPEN:
+                return
+            self._outcomes.append((now, self.last_failure))
+            self._prune(now)
+            failures = sum(1 for _, outcome in self._outcomes if outcome != 'success')
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._trip(now)
+
+    def call(self, func, *args, **kwargs):
+        """Run func through the breaker, classifying network failures as breaker failures"""
+        if not self.allow_request():
+            raise CircuitOpenError(f"Circuit '{self.name}' is open, upstream call skipped")
+        try:
+            result = func(*args, **kwargs)
+        except requests.exceptions.Timeout:
+            self.record_failure(timeout=True)
+            raise
+        except requests.exceptions.ConnectionError:
+            self.record_failure()
+            raise
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is None or status in HTTP_RETRY_STATUSES:
+                self.record_failure()
+            else:
+                self.record_success()  # Upstream answered; a 4xx is not an availability problem
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def iterate(self, chunks):
+        """Yield a streamed body's chunks, recording a failure if reading them times out or breaks off
+
+        The call that opened the stream already counted as a success once the headers arrived.
+        """
+        try:
+            yield from chunks
+        except requests.exceptions.Timeout:
+            self.record_failure(timeout=True)
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            self.record_failure()
+            raise
+
+    def stats(self):
+        """Breaker state and counters for health reporting"""
+        with self._lock:
+            now = self.clock()
+            self._advance(now)
+            self._prune(now)
+            calls = len(self._outcomes)
+            timeouts = sum(1 for _, outcome in self._outcomes if outcome == 'timeout')
+            errors = sum(1 for _, outcome in self._outcomes if outcome == 'error')
+            retry_in = None
+            if self._state == self.OPEN:
+                retry_in = round(max(0.0, self.open_seconds - (now - self._opened_at)), 1)
+            return {
+                'state': self._state,
+                'trip_count': self.trip_count,
+                'short_circuit_count': self.short_circuit_count,
+                'window_calls': calls,
+                'timeout_rate': round(timeouts / calls, 3) if calls else 0.0,
+                'error_rate': round(errors / calls, 3) if calls else 0.0,
+                'last_failure': self.last_failure,
+                'retry_in_seconds': retry_in
+            }
+
+
+upstream_breaker = CircuitBreaker('28car')
+
+# Request deadline configuration
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '25'))  # Default client budget
+DEADLINE_HEADER = 'X-Request-Deadline'  # Seconds the client is willing to wait for an analysis
+SCRAPE_PAGE_TIMEOUT = 30  # Socket timeout per page when there is budget to spare
+MIN_PAGE_BUDGET_SECONDS = float(os.environ.get('MIN_PAGE_BUDGET_SECONDS', '2'))  # Don't start a page with less
+MIN_SCRAPE_BUDGET_SECONDS = float(os.environ.get('MIN_SCRAPE_BUDGET_SECONDS', '3'))  # Don't start scraping with less
+MIN_ANALYSIS_BUDGET_SECONDS = float(os.environ.get('MIN_ANALYSIS_BUDGET_SECONDS', '0.25'))  # Else use fallback analysis
+
+
+class Deadline:
+    """Point in time by which a request must be answered, shared by every stage of an analysis"""
+
+    def __init__(self, seconds=None, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = None if seconds is None else clock() + max(0.0, seconds)
+
+    @classmethod
+    def from_header(cls, value, default=REQUEST_DEADLINE_SECONDS):
+        """Build a deadline from a header value in seconds, falling back to the configured default"""
+        try:
+            seconds = float(value) if value not in (None, '') else default
+        except (TypeError, ValueError):
+            seconds = default
+        if seconds is None or seconds <= 0 or seconds != seconds:
+            seconds = default
+        return cls(seconds)
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float('inf')
+        return max(0.0, self.expires_at - self.clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap):
+        """Socket timeout for the next call: the remaining budget, never more than cap"""
+        return min(cap, self.remaining())
+
+
+# Listing deduplication configuration
+DEDUP_SEEN_CAPACITY = int(os.environ.get('DEDUP_SEEN_CAPACITY', '200000'))  # Fingerprints remembered across scrapes
+LISTING_ID_PATTERN = re.compile(r'h_vid=(\d+)')  # 28car's listing id in detail-page links
+SCRAPE_PAGE_ENCODING = 'big5hkscs'  # 28car pages are Big5 with HKSCS characters plain Big5 can't decode
+PRICE_PATTERN = re.compile(r'\$[0-9,]+')
+LISTING_DATE_PATTERN = re.compile(r'\b(?:(20\d\d)[-/.](\d{1,2})[-/.](\d{1,2})|(\d{1,2})[-/.](\d{1,2})[-/.](20\d\d))\b')  # Posting date; day-first like Hong Kong sites
+LISTING_DIV_CLASSES = frozenset(('car_item', 'lst_item', 'item'))  # Listing containers on the mobile site
+SCRAPE_PARSE_WORKERS = int(os.environ.get('SCRAPE_PARSE_WORKERS', '0'))  # Page parser processes; 0 parses inline
+SCRAPE_STREAMING = os.environ.get('SCRAPE_STREAMING', 'false').lower() == 'true'  # Parse inline pages as they download
+SCRAPE_STREAM_CHUNK_BYTES = 16 * 1024
+SCRAPE_MAX_PAGES = int(os.environ.get('SCRAPE_MAX_PAGES', '3'))  # Page budget of an analysis's live scrape
+SCRAPE_TARGET_COMPARABLES = int(os.environ.get('SCRAPE_TARGET_COMPARABLES', '20'))  # Stop crawling once this many match
+
+
+def element_text(element):
+    """Text of an lxml element and its descendants, stripped pieces joined by single spaces"""
+    return ' '.join(piece for piece in (text.strip() for text in element.itertext()) if piece)
+
+
+def listing_fingerprint(text, listing_id=None):
+    """Stable identity for a scraped listing: 28car's listing id, else a hash of its normalized text"""
+    if listing_id:
+        return f'28car:{listing_id}'
+    normalized = ' '.join(text.upper().split())
+    return 'text:' + hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SeenFingerprints:
+    """Bounded set of recently seen fingerprints; the least recently seen are forgotten first"""
+
+    def __init__(self, capacity=DEDUP_SEEN_CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, fingerprint):
+        """Remember a fingerprint; True if it was not already in the set"""
+        with self.lock:
+            if fingerprint in self.entries:
+                self.entries.move_to_end(fingerprint)
+                return False
+            self.entries[fingerprint] = None
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return True
+
+
+class ScrapeMetrics:
+    """Counters for scraped pages and listings, including how many were duplicates"""
+
+    FIELDS = ('scrapes', 'pages', 'listings_parsed', 'duplicates_dropped', 'listings_new', 'listings_repeated')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def record(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        parsed = counts['listings_parsed']
+        published = counts['listings_new'] + counts['listings_repeated']
+        # Duplicates within a scrape (repeated rows, featured listings on several pages) vs listings already seen
+        counts['duplicate_rate'] = round(counts['duplicates_dropped'] / parsed, 4) if parsed else 0.0
+        counts['repeat_rate'] = round(counts['listings_repeated'] / published, 4) if published else 0.0
+        return counts
+
+
+scrape_metrics = ScrapeMetrics()
+
+
+
+
+class CrawlReport:
+    """How one adaptive scrape went: pages fetched, matching listings found and why it stopped"""
+
+    def __init__(self):
+        self.pages_fetched = 0
+        self.comparables = 0
+        self.stop_reason = None  # target_met, no_comparables, max_pages, deadline or circuit_open; None when nothing was scraped
+
+    def to_dict(self):
+        return {'pagesFetched': self.pages_fetched, 'comparables': self.comparables, 'stopReason': self.stop_reason}
+
+
+def is_comparable(car, make=None, model=None, year=None):
+    """True when the listing matches every given make, model and year exactly (names compared canonically)"""
+    if make and canonical.make_id(car.get('make')) != canonical.make_id(make):
+        return False
+    if model and canonical.model_id(car.get('make'), car.get('model')) != canonical.model_id(make, model):
+        return False
+    return not year or car.get('year') == year
+
+
 class CarDataScraper:
     def __init__(self):
-        self.base_url = "https://dj1jklak2e.28car.com"
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.base_url = BASE_URL
+        self.headers = DEFAULT_HEADERS
     
-    def search_cars_by_query(self, make=None, model=None, year=None, max_pages=3):
-        """Search for cars using 28car.com search functionality"""
+    @property
+    def session(self):
+        # Resolved on use so mock-only deployments never build a connection pool
+        return get_http_session()
+    
+    def search_cars_by_query(self, make=None, model=None, year=None, max_pages=3, deadline=None,
+                             target_comparables=None, report=None):
+        """Search for cars using 28car.com search functionality
+
+        Pages run through the ingestion pipeline's stages on the calling thread, one page at a time.
+
+        With target_comparables, max_pages is a budget rather than a fixed count: crawling stops once
+        that many listings match the make, model and year exactly, or when a page adds none. Pass a
+        CrawlReport to find out how many pages were fetched.
+
+        CircuitOpenError is raised only when the first page is refused; if the circuit opens later in
+        the crawl, the listings already scraped are returned with stop_reason 'circuit_open'.
+
+        With detail enrichment on, each page's listings have their detail pages looked up together,
+        on the enricher's DETAIL_WORKERS threads, before the next page is fetched.
+        """
         cars = []
+        adaptive = target_comparables is not None
+        comparables = set()  # Fingerprints (or ids) of matching listings, so repeats count once
+        report = report if report is not None else CrawlReport()
+        report.stop_reason = 'max_pages'
+        # Detail pages are looked up a page of listings at a time, concurrently, instead of in a pipeline stage
+        enricher = get_detail_enricher()
+        detail_deadline = deadline if deadline is not None or enricher is None else Deadline(DETAIL_BUDGET_SECONDS)
+        pipeline = build_ingestion_pipeline(self, deadline=deadline, report=report, enrich=False)
         
-        try:
-            # Build search query
-            search_terms = []
-            if make:
-                search_terms.append(make)
-            if model:
-                search_terms.append(model)
-            
-            search_query = "+".join(search_terms) if search_terms else ""
-            
+        def jobs():
             for page in range(1, max_pages + 1):
-                # Build URL with search parameters - use mobile version for simpler structure
-                url = f"{self.base_url}/m_sell_lst.php"
-                params = {
-                    'h_sort': '7',  # Sort by price
-                    'h_page': page
-                }
-                
-                if search_query:
-                    params['h_srh'] = search_query
-                
-                if year:
-                    params['h_f_yr'] = str(year)
-                
-                if make == "Mercedes-Benz":
-                    params['h_f_mk'] = '36'  # Mercedes-Benz brand code
-                elif make == "BMW":
-                    params['h_f_mk'] = '7'   # BMW brand code  
-                elif make == "Audi":
-                    params['h_f_mk'] = '5'   # Audi brand code
-                elif make == "Toyota":
-                    params['h_f_mk'] = '53'  # Toyota brand code
-                elif make == "Honda":
-                    params['h_f_mk'] = '19'  # Honda brand code
-                
-                logger.info(f"Scraping 28car page {page} with params: {params}")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                response.raise_for_status()
-                
-                # Handle Big5 encoding
-                response.encoding = 'big5'
-                
-                # Parse the HTML
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Look for car data in different possible structures
-                car_data_found = False
-                
-                # Method 1: Look for table rows with car data
-                table_rows = soup.find_all('tr')
-                for row in table_rows:
-                    car_data = self.parse_28car_row(row)
-                    if car_data and car_data['price'] > 0:
-                        cars.append(car_data)
-                        car_data_found = True
-                        logger.info(f"Found car: {car_data['make']} {car_data['model']} {car_data['year']} - ${car_data['price']}")
-                
-                # Method 2: Look for div elements with car listings
-                if not car_data_found:
-                    car_divs = soup.find_all('div', class_=['car_item', 'lst_item', 'item'])
-                    for div in car_divs:
-                        car_data = self.parse_28car_div(div)
-                        if car_data and car_data['price'] > 0:
-                            cars.append(car_data)
-                            car_data_found = True
-                            logger.info(f"Found car: {car_data['make']} {car_data['model']} {car_data['year']} - ${car_data['price']}")
-                
-                # Method 3: Look for any element containing price patterns
-                if not car_data_found:
-                    all_elements = soup.find_all(string=re.compile(r'\$[0-9,]+'))
-                    for i, element in enumerate(all_elements[:10]):  # Limit to first 10 matches
-                        parent = element.parent
-                        if parent:
-                            car_data = self.parse_28car_element(parent, element)
-                            if car_data and car_data['price'] > 0:
-                                cars.append(car_data)
-                                car_data_found = True
-                                logger.info(f"Found car: {car_data['make']} {car_data['model']} {car_data['year']} - ${car_data['price']}")
-                
-                if not car_data_found:
+                # Stop crawling once the caller's budget can't cover another page
+                if deadline is not None and deadline.remaining() < MIN_PAGE_BUDGET_SECONDS:
+                    logger.warning(f"Deadline budget exhausted, stopping scrape before page {page}")
+                    report.stop_reason = 'deadline'
+                    return
+                page_count, found = len(cars), len(comparables)
+                # Resumed only once every listing of this page has come out of the last stage
+                yield make, model, year, page
+                if enricher is not None:
+                    enricher.enrich_all(cars[page_count:], self, detail_deadline)
+                if len(cars) == page_count:
                     logger.warning(f"No car data found on page {page}")
+                if adaptive:
+                    if len(comparables) >= target_comparables:
+                        report.stop_reason = 'target_met'
+                        return
+                    if len(comparables) == found:
+                        logger.info(f"Page {page} added no comparable listings, stopping the scrape")
+                        report.stop_reason = 'no_comparables'
+                        return
+        
+        try:
+            for car in pipeline.run_inline(jobs()):
+                cars.append(car)
+                if adaptive and is_comparable(car, make, model, year):
+                    comparables.add(car.get('fingerprint') or id(car))
+                    report.comparables = len(comparables)
                 
-                # Be respectful to the server
-                time.sleep(random.uniform(1, 3))
-                
+        except CircuitOpenError as e:
+            if not report.pages_fetched:
+                logger.warning(f"Skipping 28car scrape: {e}")
+                raise
+            # Pages already scraped are still good; only the rest of the crawl is given up
+            logger.warning(f"Stopping 28car scrape after {report.pages_fetched} pages: {e}")
+            report.stop_reason = 'circuit_open'
         except requests.exceptions.Timeout as e:
             logger.error(f"Timeout error scraping 28car: {e}")
             # Re-raise timeout errors so they can be caught by tests
@@ -134,8 +546,72 @@ class CarDataScraper:
         except Exception as e:
             logger.error(f"Error scraping 28car: {e}")
         
+        scrape_metrics.record(scrapes=1)
         return cars
     
+    def parse_in_pool(self, pool, content, deadline=None):
+        """Listing candidates of one page parsed by the pool; parses inline if the pool can't
+
+        A pool whose worker died is broken for every later page too, so it is discarded and the
+        next page starts a new one.
+        """
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            future = pool.submit(parse_listing_candidates, content)
+            timeout = deadline.timeout(SCRAPE_PAGE_TIMEOUT) if deadline is not None else SCRAPE_PAGE_TIMEOUT
+            return future.result(timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Parser process failed, parsing inline: {e}")
+            if isinstance(e, BrokenProcessPool):
+                discard_parse_pool(pool)
+            return list(self.iter_listing_texts((content,)))
+    
+    def stream_body(self, response, deadline=None):
+        """Chunks of a streamed response body; the connection is released once they are consumed
+
+        Reading stops early, keeping what arrived, once the deadline has passed. A body that times
+        out or breaks off counts as a failed call to the circuit breaker.
+        """
+        try:
+            for chunk in upstream_breaker.iterate(response.iter_content(chunk_size=SCRAPE_STREAM_CHUNK_BYTES)):
+                yield chunk
+                if deadline is not None and deadline.remaining() <= 0:
+                    logger.warning("Deadline reached while reading a page, parsing what arrived")
+                    return
+        finally:
+            response.close()
+    
+    def search_request(self, make=None, model=None, year=None, page=1):
+        """URL and query parameters for one page of 28car search results"""
+        # Use mobile version for simpler structure; filters and codes come from the search catalog
+        return f"{self.base_url}{search_catalog.path}", search_catalog.params(make, model, year, page)
+    
+    def detail_request(self, listing_id):
+        """URL and query parameters of one listing's detail page"""
+        url = f"{self.base_url}{search_catalog.detail_path}"
+        return url, {search_catalog.parameters.get('listing', 'h_vid'): listing_id}
+    
+    def fetch_page(self, url, params, timeout=SCRAPE_PAGE_TIMEOUT, stream=False, deadline=None):
+        """Fetch one listing page through the shared session, raising on HTTP errors
+
+        Throttling and 5xx statuses are retried with backoff, or after the server's Retry-After, but
+        only while the wait plus another attempt fits in the deadline; each attempt's timeout is cut
+        to what is left of it. A wait longer than HTTP_RETRY_BACKOFF_MAX is never taken.
+        """
+        for attempt in range(HTTP_RETRY_TOTAL + 1):
+            attempt_timeout = deadline.timeout(timeout) if deadline is not None else timeout
+            response = self.session.get(url, params=params, timeout=attempt_timeout, stream=stream)
+            if response.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRY_TOTAL:
+                break
+            wait = retry_wait(response, attempt)
+            if wait > HTTP_RETRY_BACKOFF_MAX or (
+                    deadline is not None and wait + MIN_PAGE_BUDGET_SECONDS > deadline.remaining()):
+                break
+            response.close()
+            time.sleep(wait)
+        response.raise_for_status()
+        return response
+    
     def generate_enhanced_mock_data(self, user_car=None):
         """Generate enhanced mock data with focus on user's car and Hong Kong market accuracy"""
         cars = []
@@ -341,50 +817,150 @@ class CarDataScraper:
         
         return max(current_price, new_price * 0.15)  # Minimum 15% of new price
     
-    def parse_28car_row(self, row):
-        """Parse a car listing row from 28car.com"""
-        try:
-            # Get all text from the row
-            text = row.get_text(separator=' ', strip=True)
-            return self.extract_car_data_from_text(text)
-        except Exception as e:
-            logger.error(f"Error parsing 28car row: {e}")
-            return None
+    def parse_listing_page(self, content):
+        """Parse car listings from a raw 28car page body"""
+        return list(self.iter_listings((content,)))
     
-    def parse_28car_div(self, div):
-        """Parse a car listing div from 28car.com mobile version"""
+    def iter_listings(self, chunks):
+        """Yield car listings from page body chunks as soon as each table row is complete"""
+        for text, listing_id in self.iter_listing_texts(chunks):
+            car_data = self.extract_car_data_from_text(text, listing_id)
+            if car_data and car_data['price'] > 0:
+                logger.info(f"Found car: {car_data['make']} {car_data['model']} {car_data['year']} - ${car_data['price']}")
+                yield car_data
+    
+    def iter_listing_texts(self, chunks):
+        """Yield (text, listing_id) for each candidate listing in page body chunks, rows as soon as they close"""
+        # lxml decodes the bytes itself with the declared encoding; no str copy of the page is made
+        from lxml import etree
+        parser = etree.HTMLPullParser(events=('end',), tag='tr', encoding=SCRAPE_PAGE_ENCODING)
+        found = False
+        
+        # Method 1: Look for table rows holding a listing
+        def completed_rows():
+            nonlocal found
+            for _, row in parser.read_events():
+                text = element_text(row)
+                if not self.is_listing_text(text):
+                    continue
+                listing_id = self.find_listing_id(row)
+                if listing_id is None and next(row.iterancestors('tr'), None) is not None:
+                    # The enclosing row may link the listing after this one closes; it becomes the candidate
+                    continue
+                # Once a row is a listing the fallbacks never run, so this row and the rows before it
+                # aren't needed again; dropping them keeps the tree small
+                found = True
+                row.clear(keep_tail=True)
+                parent = row.getparent()
+                while parent is not None and row.getprevious() is not None:
+                    del parent[0]
+                yield text, listing_id
+        
+        for chunk in chunks:
+            if chunk:
+                parser.feed(chunk)
+                yield from completed_rows()
         try:
-            text = div.get_text(separator=' ', strip=True)
-            return self.extract_car_data_from_text(text)
-        except Exception as e:
-            logger.error(f"Error parsing 28car div: {e}")
-            return None
+            root = parser.close()
+        except etree.XMLSyntaxError:
+            return  # Empty body
+        yield from completed_rows()
+        if not found and root is not None:
+            yield from self.fallback_listing_texts(root)
+    
+    def fallback_listing_texts(self, root):
+        """Candidate listings from a parsed page without priced table rows"""
+        found = False
+        
+        # Method 2: Look for div elements with car listings
+        for div in root.iter('div'):
+            if LISTING_DIV_CLASSES.intersection((div.get('class') or '').split()):
+                text = element_text(div)
+                if PRICE_PATTERN.search(text):
+                    found = True
+                    yield text, self.find_listing_id(div)
+        
+        # Method 3: Look for any element containing price patterns
+        if not found:
+            strings = [string for string in root.xpath('//text()') if PRICE_PATTERN.search(string)]
+            for string in strings[:10]:  # Limit to first 10 matches
+                # A tail string belongs to the element enclosing its preceding sibling
+                parent = string.getparent()
+                if string.is_tail and parent is not None:
+                    parent = parent.getparent()
+                if parent is not None:
+                    yield self.price_context_text(parent), None
+    
+    def find_listing_id(self, element):
+        """28car listing id (h_vid) from the first detail-page link or handler inside an element"""
+        for tag in element.iter():
+            if not isinstance(tag.tag, str):
+                continue  # Comments and processing instructions
+            for attr in ('href', 'onclick'):
+                match = LISTING_ID_PATTERN.search(tag.get(attr) or '')
+                if match:
+                    return match.group(1)
+        return None
+    
+    def price_context_text(self, element):
+        """Text of an element containing a price, plus its parent's text for context"""
+        # Get text from the element and its siblings
+        text_parts = []
+        
+        # Get text from current element
+        element_string = element_text(element)
+        if element_string:
+            text_parts.append(element_string)
+        
+        # Get text from parent and siblings for context
+        if element.getparent() is not None:
+            parent_text = element_text(element.getparent())
+            if parent_text and len(parent_text) < 1000:  # Avoid huge text blocks
+                text_parts.append(parent_text)
+        
+        # Combine all text
+        return ' '.join(text_parts)
     
-    def parse_28car_element(self, element, price_text):
-        """Parse car data from any element containing price information"""
+    def listing_price(self, text):
+        """First $ amount in a listing's text, or None when there is none or it's too low to be a car price"""
+        price_matches = re.findall(r'\$([0-9,]+)', text)
+        if not price_matches:
+            return None  # Must have a price
         try:
-            # Get text from the element and its siblings
-            text_parts = []
-            
-            # Get text from current element
-            if element.get_text(strip=True):
-                text_parts.append(element.get_text(separator=' ', strip=True))
-            
-            # Get text from parent and siblings for context
-            if element.parent:
-                parent_text = element.parent.get_text(separator=' ', strip=True)
-                if parent_text and len(parent_text) < 1000:  # Avoid huge text blocks
-                    text_parts.append(parent_text)
-            
-            # Combine all text
-            combined_text = ' '.join(text_parts)
-            return self.extract_car_data_from_text(combined_text)
-            
-        except Exception as e:
-            logger.error(f"Error parsing 28car element: {e}")
+            price = int(price_matches[0].replace(',', ''))
+        except ValueError:
             return None
+        return price if price >= 10000 else None
     
-    def extract_car_data_from_text(self, text):
+    def listing_make(self, text):
+        """Make named in a listing's text, or None when it isn't one the scraper recognizes"""
+        # Handle both English and Chinese brand names
+        if any(keyword in text.upper() for keyword in ['平治', 'BENZ', 'MERCEDES', 'AMG']):
+            return 'Mercedes-Benz'
+        if any(keyword in text for keyword in ['寶馬', 'BMW']):
+            return 'BMW'
+        if any(keyword in text for keyword in ['豐田', 'TOYOTA']):
+            return 'Toyota'
+        if any(keyword in text for keyword in ['本田', 'HONDA']):
+            return 'Honda'
+        return None
+    
+    def listing_date(self, text):
+        """ISO date a listing's text says it was posted, or None when it carries no valid date"""
+        for match in LISTING_DATE_PATTERN.finditer(text):
+            year, month, day = (match.group(1), match.group(2), match.group(3)) if match.group(1) else \
+                (match.group(6), match.group(5), match.group(4))
+            try:
+                return datetime(int(year), int(month), int(day)).strftime('%Y-%m-%d')
+            except ValueError:
+                continue
+        return None
+    
+    def is_listing_text(self, text):
+        """True when extract_car_data_from_text would find a listing in the text"""
+        return len(text) >= 10 and self.listing_price(text) is not None and self.listing_make(text) is not None
+    
+    def extract_car_data_from_text(self, text, listing_id=None):
         """Extract car data from any text block"""
         try:
             # Skip if this doesn't look like a car listing
@@ -405,33 +981,29 @@ class CarDataScraper:
                 'seats': 5,
                 'engine_cc': 2000,
                 'date_listed': datetime.now().strftime('%Y-%m-%d'),
-                'is_mock_data': False
+                'date_basis': 'ingested',  # Until the text gives the day the listing was posted
+                'is_mock_data': False,
+                'fingerprint': listing_fingerprint(text, listing_id)
             }
             
-            # Extract price (format: $xxx,xxx or $xx萬)
-            price_matches = re.findall(r'\$([0-9,]+)', text)
-            if price_matches:
-                price_str = price_matches[0].replace(',', '')
-                try:
-                    car_data['price'] = int(price_str)
-                except ValueError:
-                    return None
-            else:
-                return None  # Must have a price
+            listed = self.listing_date(text)
+            if listed:
+                car_data['date_listed'] = listed
+                car_data['date_basis'] = 'listed'
             
-            # Skip if price is too low (likely not a real car price)
-            if car_data['price'] < 10000:
+            # Extract price (format: $xxx,xxx or $xx萬); skip text without a realistic car price
+            car_data['price'] = self.listing_price(text)
+            if car_data['price'] is None:
                 return None
             
             # Extract year (4-digit number between 1990-2025)
-            year_matches = re.findall(r'\b(20[0-2][0-9]|19[9][0-9])\b', text)
+            year_matches = re.findall(r'\b(20[0-2][0-9]|19[9][0-9])\b', LISTING_DATE_PATTERN.sub(' ', text))
             if year_matches:
                 car_data['year'] = int(year_matches[0])
             
             # Extract make and model from the text
-            # Handle both English and Chinese brand names
-            if any(keyword in text.upper() for keyword in ['平治', 'BENZ', 'MERCEDES', 'AMG']):
-                car_data['make'] = 'Mercedes-Benz'
+            car_data['make'] = self.listing_make(text) or 'Unknown'
+            if car_data['make'] == 'Mercedes-Benz':
                 if any(keyword in text.upper() for keyword in ['CLA250', 'CLA 250']):
                     car_data['model'] = 'CLA250'
                 elif any(keyword in text.upper() for keyword in ['CLA200', 'CLA 200']):
@@ -453,8 +1025,7 @@ class CarDataScraper:
                 elif 'GLC' in text.upper():
                     car_data['model'] = 'GLC'
                     
-            elif any(keyword in text for keyword in ['寶馬', 'BMW']):
-                car_data['make'] = 'BMW'
+            elif car_data['make'] == 'BMW':
                 if 'X3' in text.upper():
                     car_data['model'] = 'X3'
                 elif 'X5' in text.upper():
@@ -464,8 +1035,7 @@ class CarDataScraper:
                 elif any(keyword in text for keyword in ['5系', '520', '528', '530']):
                     car_data['model'] = '5 Series'
                     
-            elif any(keyword in text for keyword in ['豐田', 'TOYOTA']):
-                car_data['make'] = 'Toyota'
+            elif car_data['make'] == 'Toyota':
                 if 'CAMRY' in text.upper():
                     car_data['model'] = 'Camry'
                 elif 'COROLLA' in text.upper():
@@ -476,8 +1046,7 @@ class CarDataScraper:
                     car_data['model'] = 'Prius'
                     car_data['fuel_type'] = 'hybrid'
                     
-            elif any(keyword in text for keyword in ['本田', 'HONDA']):
-                car_data['make'] = 'Honda'
+            elif car_data['make'] == 'Honda':
                 if 'CIVIC' in text.upper():
                     car_data['model'] = 'Civic'
                 elif 'ACCORD' in text.upper():
@@ -681,76 +1250,3220 @@ class CarDataScraper:
             elif make in ["Toyota", "Honda"] and random.random() < 0.4:
                 fuel_type = "hybrid"
             else:
-                fuel_type = random.choice(["petrol", "diesel"])
-            
-            car = {
-                'make': make,
-                'model': model,
-                'year': year,
-                'mileage': mileage,
-                'color': random.choice(colors),
-                'owners': random.choices([1, 2, 3, 4], weights=[60, 25, 12, 3])[0],
-                'price': price,
-                'fuel_type': fuel_type,
-                'transmission': random.choices(transmissions, weights=[85, 15])[0],  # More automatics
-                'seats': random.choices([5, 7, 2, 4], weights=[70, 20, 5, 5])[0],
-                'engine_cc': random.randint(1000, 4000),
-                'date_listed': datetime.now().strftime('%Y-%m-%d'),
-                'is_mock_data': True  # Flag to identify mock data
-            }
-            cars.append(car)
-        
-        return cars
+                fuel_type = random.choice(["petrol", "diesel"])
+            
+            car = {
+                'make': make,
+                'model': model,
+                'year': year,
+                'mileage': mileage,
+                'color': random.choice(colors),
+                'owners': random.choices([1, 2, 3, 4], weights=[60, 25, 12, 3])[0],
+                'price': price,
+                'fuel_type': fuel_type,
+                'transmission': random.choices(transmissions, weights=[85, 15])[0],  # More automatics
+                'seats': random.choices([5, 7, 2, 4], weights=[70, 20, 5, 5])[0],
+                'engine_cc': random.randint(1000, 4000),
+                'date_listed': datetime.now().strftime('%Y-%m-%d'),
+                'is_mock_data': True  # Flag to identify mock data
+            }
+            cars.append(car)
+        
+        return cars
+
+    def parse_car_data(self, data):
+        """Parse car data - for compatibility with extended tests"""
+        # This is a simplified version for backward compatibility
+        if isinstance(data, str):
+            return self.extract_car_data_from_text(data)
+        elif isinstance(data, dict):
+            return data if data.get('make') and data.get('price') else None
+        else:
+            return None
+    
+    def scrape_cars(self, pages=1):
+        """Scrape cars - for compatibility with extended tests"""
+        # This is a simplified version for backward compatibility
+        try:
+            return self.search_cars_by_query(max_pages=pages)
+        except Exception as e:
+            logger.error(f"Error in scrape_cars: {e}")
+            return self.generate_mock_data()[:50]  # Fallback to mock data
+
+# Segments with at least this many listings are analysed from precomputed aggregates
+SEGMENT_MIN_LISTINGS = int(os.environ.get('SEGMENT_MIN_LISTINGS', '20'))
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """Return the process-wide page parser pool, or None when pages are parsed inline"""
+    global _parse_pool
+    if SCRAPE_PARSE_WORKERS <= 0:
+        return None
+    if _parse_pool is None:
+        with _parse_pool_lock:
+            if _parse_pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                # Forking a process that runs request and background threads can copy a held lock into
+                # the child, so workers start from a clean interpreter and skip this module's startup work
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                _parse_pool = ProcessPoolExecutor(max_workers=SCRAPE_PARSE_WORKERS, mp_context=context)
+    return _parse_pool
+
+
+def discard_parse_pool(pool):
+    """Drop a broken parser pool so the next page starts a fresh one"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False)
+
+
+def parse_listing_candidates(content):
+    """Parser process entry point: raw page bytes in, (text, listing_id) candidates out for the extract stage"""
+    return list(CarDataScraper().iter_listing_texts((content,)))
+
+
+# Detail-page enrichment configuration
+DETAIL_ENRICHMENT = os.environ.get('DETAIL_ENRICHMENT', 'false').lower() == 'true'  # Fetch each listing's detail page
+DETAIL_WORKERS = int(os.environ.get('DETAIL_WORKERS', '4'))  # Detail pages fetched concurrently
+DETAIL_HOST_RATE = float(os.environ.get('DETAIL_HOST_RATE', '2'))  # Requests per second to any one host
+DETAIL_CACHE_PATH = os.environ.get('DETAIL_CACHE_PATH')  # Defaults to detail-cache.sqlite in MARKET_SNAPSHOT_DIR
+DETAIL_BUDGET_SECONDS = float(os.environ.get('DETAIL_BUDGET_SECONDS', '120'))  # Detail fetching per scrape without a deadline
+# Detail page fields: label pattern capturing the value, per field
+DETAIL_FIELD_PATTERNS = {
+    'mileage': re.compile(r'(?:里數|里程|Mileage)\D{0,6}([0-9][0-9,.]*)\s*(萬)?', re.IGNORECASE),
+    'owners': re.compile(r'(?:前車主數目|車主數目|手數|Owners?)\D{0,6}(\d+)', re.IGNORECASE),
+    'color': re.compile(r'(?:顏色|Colou?r)\s*[:：]?\s*([^\s:：]+)', re.IGNORECASE),
+}
+DETAIL_COLORS = {'黑': 'black', '白': 'white', '銀': 'silver', '灰': 'grey', '紅': 'red', '藍': 'blue', '金': 'gold',
+                 '綠': 'green', '啡': 'brown', '黃': 'yellow'}
+
+
+def listing_id_of(car):
+    """28car listing id from a scraped listing's fingerprint, or None for text-fingerprinted and mock listings"""
+    fingerprint = car.get('fingerprint') or ''
+    return fingerprint[len('28car:'):] if fingerprint.startswith('28car:') else None
+
+
+def parse_detail_page(content):
+    """Mileage, owners and colour found on a listing's detail page; fields that aren't there are left out"""
+    from lxml import etree
+    root = etree.fromstring(content, etree.HTMLParser(encoding=SCRAPE_PAGE_ENCODING)) if content else None
+    text = element_text(root) if root is not None else ''
+    fields = {}
+    match = DETAIL_FIELD_PATTERNS['mileage'].search(text)
+    if match:
+        mileage = float(match.group(1).replace(',', ''))
+        fields['mileage'] = int(mileage * 10000 if match.group(2) else mileage)
+    match = DETAIL_FIELD_PATTERNS['owners'].search(text)
+    if match:
+        fields['owners'] = int(match.group(1))
+    match = DETAIL_FIELD_PATTERNS['color'].search(text)
+    if match:
+        color = match.group(1)
+        fields['color'] = next((name for key, name in DETAIL_COLORS.items() if key in color), color.lower())
+    return fields
+
+
+class DetailCache:
+    """Persistent detail-page fields keyed by listing id, so each detail page is fetched at most once"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS details '
+                                    '(listing_id TEXT PRIMARY KEY, fields TEXT NOT NULL, fetched_at TEXT NOT NULL)')
+
+    def get(self, listing_id):
+        """Cached fields for the listing, or None when its detail page hasn't been fetched"""
+        with self.lock:
+            row = self.connection.execute('SELECT fields FROM details WHERE listing_id = ?', (listing_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, listing_id, fields):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO details VALUES (?, ?, ?)',
+                                    (listing_id, json.dumps(fields), datetime.now().isoformat()))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM details').fetchone()[0]
+
+
+class HostRateLimiter:
+    """Spaces requests to each host at least 1 / rate seconds apart, across threads"""
+
+    def __init__(self, rate=DETAIL_HOST_RATE, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_slot = {}  # Host -> earliest time the next request may start
+
+    def acquire(self, host):
+        """Block until a request to host may start"""
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+
+class EnrichmentMetrics(ScrapeMetrics):
+    """Counters for detail-page enrichment: cache hits, fetches and their throughput"""
+
+    FIELDS = ('listings', 'cache_hits', 'cache_misses', 'pages_fetched', 'fetch_failures', 'skipped', 'fields_filled',
+              'fetch_seconds')
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        lookups = counts['cache_hits'] + counts['cache_misses']
+        counts['fetch_seconds'] = round(counts['fetch_seconds'], 3)
+        counts['hit_rate'] = round(counts['cache_hits'] / lookups, 4) if lookups else 0.0
+        counts['pages_per_second'] = (round(counts['pages_fetched'] / counts['fetch_seconds'], 2)
+                                      if counts['fetch_seconds'] else 0.0)
+        return counts
+
+
+enrichment_metrics = EnrichmentMetrics()
+
+
+class DetailEnricher:
+    """Replaces estimated mileage, owners and colour with the values on each listing's detail page"""
+
+    def __init__(self, cache, workers=DETAIL_WORKERS, limiter=None, budget=None):
+        self.cache = cache
+        self.workers = workers  # Threads of the pipeline's enrich stage
+        self.limiter = limiter if limiter is not None else HostRateLimiter()
+        self.budget = budget if budget is not None else crawl_budget  # Detail pages count as crawled pages
+        self.pool = None  # Threads fetching for enrich_all, shared by every scrape so the total stays at `workers`
+        self.pool_lock = threading.Lock()
+
+    def lookup(self, car, scraper, timeout=SCRAPE_PAGE_TIMEOUT, deadline=None):
+        """Detail fields for one listing from the cache or its detail page; None when there are none to apply"""
+        listing_id = listing_id_of(car)
+        if listing_id is None:
+            return None
+        enrichment_metrics.record(listings=1)
+        fields = self.cache.get(listing_id)
+        if fields is not None:
+            enrichment_metrics.record(cache_hits=1)
+            return fields
+        enrichment_metrics.record(cache_misses=1)
+        url, params = scraper.detail_request(listing_id)
+        self.limiter.acquire(urlparse(url).netloc)
+        started = time.perf_counter()
+        try:
+            response = upstream_breaker.call(self.fetch, scraper, url, params, timeout, deadline)
+            fields = parse_detail_page(response.content)
+        except Exception as e:
+            # Not cached, so a later scrape tries again; the listing keeps its estimates
+            logger.warning(f"Detail page for listing {listing_id} failed: {e}")
+            enrichment_metrics.record(fetch_failures=1, fetch_seconds=time.perf_counter() - started)
+            return None
+        enrichment_metrics.record(pages_fetched=1, fetch_seconds=time.perf_counter() - started)
+        self.cache.put(listing_id, fields)  # Cached even when empty, so the page isn't fetched again
+        return fields
+
+    def fetch(self, scraper, url, params, timeout, deadline=None):
+        """Fetch a detail page, charging it to the crawl budget once the breaker has let it through"""
+        self.budget.charge(1)
+        return scraper.fetch_page(url, params, timeout=timeout, deadline=deadline)
+
+    def apply(self, car, fields):
+        if fields:
+            car.update(fields)
+            enrichment_metrics.record(fields_filled=len(fields))
+        return car
+
+    def lookup_within(self, car, scraper, deadline=None):
+        """lookup, unless too little of the deadline is left to fetch a page"""
+        if deadline is not None and deadline.remaining() < MIN_PAGE_BUDGET_SECONDS:
+            if listing_id_of(car) is not None:
+                enrichment_metrics.record(skipped=1)
+            return None
+        timeout = deadline.timeout(SCRAPE_PAGE_TIMEOUT) if deadline is not None else SCRAPE_PAGE_TIMEOUT
+        return self.lookup(car, scraper, timeout, deadline)
+
+    def enrich_one(self, car, scraper, deadline=None):
+        """Enrich one listing in place on the calling thread; with too little budget left it keeps its estimates"""
+        return self.apply(car, self.lookup_within(car, scraper, deadline))
+
+    def enrich_all(self, cars, scraper, deadline=None):
+        """Enrich listings in place, looking up their detail pages on up to `workers` threads within one deadline
+
+        Listings whose lookup hasn't finished by the deadline keep their estimates; the lookup still
+        completes in the background and fills the cache for the next scrape. Fields are applied on
+        the calling thread, so a late lookup never changes a listing after this returns.
+        """
+        if not cars:
+            return cars
+        from concurrent.futures import wait
+        with self.pool_lock:
+            if self.pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='detail-fetch')
+        futures = {self.pool.submit(self.lookup_within, car, scraper, deadline): car for car in cars}
+        remaining = deadline.remaining() if deadline is not None else float('inf')
+        done, _ = wait(futures, timeout=None if remaining == float('inf') else remaining)
+        for future in done:
+            if future.exception() is None:
+                self.apply(futures[future], future.result())
+            else:
+                logger.warning(f"Detail lookup failed: {future.exception()}")
+        return cars
+
+
+_detail_enricher = None
+_detail_enricher_lock = threading.Lock()
+
+
+def get_detail_enricher():
+    """Return the process-wide detail enricher, or None when enrichment is off"""
+    global _detail_enricher
+    if not DETAIL_ENRICHMENT:
+        return None
+    if _detail_enricher is None:
+        with _detail_enricher_lock:
+            if _detail_enricher is None:
+                path = DETAIL_CACHE_PATH or os.path.join(MARKET_SNAPSHOT_DIR, 'detail-cache.sqlite')
+                _detail_enricher = DetailEnricher(DetailCache(path))
+    return _detail_enricher
+
+
+# Ingestion pipeline configuration
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '8'))  # Items buffered between two stages
+PIPELINE_STAGES = ('fetch', 'parse', 'extract', 'canonicalize', 'dedupe')
+# Threads per stage, e.g. 'fetch=2,parse=1'; unlisted stages get one, parse one per SCRAPE_PARSE_WORKERS process
+PIPELINE_WORKERS = os.environ.get('PIPELINE_WORKERS', '')
+PIPELINE_PAGE_PAUSE = (1.0, 3.0)  # Seconds each fetch thread waits between pages, like the inline scraper
+
+
+def parse_stage_workers(value):
+    """'fetch=2,parse=1' -> {'fetch': 2, 'parse': 1}"""
+    workers = {}
+    for entry in value.split(','):
+        name, _, count = entry.partition('=')
+        if name.strip() and count.strip():
+            workers[name.strip()] = max(1, int(count))
+    return workers
+
+
+class PipelineStage:
+    """One streaming stage: func maps each item to zero or more outputs, run by `workers` threads"""
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.input = None  # Bounded queue feeding this stage, set by the pipeline
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.items_in = 0
+            self.items_out = 0
+            self.errors = 0
+            self.busy_seconds = 0.0
+            self.max_queue_depth = 0
+
+    def stats(self, elapsed):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'items_in': self.items_in,
+                'items_out': self.items_out,
+                'errors': self.errors,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'throughput_per_second': round(self.items_out / elapsed, 2) if elapsed > 0 else 0.0,
+                'queue_depth': self.input.qsize() if self.input is not None else 0,
+                'max_queue_depth': self.max_queue_depth
+            }
+
+
+class Pipeline:
+    """Stages connected by bounded queues: a stage blocks when the next one falls behind (backpressure)
+
+    Items stream through one at a time, so memory in flight is bounded by the queue sizes however
+    many items the source produces.
+    """
+
+    DONE = object()
+
+    def __init__(self, stages, queue_size=PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.started_at = None
+        self.finished_at = None
+        self.stopped = threading.Event()
+
+    def put(self, target, item, stage=None):
+        while not self.stopped.is_set():
+            try:
+                target.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if stage is not None:
+                with stage.lock:
+                    stage.max_queue_depth = max(stage.max_queue_depth, target.qsize())
+            return True
+        return False
+
+    def get(self, source):
+        while not self.stopped.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return self.DONE
+
+    def run(self, items):
+        """Push items through every stage, yielding the last stage's outputs as they arrive"""
+        self.stopped.clear()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.feed, args=(items, queues[0]), name='pipeline-source', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            stage.reset()
+            stage.input = queues[index]
+            remaining = [stage.workers]  # Workers still running; the last one out closes the next queue
+            for number in range(stage.workers):
+                threads.append(threading.Thread(target=self.work, args=(stage, queues[index + 1], remaining),
+                                                name=f'pipeline-{stage.name}-{number}', daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self.get(queues[-1])
+                if item is self.DONE:
+                    break
+                yield item
+        finally:
+            # Also reached when the consumer stops early: unblock every stage so the threads exit
+            self.stopped.set()
+            self.finished_at = time.monotonic()
+
+    def run_inline(self, items):
+        """Push items through every stage on the calling thread, yielding outputs as they come out of the last
+
+        Items are taken from the source one at a time and each is followed all the way through before
+        the next is taken, so the source can decide on its next item from what the last one produced.
+        A stage that raises stops the run with that error.
+        """
+        self.stopped.clear()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        for stage in self.stages:
+            stage.reset()
+            stage.input = None
+        try:
+            for item in items:
+                yield from self.flow(item, 0)
+        finally:
+            self.finished_at = time.monotonic()
+
+    def flow(self, item, index):
+        if index == len(self.stages):
+            yield item
+            return
+        stage = self.stages[index]
+        with stage.lock:
+            stage.items_in += 1
+        started = time.perf_counter()
+        # Outputs are passed on one at a time, so time spent in later stages isn't counted as this one's
+        for output in stage.func(item) or ():
+            with stage.lock:
+                stage.items_out += 1
+                stage.busy_seconds += time.perf_counter() - started
+            yield from self.flow(output, index + 1)
+            started = time.perf_counter()
+        with stage.lock:
+            stage.busy_seconds += time.perf_counter() - started
+
+    def feed(self, items, target):
+        try:
+            for item in items:
+                if not self.put(target, item, self.stages[0]):
+                    return
+        finally:
+            self.put(target, self.DONE)
+
+    def work(self, stage, target, remaining):
+        next_stage = self.stages[self.stages.index(stage) + 1] if stage is not self.stages[-1] else None
+        while True:
+            item = self.get(stage.input)
+            if item is self.DONE:
+                self.put(stage.input, self.DONE)  # Let sibling workers see it too
+                break
+            started = time.perf_counter()
+            outputs = []
+            try:
+                outputs = list(stage.func(item) or ())
+            except Exception as e:
+                logger.warning(f"Pipeline stage {stage.name} failed on an item: {e}")
+                with stage.lock:
+                    stage.errors += 1
+            with stage.lock:
+                stage.items_in += 1
+                stage.items_out += len(outputs)
+                stage.busy_seconds += time.perf_counter() - started
+            for output in outputs:
+                if not self.put(target, output, next_stage):
+                    return
+        with stage.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self.put(target, self.DONE)
+
+    def stats(self):
+        """Per-stage counters, throughput and queue depths for the current or last run"""
+        if self.started_at is None:
+            return {}
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {stage.name: stage.stats(elapsed) for stage in self.stages}
+
+
+def build_ingestion_pipeline(scraper, workers=None, page_pause=None, deduplicate=True, enricher=None, deadline=None,
+                             report=None, enrich=True):
+    """fetch -> parse -> extract -> canonicalize -> dedupe over (make, model, year, page) search jobs
+
+    The ingestion worker runs these stages on threads; search_cars_by_query runs them inline.
+    deadline bounds every page and detail fetch, and a CrawlReport passed as report counts the pages fetched.
+    With detail enrichment on (or an enricher passed), an enrich stage follows dedupe so each
+    listing's detail page is looked up once; enrich=False leaves it out for callers that enrich
+    the listings themselves.
+    """
+    workers = parse_stage_workers(PIPELINE_WORKERS) if workers is None else workers
+    page_pause = PIPELINE_PAGE_PAUSE if page_pause is None else page_pause
+    fingerprints = set()
+    fingerprints_lock = threading.Lock()
+    local = threading.local()
+
+    def fetch(job):
+        make, model, year, page = job
+        # Each fetch thread pauses between its own pages, within what's left of the deadline
+        if getattr(local, 'fetched', False) and page_pause[1] > 0:
+            pause = random.uniform(*page_pause)
+            if deadline is not None:
+                pause = min(pause, max(0.0, deadline.remaining() - MIN_PAGE_BUDGET_SECONDS))
+            time.sleep(pause)
+        local.fetched = True
+        url, params = scraper.search_request(make, model, year, page)
+        logger.info(f"Scraping 28car page {page} with params: {params}")
+        timeout = deadline.timeout(SCRAPE_PAGE_TIMEOUT) if deadline is not None else SCRAPE_PAGE_TIMEOUT
+        # Pages handed to the parser pool are parsed whole; otherwise they may be parsed as they download
+        streaming = SCRAPE_STREAMING and get_parse_pool() is None
+        response = upstream_breaker.call(scraper.fetch_page, url, params, timeout=timeout, stream=streaming,
+                                         deadline=deadline)
+        scrape_metrics.record(pages=1)
+        if report is not None:
+            report.pages_fetched += 1
+        return [scraper.stream_body(response, deadline) if streaming else response.content]
+
+    def parse(body):
+        # Raw bytes go straight to the parser, which decodes Big5-HKSCS itself
+        if isinstance(body, bytes):
+            pool = get_parse_pool()
+            if pool is not None:
+                return scraper.parse_in_pool(pool, body, deadline)
+            body = (body,)
+        return scraper.iter_listing_texts(body)
+
+    def extract(candidate):
+        car_data = scraper.extract_car_data_from_text(*candidate)
+        if not car_data or car_data['price'] <= 0:
+            return []
+        return [car_data]
+
+    def canonicalize(car):
+        car['make'], car['model'] = canonical.spelling(car['make'], car['model'])
+        return [car]
+
+    def dedupe(car):
+        scrape_metrics.record(listings_parsed=1)
+        fingerprint = car.get('fingerprint')
+        if deduplicate and fingerprint is not None:
+            with fingerprints_lock:
+                if fingerprint in fingerprints:
+                    scrape_metrics.record(duplicates_dropped=1)
+                    return []
+                fingerprints.add(fingerprint)
+        return [car]
+
+    enricher = (enricher if enricher is not None else get_detail_enricher()) if enrich else None
+    detail_deadline = [deadline]
+
+    def enrich(car):
+        # Without a caller deadline, detail fetching still stops DETAIL_BUDGET_SECONDS after it starts
+        if detail_deadline[0] is None:
+            detail_deadline[0] = Deadline(DETAIL_BUDGET_SECONDS)
+        return [enricher.enrich_one(car, scraper, detail_deadline[0])]
+
+    functions = {'fetch': fetch, 'parse': parse, 'extract': extract, 'canonicalize': canonicalize, 'dedupe': dedupe,
+                 'enrich': enrich}
+    stages = PIPELINE_STAGES + (('enrich',) if enricher is not None else ())
+    # Detail fetches wait on the per-host rate limit, so the enrich stage defaults to the enricher's workers
+    defaults = {'enrich': enricher.workers} if enricher is not None else {}
+    if SCRAPE_PARSE_WORKERS > 0:
+        defaults['parse'] = SCRAPE_PARSE_WORKERS  # Each parse thread waits on one page, so one per pool process
+    return Pipeline([PipelineStage(name, functions[name], workers.get(name, defaults.get(name, 1))) for name in stages])
+
+
+def valid_price(car):
+    """Listing price as a float, or None if missing, non-positive or not finite"""
+    price = car.get('price')
+    if price is None:
+        return None
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        return None
+    if not np.isfinite(price) or price <= 0:
+        return None
+    return price
+
+
+def as_number(value):
+    """float(value), or None when value is missing or not numeric"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+# Make/model canonicalization: spellings differ between 28car, mock data and API input
+CANONICAL_CACHE_SIZE = int(os.environ.get('CANONICAL_CACHE_SIZE', '4096'))  # Raw spellings memoized per lookup
+MAKE_ALIASES = {
+    'Mercedes-Benz': ('Mercedes', 'Benz', 'Mercedes Benz', '平治', '賓士', '奔馳'),
+    'BMW': ('寶馬',),
+    'Toyota': ('豐田',),
+    'Honda': ('本田',),
+    'Audi': ('奧迪',),
+    'Lexus': ('凌志',),
+    'Volkswagen': ('VW', '福士'),
+    'Porsche': ('保時捷',),
+    'Tesla': ('特斯拉',),
+    'Nissan': ('日產',),
+    'Mazda': ('萬事得',),
+    'Land Rover': ('Landrover', '路華'),
+}
+MODEL_ALIASES = {
+    'BMW': {'1 Series': ('1系',), '3 Series': ('3系',), '5 Series': ('5系',), '7 Series': ('7系',)},
+    'Mercedes-Benz': {'C-Class': ('C級', 'C Klasse'), 'E-Class': ('E級', 'E Klasse'), 'S-Class': ('S級', 'S Klasse')},
+}
+SPELLING_NOISE = re.compile(r'[\s\-_.]+')
+
+
+def name_key(name):
+    """Spelling-insensitive form of a name: case, spaces, hyphens, underscores and dots dropped"""
+    return SPELLING_NOISE.sub('', name).casefold()
+
+
+def name_text(value):
+    """Raw make/model value as text; missing values are empty"""
+    if isinstance(value, str):
+        return value
+    return '' if value is None else str(value)
+
+
+class Canonicalizer:
+    """Maps raw make/model spellings to canonical keys and interned integer ids
+
+    Aliases are resolved through tables precomputed at construction; each distinct raw spelling
+    is normalized once and then served from an LRU memo, so hot loops compare small integers.
+    """
+
+    def __init__(self, make_aliases=MAKE_ALIASES, model_aliases=MODEL_ALIASES, cache_size=CANONICAL_CACHE_SIZE):
+        self.makes = {}
+        self.names = {}  # Canonical key -> preferred spelling
+        for name, aliases in make_aliases.items():
+            self.names[name_key(name)] = name
+            for alias in (name,) + tuple(aliases):
+                self.makes[name_key(alias)] = name_key(name)
+        self.models = {}
+        for make, models in model_aliases.items():
+            make = self.makes.get(name_key(make), name_key(make))
+            for name, aliases in models.items():
+                self.names[(make, name_key(name))] = name
+                for alias in (name,) + tuple(aliases):
+                    self.models[(make, name_key(alias))] = name_key(name)
+        self.ids = {}
+        self.keys = []  # Id -> key, so ids can be written out as process-independent keys
+        self.lock = threading.Lock()
+        # Memoized on the raw values, so a cache hit costs one dict lookup and no string work
+        self.make = lru_cache(maxsize=cache_size)(self.resolve_make)
+        self.model = lru_cache(maxsize=cache_size)(self.resolve_model)
+        self.make_id = lru_cache(maxsize=cache_size)(self.resolve_make_id)
+        self.model_id = lru_cache(maxsize=cache_size)(self.resolve_model_id)
+        self.spelling = lru_cache(maxsize=cache_size)(self.resolve_spelling)
+
+    def resolve_make(self, raw):
+        """Canonical make key, e.g. 'mercedesbenz' for 'Mercedes Benz' or '平治'"""
+        key = name_key(name_text(raw))
+        return sys.intern(self.makes.get(key, key))
+
+    def resolve_model(self, raw_make, raw_model):
+        """Canonical model key within its make, e.g. '3series' for BMW '3系' or '3 Series'"""
+        key = name_key(name_text(raw_model))
+        return sys.intern(self.models.get((self.make(raw_make), key), key))
+
+    def resolve_make_id(self, raw):
+        return self.intern(('make', self.make(raw)))
+
+    def resolve_model_id(self, raw_make, raw_model):
+        return self.intern(('model', self.make(raw_make), self.model(raw_make, raw_model)))
+
+    def resolve_spelling(self, raw_make, raw_model):
+        """Preferred (make, model) spelling, e.g. ('Mercedes-Benz', 'C-Class') for ('平治', 'C級')"""
+        make = self.make(raw_make)
+        model_key = (make, self.model(raw_make, raw_model))
+        return (self.names.get(make, name_text(raw_make).strip()),
+                self.names.get(model_key, name_text(raw_model).strip()))
+
+    def intern(self, key):
+        with self.lock:
+            interned = self.ids.get(key)
+            if interned is None:
+                interned = self.ids[key] = len(self.keys)
+                self.keys.append(key)
+            return interned
+
+    def key(self, interned):
+        """Key an id was interned for; ids differ between processes, keys don't"""
+        return self.keys[interned]
+
+    def cache_info(self):
+        return {name: getattr(self, name).cache_info()._asdict()
+                for name in ('make', 'model', 'make_id', 'model_id', 'spelling')}
+
+
+canonical = Canonicalizer()
+
+
+# 28car search catalog: parameter names plus the brand and model codes that filter results server-side
+SEARCH_CATALOG_PATH = os.environ.get('SEARCH_CATALOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog_28car.json'))
+
+
+class SearchCatalog:
+    """Builds 28car search parameters from a JSON catalog instead of hard-coded brand codes
+
+    Makes and models are looked up by canonical key, so any alias of a catalogued make gets its
+    code. Filters the catalog has no parameter for are not sent.
+    """
+
+    def __init__(self, data):
+        self.path = data.get('path', '/m_sell_lst.php')
+        self.detail_path = data.get('detail_path', '/m_sell_dsp.php')
+        self.sort = data.get('sort')
+        self.parameters = data.get('parameters', {})
+        self.makes = {}  # Canonical make key -> code
+        self.models = {}  # (canonical make key, canonical model key) -> code
+        self.coded_makes = []  # Catalogued makes with a code, in catalog order
+        for make, entry in data.get('makes', {}).items():
+            if entry.get('code'):
+                self.makes[canonical.make(make)] = str(entry['code'])
+                self.coded_makes.append(make)
+            for model, code in entry.get('models', {}).items():
+                self.models[(canonical.make(make), canonical.model(make, model))] = str(code)
+
+    @classmethod
+    def load(cls, path=SEARCH_CATALOG_PATH):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Search catalog {path} unavailable, searching by free text only: {e}")
+            return cls({})
+
+    def make_code(self, make):
+        return self.makes.get(canonical.make(make)) if make else None
+
+    def model_code(self, make, model):
+        return self.models.get((canonical.make(make), canonical.model(make, model))) if make and model else None
+
+    def supports(self, name):
+        return name in self.parameters
+
+    def params(self, make=None, model=None, year=None, page=1):
+        """Query parameters for one page; coded makes and models are filtered upstream instead of by text"""
+        parameters = self.parameters
+        params = {parameters.get('page', 'h_page'): page}
+        if self.sort is not None:
+            params[parameters.get('sort', 'h_sort')] = self.sort
+        make_code = self.make_code(make) if self.supports('make') else None
+        model_code = self.model_code(make, model) if make_code and self.supports('model') else None
+        # Free text only carries what no code covers
+        search_terms = [term for term, code in ((make, make_code), (model, model_code)) if term and not code]
+        if search_terms:
+            params[parameters.get('text', 'h_srh')] = '+'.join(search_terms)
+        if make_code:
+            params[parameters['make']] = make_code
+        if model_code:
+            params[parameters['model']] = model_code
+        if year and self.supports('year'):
+            params[parameters['year']] = str(year)
+        return params
+
+
+search_catalog = SearchCatalog.load()
+
+
+class SegmentStats:
+    """Immutable price aggregates for one market segment, backed by a sorted price array"""
+    __slots__ = ('prices', 'total', 'scraped_count')
+
+    def __init__(self, prices=None, total=0.0, scraped_count=0):
+        self.prices = prices if prices is not None else np.empty(0)
+        self.total = total
+        self.scraped_count = scraped_count
+
+    @classmethod
+    def from_prices(cls, prices, scraped_count=0):
+        """Build stats for an ad-hoc candidate set with a single sort"""
+        prices = np.sort(np.asarray(prices, dtype=float))
+        return cls(prices, float(prices.sum()), scraped_count)
+
+    @property
+    def count(self):
+        return len(self.prices)
+
+    def rank(self, price):
+        """(lower_priced, higher_priced) counts for a price, by binary search"""
+        lower = int(np.searchsorted(self.prices, price, side='left'))
+        higher = self.count - int(np.searchsorted(self.prices, price, side='right'))
+        return lower, higher
+
+    def percentile_rank(self, price):
+        """Mid-rank percentile (0-100) of a price within the segment"""
+        lower, higher = self.rank(price)
+        equal = self.count - lower - higher
+        return (lower + equal / 2) / self.count * 100
+
+    def updated(self, added=(), removed=(), scraped_delta=0):
+        """Return new stats with the given prices added and removed"""
+        prices = self.prices
+        total = self.total
+        if len(removed):
+            removed = np.sort(np.asarray(removed, dtype=float))
+            # Consecutive equal prices map to consecutive slots starting at their left insertion point
+            starts = np.searchsorted(prices, removed, side='left')
+            offsets = np.arange(len(removed)) - np.searchsorted(removed, removed, side='left')
+            positions = starts + offsets
+            valid = positions < len(prices)
+            valid[valid] = prices[positions[valid]] == removed[valid]
+            positions = positions[valid]
+            total -= float(prices[positions].sum())
+            prices = np.delete(prices, positions)
+        if len(added):
+            added = np.asarray(added, dtype=float)
+            total += float(added.sum())
+            prices = np.sort(np.concatenate([prices, added]), kind='mergesort')
+        return SegmentStats(prices, total, self.scraped_count + scraped_delta)
+
+    def summary(self):
+        """Market statistics in the shape used by analyze_price"""
+        count = self.count
+        mid = count // 2
+        median = self.prices[mid] if count % 2 else (self.prices[mid - 1] + self.prices[mid]) / 2
+        return {
+            'average': self.total / count,
+            'median': float(median),
+            'min': float(self.prices[0]),
+            'max': float(self.prices[-1]),
+            'count': count
+        }
+
+
+class MarketStatsIndex:
+    """Per-segment price aggregates for (make, model, year) and the make+year and make roll-ups"""
+
+    def __init__(self):
+        self.segments = {}
+
+    @staticmethod
+    def segment_keys(make, model, year):
+        make, model = canonical.make(make), canonical.model(make, model)
+        return (
+            ('make_model_year', make, model, year),
+            ('make_year', make, year),
+            ('make', make)
+        )
+
+    def apply(self, added=(), removed=()):
+        """Incrementally fold added and expired listings into the affected segments"""
+        changes = {}
+        for cars, sign in ((added, 1), (removed, -1)):
+            for car in cars:
+                price = valid_price(car)
+                if price is None or not car.get('make'):
+                    continue
+                for key in self.segment_keys(car['make'], car.get('model'), car.get('year')):
+                    change = changes.setdefault(key, ([], [], [0]))
+                    change[0 if sign > 0 else 1].append(price)
+                    if not car.get('is_mock_data', False):
+                        change[2][0] += sign
+        
+        for key, (added_prices, removed_prices, scraped_delta) in changes.items():
+            stats = self.segments.get(key, EMPTY_SEGMENT).updated(added_prices, removed_prices, scraped_delta[0])
+            if stats.count:
+                self.segments[key] = stats
+            else:
+                self.segments.pop(key, None)
+
+    def evolve(self, added=(), removed=()):
+        """Copy-on-write update: a new index sharing every untouched segment with this one"""
+        index = MarketStatsIndex()
+        index.segments = dict(self.segments)
+        index.apply(added, removed)
+        return index
+
+    def to_arrays(self):
+        """(meta, arrays) for the snapshot store: every segment's sorted prices laid end to end"""
+        keys = list(self.segments)
+        stats = [self.segments[key] for key in keys]
+        arrays = {
+            'stats_prices': np.concatenate([s.prices for s in stats]) if stats else np.empty(0),
+            'stats_ends': np.cumsum([s.count for s in stats], dtype=np.int64),
+            'stats_totals': np.array([s.total for s in stats], dtype=float),
+            'stats_scraped': np.array([s.scraped_count for s in stats], dtype=np.int64)
+        }
+        return {'keys': [list(key) for key in keys]}, arrays
+
+    @classmethod
+    def from_arrays(cls, meta, arrays):
+        """Index over stored segments; each segment's prices are a slice of one stored array"""
+        index = cls()
+        prices, ends = arrays['stats_prices'], arrays['stats_ends'].tolist()
+        totals, scraped = arrays['stats_totals'].tolist(), arrays['stats_scraped'].tolist()
+        start = 0
+        for key, end, total, scraped_count in zip(meta['keys'], ends, totals, scraped):
+            index.segments[tuple(key)] = SegmentStats(prices[start:end], total, scraped_count)
+            start = end
+        return index
+
+    def lookup(self, make, model=None, year=None):
+        """Aggregates for the most specific segment requested, or None if it has no listings"""
+        keys = self.segment_keys(make, model, year)
+        if model is not None and year is not None:
+            return self.segments.get(keys[0])
+        if year is not None:
+            return self.segments.get(keys[1])
+        return self.segments.get(keys[2])
+
+
+EMPTY_SEGMENT = SegmentStats()
+
+
+# Nearest-neighbour comparables configuration
+KNN_K = int(os.environ.get('KNN_K', '20'))  # Comparables returned; smaller make/model partitions fall back to a scan
+KNN_LEAF_SIZE = 256  # Points per k-d tree leaf, scanned with one vectorized distance
+KNN_BRUTE_FORCE_MAX = 8192  # Below this many points one vectorized scan beats walking the tree
+KNN_DELTA_MIN = 64  # New listings buffered unindexed before a partition rebuild is considered
+KNN_DELTA_FRACTION = 0.25  # ...and rebuilt once buffered or removed listings exceed this share of the tree
+# Feature units: one unit of distance is 2 years, 40,000 km, a 20% price gap or 500cc
+KNN_SCALES = np.array([2.0, 40000.0, 0.2, 500.0])
+KNN_DEFAULTS = (2020, 50000, 2000)  # year, mileage, engine_cc when a listing lacks them (the scraper's defaults)
+
+
+def knn_features(car):
+    """Scaled (year, mileage, log price, engine_cc) point for a listing, or None without a usable price"""
+    price = valid_price(car)
+    if price is None:
+        return None
+    year = as_number(car.get('year'))
+    mileage = as_number(car.get('mileage'))
+    engine_cc = as_number(car.get('engine_cc'))
+    return np.array([
+        year if year is not None else KNN_DEFAULTS[0],
+        mileage if mileage is not None else KNN_DEFAULTS[1],
+        math.log(price),
+        engine_cc if engine_cc is not None else KNN_DEFAULTS[2]
+    ]) / KNN_SCALES
+
+
+class KDTree:
+    """Static k-d tree over a point array answering k-nearest queries by branch and bound"""
+
+    def __init__(self, points, leaf_size=KNN_LEAF_SIZE, brute_force_max=KNN_BRUTE_FORCE_MAX):
+        self.points = np.asarray(points, dtype=float).reshape(-1, KNN_SCALES.size)
+        if len(self.points) <= brute_force_max:
+            leaf_size = max(leaf_size, len(self.points))  # A single leaf: queries are one scan
+        self.order = np.arange(len(self.points))
+        starts, ends, lefts, rights, lows, highs = [], [], [], [], [], []
+        
+        def add_node(start, end):
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            block = self.points[self.order[start:end]]
+            lows.append(block.min(axis=0) if end > start else np.full(KNN_SCALES.size, np.inf))
+            highs.append(block.max(axis=0) if end > start else np.full(KNN_SCALES.size, -np.inf))
+            return len(starts) - 1
+        
+        stack = [add_node(0, len(self.points))]
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= leaf_size:
+                continue
+            # Split at the median of the widest dimension
+            dim = int(np.argmax(highs[node] - lows[node]))
+            mid = (start + end) // 2
+            segment = self.order[start:end]
+            self.order[start:end] = segment[np.argpartition(self.points[segment, dim], mid - start)]
+            lefts[node] = add_node(start, mid)
+            rights[node] = add_node(mid, end)
+            stack.extend((lefts[node], rights[node]))
+        
+        self.starts = np.array(starts)
+        self.ends = np.array(ends)
+        self.lefts = np.array(lefts)
+        self.rights = np.array(rights)
+        self.lows = np.array(lows)
+        self.highs = np.array(highs)
+
+    TREE_ARRAYS = ('order', 'starts', 'ends', 'lefts', 'rights', 'lows', 'highs')
+
+    @classmethod
+    def from_arrays(cls, points, **arrays):
+        """A tree built earlier, from its stored point and node arrays"""
+        tree = cls.__new__(cls)
+        tree.points = np.asarray(points, dtype=float).reshape(-1, KNN_SCALES.size)
+        for name in cls.TREE_ARRAYS:
+            setattr(tree, name, arrays[name])
+        return tree
+
+    def __len__(self):
+        return len(self.points)
+
+    def box_distance(self, node, point):
+        gap = np.maximum(self.lows[node] - point, 0) + np.maximum(point - self.highs[node], 0)
+        return float(gap @ gap)
+
+    def query(self, point, k):
+        """(squared distances, point indices) of the k nearest points, closest first"""
+        best_d = np.empty(0)
+        best_i = np.empty(0, dtype=int)
+        if not len(self.points) or k <= 0:
+            return best_d, best_i
+        heap = [(self.box_distance(0, point), 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if len(best_d) == k and bound > best_d[-1]:
+                break  # Every remaining box is farther than the current k-th neighbour
+            if self.lefts[node] < 0:
+                ids = self.order[self.starts[node]:self.ends[node]]
+                diff = self.points[ids] - point
+                best_d = np.concatenate([best_d, np.einsum('ij,ij->i', diff, diff)])
+                best_i = np.concatenate([best_i, ids])
+                if len(best_d) > k:
+                    keep = np.argpartition(best_d, k - 1)[:k]
+                    keep = keep[np.argsort(best_d[keep])]
+                else:
+                    keep = np.argsort(best_d)
+                best_d, best_i = best_d[keep], best_i[keep]
+                continue
+            for child in (self.lefts[node], self.rights[node]):
+                heapq.heappush(heap, (self.box_distance(child, point), child))
+        return best_d, best_i
+
+
+class ComparablesPartition:
+    """Listings of one make/model: a k-d tree plus an unindexed buffer of recent changes"""
+
+    __slots__ = ('tree', 'cars', 'delta_points', 'delta_cars', 'removed', 'median_price')
+
+    def __init__(self, tree, cars, delta_points, delta_cars, removed, median_price):
+        self.tree = tree
+        self.cars = cars  # Listing dicts aligned with the tree's points
+        self.delta_points = delta_points
+        self.delta_cars = delta_cars
+        self.removed = removed  # ids of tree listings that have since expired
+        self.median_price = median_price  # As of the last rebuild
+
+    @classmethod
+    def build(cls, cars):
+        points, indexed = [], []
+        for car in cars:
+            point = knn_features(car)
+            if point is not None:
+                points.append(point)
+                indexed.append(car)
+        return cls.over(points, tuple(indexed))
+
+    @classmethod
+    def over(cls, points, cars):
+        """Partition with a fresh tree over points, one per listing in cars"""
+        tree = KDTree(points)
+        median_price = float(np.exp(np.median(tree.points[:, 2]) * KNN_SCALES[2])) if len(cars) else None
+        return cls(tree, cars, np.empty((0, KNN_SCALES.size)), (), frozenset(), median_price)
+
+    def __len__(self):
+        return len(self.cars) - len(self.removed) + len(self.delta_cars)
+
+    def live_cars(self):
+        return [car for car in self.cars if id(car) not in self.removed] + list(self.delta_cars)
+
+    def changed(self, added, removed):
+        """New partition with the changes applied, sharing the tree unless a rebuild is due"""
+        removed_ids = {id(car) for car in removed}
+        delta = [(point, car) for point, car in zip(self.delta_points, self.delta_cars) if id(car) not in removed_ids]
+        for car in added:
+            point = knn_features(car)
+            if point is not None:
+                delta.append((point, car))
+        tree_ids = {id(car) for car in self.cars} if removed_ids else set()
+        tombstones = self.removed | (removed_ids & tree_ids)
+        
+        if len(delta) + len(tombstones) > max(KNN_DELTA_MIN, KNN_DELTA_FRACTION * len(self.cars)):
+            return ComparablesPartition.build(
+                [car for car in self.cars if id(car) not in tombstones] + [car for _, car in delta])
+        delta_points = np.array([point for point, _ in delta]).reshape(-1, KNN_SCALES.size)
+        return ComparablesPartition(self.tree, self.cars, delta_points, tuple(car for _, car in delta), tombstones,
+                                    self.median_price)
+
+    def nearest(self, point, k):
+        """[(distance, listing)] for the k closest live listings"""
+        distances, ids = self.tree.query(point, k + len(self.removed))
+        found = [(d, self.cars[i]) for d, i in zip(distances.tolist(), ids.tolist())
+                 if id(self.cars[i]) not in self.removed]
+        if len(self.delta_cars):
+            diff = self.delta_points - point
+            found.extend(zip(np.einsum('ij,ij->i', diff, diff).tolist(), self.delta_cars))
+        found.sort(key=lambda entry: entry[0])
+        return [(math.sqrt(d), car) for d, car in found[:k]]
+
+
+class ComparablesIndex:
+    """Per make/model nearest-neighbour partitions over normalized listing features"""
+
+    def __init__(self, partitions=None):
+        self.partitions = partitions if partitions is not None else {}
+
+    @staticmethod
+    def partition_key(car):
+        make = car.get('make')
+        return (canonical.make(make), canonical.model(make, car.get('model')))
+
+    def evolve(self, added=(), removed=()):
+        """Copy-on-write update: untouched partitions are shared with this index"""
+        changes = {}
+        for cars, slot in ((added, 0), (removed, 1)):
+            for car in cars:
+                if car.get('make'):
+                    changes.setdefault(self.partition_key(car), ([], []))[slot].append(car)
+        partitions = dict(self.partitions)
+        for key, (added_cars, removed_cars) in changes.items():
+            partition = partitions.get(key)
+            if partition is None:
+                partition = ComparablesPartition.build(added_cars)
+            else:
+                partition = partition.changed(added_cars, removed_cars)
+            if len(partition):
+                partitions[key] = partition
+            else:
+                partitions.pop(key, None)
+        return ComparablesIndex(partitions)
+
+    @classmethod
+    def from_listings(cls, listings):
+        """Index over all of a snapshot's stored listings, built in one scan; partitions read listings by position"""
+        groups = {}
+        for position, car in enumerate(scan_listings(listings)):
+            point = knn_features(car) if car.get('make') else None
+            if point is not None:
+                points, positions = groups.setdefault(cls.partition_key(car), ([], []))
+                points.append(point)
+                positions.append(position)
+        return cls({key: ComparablesPartition.over(points, ListingRows(listings, np.array(positions, dtype=np.int64)))
+                    for key, (points, positions) in groups.items()})
+
+    def to_arrays(self, listings):
+        """(meta, arrays) for the snapshot store, with every tree's listings stored as positions in listings
+
+        Partitions with buffered changes are rebuilt first, so only clean trees over live listings are stored.
+        """
+        keys, medians, trees, cars = [], [], [], []
+        positions = None
+        for key, partition in self.partitions.items():
+            if len(partition.delta_cars) or partition.removed:
+                partition = ComparablesPartition.build(partition.live_cars())
+            keys.append(list(key))
+            medians.append(partition.median_price)
+            trees.append(partition.tree)
+            if isinstance(partition.cars, ListingRows) and partition.cars.listings is listings:
+                cars.append(partition.cars.positions)
+                continue
+            if (isinstance(partition.cars, ListingRows) and isinstance(listings, SplicedListings)
+                    and partition.cars.listings is listings.stored):
+                cars.append(listings.locate(partition.cars.positions))  # A partition no refreshed segment touched
+                continue
+            if positions is None:
+                positions = listing_positions(listings)
+            cars.append(np.array([positions[id(car)] for car in partition.cars], dtype=np.int64))
+        arrays = {
+            'knn_points': np.concatenate([tree.points for tree in trees]) if trees else np.empty((0, KNN_SCALES.size)),
+            'knn_cars': np.concatenate(cars) if cars else np.empty(0, dtype=np.int64),
+            'knn_point_ends': np.cumsum([len(tree.points) for tree in trees], dtype=np.int64),
+            'knn_node_ends': np.cumsum([len(tree.starts) for tree in trees], dtype=np.int64)
+        }
+        for name in KDTree.TREE_ARRAYS:
+            parts = [getattr(tree, name) for tree in trees]
+            arrays[f'knn_{name}'] = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        return {'keys': keys, 'medians': medians}, arrays
+
+    @classmethod
+    def from_arrays(cls, meta, arrays, listings):
+        """Index over stored trees; each partition's listings are read through to the snapshot's listings"""
+        partitions = {}
+        point_start = node_start = 0
+        ends = zip(arrays['knn_point_ends'].tolist(), arrays['knn_node_ends'].tolist())
+        for key, median, (point_end, node_end) in zip(meta['keys'], meta['medians'], ends):
+            tree = KDTree.from_arrays(arrays['knn_points'][point_start:point_end],
+                                      order=arrays['knn_order'][point_start:point_end],
+                                      **{name: arrays[f'knn_{name}'][node_start:node_end]
+                                         for name in KDTree.TREE_ARRAYS if name != 'order'})
+            cars = ListingRows(listings, arrays['knn_cars'][point_start:point_end])
+            partitions[tuple(key)] = ComparablesPartition(tree, cars, np.empty((0, KNN_SCALES.size)), (), frozenset(),
+                                                          median)
+            point_start, node_start = point_end, node_end
+        return cls(partitions)
+
+    def nearest(self, car, k=KNN_K, reference_price=None):
+        """Top-k comparables of the same make/model as [(distance, listing)], or None if there are fewer than k
+
+        reference_price replaces the car's own price in the query, so an asking price can be judged
+        against neighbours it did not select; without one the partition's median price is used.
+        """
+        partition = self.partitions.get(self.partition_key(car))
+        if partition is None or len(partition) < k:
+            return None
+        point = knn_features(dict(car, price=reference_price or partition.median_price or car.get('price')))
+        if point is None:
+            return None
+        return partition.nearest(point, k)
+
+
+class ListingPostings:
+    """Inverted index from make, fuel type, transmission and year to listing positions
+
+    Posting lists are sorted position arrays, so candidate sets are unions and intersections of
+    arrays and iterating them preserves market order. Listings whose year or fields can't be indexed
+    are kept in every candidate set so they are scored exactly as a full scan would. The canonical
+    make and model id of every listing is stored by position for the similarity scan.
+    """
+
+    def __init__(self, listings):
+        self.size = len(listings)
+        tables = {'make': {}, 'fuel_type': {}, 'transmission': {}, 'year': {}}
+        irregular = []
+        self.make_ids = np.empty(self.size, dtype=np.int64)
+        self.model_ids = np.empty(self.size, dtype=np.int64)
+        for position, car in enumerate(scan_listings(listings)):
+            make, year = car.get('make'), car.get('year')
+            self.make_ids[position] = make_id = canonical.make_id(make)
+            self.model_ids[position] = canonical.model_id(make, car.get('model'))
+            fields = [car.get(field) for field in ('fuel_type', 'transmission')]
+            if (isinstance(year, bool) or not isinstance(year, (int, float))
+                    or not math.isfinite(year) or any(value and not isinstance(value, str) for value in fields)):
+                irregular.append(position)
+                continue
+            tables['make'].setdefault(make_id, []).append(position)
+            tables['year'].setdefault(year, []).append(position)
+            for field, value in zip(('fuel_type', 'transmission'), fields):
+                if value:
+                    tables[field].setdefault(value, []).append(position)
+        self.tables = {name: {key: np.array(positions, dtype=np.int64) for key, positions in table.items()}
+                       for name, table in tables.items()}
+        self.years = np.array(sorted(self.tables['year']), dtype=float)
+        self.irregular = np.array(irregular, dtype=np.int64)
+
+    def to_arrays(self):
+        """(meta, arrays) for the snapshot store; make and model ids are written as canonical keys"""
+        meta, arrays = {'tables': {}}, {}
+        for name, ids in (('make', self.make_ids), ('model', self.model_ids)):
+            interned, codes = np.unique(ids, return_inverse=True)
+            meta[f'{name}_keys'] = [list(canonical.key(value)) for value in interned.tolist()]
+            arrays[f'postings_{name}_codes'] = codes.astype(np.int64)
+        for name, table in self.tables.items():
+            keys = list(table)
+            lists = [table[key] for key in keys]
+            meta['tables'][name] = [list(canonical.key(key)) for key in keys] if name == 'make' else keys
+            arrays[f'postings_{name}'] = np.concatenate(lists) if lists else EMPTY_POSTING
+            arrays[f'postings_{name}_ends'] = np.cumsum([len(positions) for positions in lists], dtype=np.int64)
+        arrays['postings_irregular'] = self.irregular
+        return meta, arrays
+
+    @classmethod
+    def from_arrays(cls, meta, arrays):
+        """Postings from the store, with canonical keys interned again in this process"""
+        postings = cls.__new__(cls)
+        for name in ('make', 'model'):
+            interned = np.array([canonical.intern(tuple(key)) for key in meta[f'{name}_keys']], dtype=np.int64)
+            setattr(postings, f'{name}_ids', interned[arrays[f'postings_{name}_codes']])
+        postings.size = len(postings.make_ids)
+        postings.tables = {}
+        for name, keys in meta['tables'].items():
+            if name == 'make':
+                keys = [canonical.intern(tuple(key)) for key in keys]
+            positions, start = arrays[f'postings_{name}'], 0
+            table = postings.tables[name] = {}
+            for key, end in zip(keys, arrays[f'postings_{name}_ends'].tolist()):
+                table[key] = positions[start:end]
+                start = end
+        postings.years = np.array(sorted(postings.tables['year']), dtype=float)
+        postings.irregular = arrays['postings_irregular']
+        return postings
+
+    def posting(self, table, key):
+        return self.tables[table].get(key, EMPTY_POSTING)
+
+    def years_within(self, year, distance):
+        """Positions of listings no more than distance years from year"""
+        lo = np.searchsorted(self.years, year - distance, side='left')
+        hi = np.searchsorted(self.years, year + distance, side='right')
+        lists = [self.tables['year'][key] for key in self.years[lo:hi].tolist()]
+        # Year postings are disjoint, so a sort is a union
+        return np.sort(np.concatenate(lists)) if lists else EMPTY_POSTING
+
+    def candidates(self, user_car, tier):
+        """Sorted positions that could reach a tier's threshold, or None when the tier needs a full scan"""
+        make = canonical.make_id(user_car['make'])
+        if tier == 1:
+            # Without a make match the strict tier tops out at 20 + 15 + 10 + 5 = 50 < 60
+            positions = self.posting('make', make)
+        elif tier == 2:
+            # Without a make match a car needs its year within 8 and a fuel or transmission match:
+            # year (max 25) + price (10) alone is 35 < 40
+            matches = EMPTY_POSTING
+            for field in ('fuel_type', 'transmission'):
+                if user_car.get(field):
+                    matches = np.union1d(matches, self.posting(field, user_car[field]))
+            nearby = np.intersect1d(self.years_within(user_car['year'], 8), matches, assume_unique=True)
+            positions = np.union1d(self.posting('make', make), nearby)
+        else:
+            return None  # Price similarity alone can pass the lenient tier
+        return np.union1d(positions, self.irregular) if len(self.irregular) else positions
+
+
+EMPTY_POSTING = np.empty(0, dtype=np.int64)
+
+# Listing query configuration
+LISTING_SORT_FIELDS = ('price', 'year', 'mileage')
+LISTING_PAGE_SIZE = 20
+LISTING_MAX_PAGE_SIZE = 100
+LISTING_SCAN_CHUNK = 512  # Positions tested per vectorized step when walking a sort order
+LISTING_INDEX_BACKGROUND = os.environ.get('LISTING_INDEX_BACKGROUND', 'true').lower() == 'true'  # Build off the request path
+
+
+class ListingIndex:
+    """Columns, sort orders and ranks over a snapshot's listings for filtered, keyset-paginated queries
+
+    Filters are numpy masks over column arrays. Results are read off a precomputed sort order from
+    the cursor onward, one chunk at a time, so a page costs about the same however many listings
+    the snapshot holds; a make filter with a short posting list is answered from the posting list.
+    """
+
+    def __init__(self, listings, postings):
+        self.listings = listings
+        self.postings = postings
+        self.size = len(listings)
+        # Read a field at a time, so stored listings are indexed without building a dict per listing
+        self.numbers = {field: np.array([number_or_nan(value) for value in listing_values(listings, field)], dtype=float)
+                        for field in LISTING_SORT_FIELDS}
+        self.codes = {}  # Field -> {value: code}
+        self.columns = {}  # Field -> code per listing, -1 when missing
+        makes = listing_values(listings, 'make')
+        for field in ('fuel_type', 'transmission', 'model'):
+            codes = self.codes[field] = {}
+            column = self.columns[field] = np.full(self.size, -1, dtype=np.int64)
+            for position, value in enumerate(listing_values(listings, field)):
+                if field == 'model':
+                    value = canonical.model(makes[position], value)
+                elif isinstance(value, str):
+                    value = value.lower()
+                if value:
+                    column[position] = codes.setdefault(value, len(codes))
+        self.orders = {}  # Sort -> (listing positions in sort order, sort keys in that order, rank of each position)
+        self.lock = threading.Lock()
+
+    def order(self, sort):
+        """Positions sorted by the sort field (prefix '-' for descending), ties by position; missing values last"""
+        if sort not in self.orders:
+            with self.lock:
+                if sort not in self.orders:
+                    keys = self.numbers[sort.lstrip('-')]
+                    keys = -keys if sort.startswith('-') else keys
+                    order = np.argsort(keys, kind='stable')
+                    ranks = np.empty(self.size, dtype=np.int64)
+                    ranks[order] = np.arange(self.size)
+                    self.orders[sort] = (order, keys[order], ranks)
+        return self.orders[sort]
+
+    def warm(self):
+        """Compute every sort order up front"""
+        for field in LISTING_SORT_FIELDS:
+            self.order(field)
+            self.order(f'-{field}')
+        return self
+
+    def mask(self, positions, filters):
+        """Which of positions pass every filter"""
+        keep = np.ones(len(positions), dtype=bool)
+        if filters.get('make'):
+            keep &= self.postings.make_ids[positions] == canonical.make_id(filters['make'])
+        if filters.get('model'):
+            code = self.codes['model'].get(canonical.model(filters.get('make'), filters['model']), -2)
+            keep &= self.columns['model'][positions] == code
+        for field in ('fuel_type', 'transmission'):
+            if filters.get(field):
+                keep &= self.columns[field][positions] == self.codes[field].get(filters[field].lower(), -2)
+        for field in LISTING_SORT_FIELDS:
+            low, high = filters.get(f'{field}_min'), filters.get(f'{field}_max')
+            if low is not None or high is not None:
+                values = self.numbers[field][positions]
+                if low is not None:
+                    keep &= values >= low
+                if high is not None:
+                    keep &= values <= high
+        return keep
+
+    def start_rank(self, sort, cursor):
+        """First rank after the cursor's (sort key, position); NaN keys compare as the largest"""
+        if cursor is None:
+            return 0
+        order, keys, ranks = self.order(sort)
+        key, position = cursor
+        key = float('nan') if key is None else (-key if sort.startswith('-') else key)
+        lo = int(np.searchsorted(keys, key, side='left'))
+        hi = int(np.searchsorted(keys, key, side='right'))
+        # Ties are in position order, so skip the ones up to and including the cursor's position
+        return lo + int(np.searchsorted(order[lo:hi], position, side='right'))
+
+    def query(self, filters, sort='price', limit=LISTING_PAGE_SIZE, cursor=None):
+        """Up to limit listing positions after the cursor, plus whether more follow"""
+        order, keys, ranks = self.order(sort)
+        start = self.start_rank(sort, cursor)
+        # A range on the sort field itself is a seek: skip the listings sorted before its near bound
+        field = sort.lstrip('-')
+        bound = filters.get(f'{field}_max') if sort.startswith('-') else filters.get(f'{field}_min')
+        if bound is not None:
+            start = max(start, int(np.searchsorted(keys, -bound if sort.startswith('-') else bound, side='left')))
+        make = filters.get('make')
+        posting = self.postings.posting('make', canonical.make_id(make)) if make else None
+        candidates = len(posting) + len(self.postings.irregular) if posting is not None else 0
+        # Walking the order tests about limit * size / candidates positions; ranking the posting list tests candidates
+        if posting is not None and candidates * candidates < (limit + 1) * self.size:
+            # Selective make filter: rank the make's listings instead of walking the whole order
+            candidates = np.union1d(posting, self.postings.irregular) if len(self.postings.irregular) else posting
+            candidates = candidates[self.mask(candidates, filters)]
+            candidate_ranks = ranks[candidates]
+            selected = np.sort(candidate_ranks[candidate_ranks >= start])[:limit + 1]
+            found = order[selected]
+        else:
+            found = []
+            for chunk_start in range(start, self.size, LISTING_SCAN_CHUNK):
+                chunk = order[chunk_start:chunk_start + LISTING_SCAN_CHUNK]
+                found.extend(chunk[self.mask(chunk, filters)][:limit + 1 - len(found)].tolist())
+                if len(found) > limit:
+                    break
+        found = [int(position) for position in found]
+        return found[:limit], len(found) > limit
+
+    def sort_key(self, sort, position):
+        value = self.numbers[sort.lstrip('-')][position]
+        return None if math.isnan(value) else float(value)
+
+
+def encode_listing_cursor(version, sort, key, position):
+    """Opaque keyset cursor: the last listing's sort key and position in snapshot version"""
+    payload = json.dumps([version, sort, key, position], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_listing_cursor(cursor, version, sort):
+    """(sort key, position) to resume after; raises ValueError for a malformed cursor or a different sort"""
+    try:
+        cursor_version, cursor_sort, key, position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        key = None if key is None else float(key)
+        position = int(position)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort:
+        raise ValueError('Cursor was issued for a different sort')
+    if cursor_version != version:
+        # Positions belong to the snapshot that issued the cursor; resume after every listing with its key
+        position = sys.maxsize
+    return key, position
+
+
+def parse_listing_query(args):
+    """Filters, sort, limit and cursor of a /api/listings request; raises ValueError for invalid parameters"""
+    filters = {field: args.get(field) for field in ('make', 'model', 'fuel_type', 'transmission') if args.get(field)}
+    for field in LISTING_SORT_FIELDS:
+        for bound in ('min', 'max'):
+            value = args.get(f'{field}_{bound}')
+            if value not in (None, ''):
+                try:
+                    filters[f'{field}_{bound}'] = float(value)
+                except ValueError:
+                    raise ValueError(f'{field}_{bound} must be a number')
+    sort = args.get('sort', 'price')
+    if sort.lstrip('-') not in LISTING_SORT_FIELDS:
+        raise ValueError(f"sort must be one of {', '.join(LISTING_SORT_FIELDS)}, optionally prefixed with '-'")
+    try:
+        limit = int(args.get('limit', LISTING_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if not 1 <= limit <= LISTING_MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {LISTING_MAX_PAGE_SIZE}')
+    return filters, sort, limit, args.get('cursor') or None
+
+
+def number_or_nan(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return float('nan')
+    return float(value)
+
+
+# Market data freshness: analyses scrape again once the snapshot is older than this
+MARKET_DATA_TTL_SECONDS = float(os.environ.get('MARKET_DATA_TTL_SECONDS', '1800'))
+
+
+class MarketSnapshot:
+    """Immutable, versioned market state; writers publish a new snapshot instead of editing this one"""
+
+    __slots__ = ('version', 'listings', 'stats', 'updated_at', 'source', 'comparables', 'postings', 'sketches', 'trends',
+                 'segment_updates', 'query_index', 'index_lock')
+
+    def __init__(self, version=0, listings=None, stats=None, updated_at=None, source=None, comparables=None,
+                 postings=None, sketches=None, trends=None, segment_updates=None):
+        object.__setattr__(self, 'version', version)
+        if listings is not None and not isinstance(listings, (StoredListings, SplicedListings)):
+            listings = tuple(listings)  # Stored and spliced listings are already read-only
+        object.__setattr__(self, 'listings', listings)
+        object.__setattr__(self, 'stats', stats if stats is not None else MarketStatsIndex())
+        object.__setattr__(self, 'updated_at', updated_at)
+        object.__setattr__(self, 'source', source)
+        object.__setattr__(self, 'comparables', comparables if comparables is not None else ComparablesIndex())
+        object.__setattr__(self, 'postings', postings if postings is not None else ListingPostings(self.listings or ()))
+        # Sketches and trends this version was published with; a later publish evolves copies of them
+        object.__setattr__(self, 'sketches', sketches if sketches is not None else SegmentSketches())
+        object.__setattr__(self, 'trends', trends if trends is not None else PriceTrends())
+        # (make, model) segments refreshed on their own after updated_at -> when
+        object.__setattr__(self, 'segment_updates', segment_updates if segment_updates is not None else {})
+        object.__setattr__(self, 'query_index', None)
+        object.__setattr__(self, 'index_lock', threading.Lock())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MarketSnapshot is immutable')
+
+    def index(self):
+        """Query index over the listings; the index builder makes it after publish, else the first query does"""
+        if self.query_index is None:
+            with self.index_lock:  # A query arriving mid-build waits for that build instead of starting another
+                if self.query_index is None:
+                    object.__setattr__(self, 'query_index', ListingIndex(self.listings or (), self.postings))
+        return self.query_index
+
+    @staticmethod
+    def segment_key(make, model):
+        return canonical.make(make), canonical.model(make, model)
+
+    def segment_updated_at(self, segment=None):
+        """When the segment's listings were last refreshed: on their own, or with the whole snapshot"""
+        refreshed = self.segment_updates.get(segment) if segment is not None else None
+        if refreshed is not None and (self.updated_at is None or refreshed > self.updated_at):
+            return refreshed
+        return self.updated_at
+
+    def is_stale(self, max_age_seconds=None, segment=None):
+        """True when the snapshot has no data yet or is older than max_age_seconds, counting a segment from its own refresh"""
+        if self.listings is None:
+            return True
+        max_age_seconds = MARKET_DATA_TTL_SECONDS if max_age_seconds is None else max_age_seconds
+        updated_at = self.segment_updated_at(segment)
+        return bool(updated_at and (datetime.now() - updated_at).total_seconds() > max_age_seconds)
+
+# Quantile sketch configuration
+SKETCH_COMPRESSION = int(os.environ.get('SKETCH_COMPRESSION', '100'))  # Higher = more centroids, more accuracy
+SKETCH_MIN_COUNT = int(os.environ.get('SKETCH_MIN_COUNT', '10'))  # Below this, roll up to a broader segment
+SKETCH_QUANTILES = (('p10', 0.10), ('p25', 0.25), ('median', 0.50), ('p75', 0.75), ('p90', 0.90))
+
+
+class QuantileSketch:
+    """Mergeable t-digest approximating a price distribution in bounded memory"""
+
+    def __init__(self, compression=SKETCH_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = []
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def copy(self):
+        """Independent sketch with the same state; centroid arrays are replaced, never edited, so they are shared"""
+        sketch = QuantileSketch(self.compression)
+        sketch.means, sketch.weights, sketch.buffer = self.means, self.weights, list(self.buffer)
+        sketch.count, sketch.min, sketch.max = self.count, self.min, self.max
+        return sketch
+
+    def update(self, value, weight=1):
+        """Add one observation; centroids are rebuilt once the buffer fills"""
+        value = float(value)
+        self.buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        """Fold another sketch (e.g. from a different shard or worker) into this one"""
+        if not other.count:
+            return self
+        other_means, other_weights = other.centroids()
+        self.buffer.extend(zip(other_means.tolist(), other_weights.tolist()))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def centroids(self):
+        """Sorted centroid means and weights, including any buffered observations"""
+        if not self.buffer:
+            return self.means, self.weights
+        values = np.array([value for value, _ in self.buffer], dtype=float)
+        weights = np.array([weight for _, weight in self.buffer], dtype=float)
+        return self._merge_centroids(np.concatenate([self.means, values]),
+                                     np.concatenate([self.weights, weights]))
+
+    def compress(self):
+        self.means, self.weights = self.centroids()
+        self.buffer = []
+
+    def _merge_centroids(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        scale = self.compression / (2 * np.pi)
+
+        def q_limit(q):
+            # Inverse of the k1 scale function one unit of k beyond q: small centroids at the tails
+            k = scale * np.arcsin(2 * q - 1) + 1
+            if k >= scale * np.pi / 2:
+                return 1.0
+            return (np.sin(k / scale) + 1) / 2
+
+        merged_means = []
+        merged_weights = []
+        current_mean = means[0]
+        current_weight = weights[0]
+        q_left = 0.0
+        limit = q_limit(q_left)
+        for mean, weight in zip(means[1:].tolist(), weights[1:].tolist()):
+            if q_left + (current_weight + weight) / total <= limit:
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                merged_means.append(current_mean)
+                merged_weights.append(current_weight)
+                q_left += current_weight / total
+                limit = q_limit(q_left)
+                current_mean = mean
+                current_weight = weight
+        merged_means.append(current_mean)
+        merged_weights.append(current_weight)
+        return np.array(merged_means, dtype=float), np.array(merged_weights, dtype=float)
+
+    def _curve(self):
+        # Piecewise-linear CDF through min, each centroid's midpoint and max
+        means, weights = self.centroids()
+        cumulative = (np.cumsum(weights) - weights / 2) / self.count
+        return np.concatenate([[self.min], means, [self.max]]), np.concatenate([[0.0], cumulative, [1.0]])
+
+    def quantile(self, q):
+        """Approximate value at quantile q (0-1), or None for an empty sketch"""
+        if not self.count:
+            return None
+        values, ranks = self._curve()
+        return float(np.interp(min(max(q, 0.0), 1.0), ranks, values))
+
+    def percentile_of(self, value):
+        """Approximate share of observations (0-100) priced at or below value"""
+        if not self.count:
+            return None
+        values, ranks = self._curve()
+        return float(np.interp(value, values, ranks) * 100)
+
+    def to_dict(self):
+        means, weights = self.centroids()
+        return {'compression': self.compression, 'count': self.count, 'min': self.min, 'max': self.max,
+                'means': means.tolist(), 'weights': weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get('compression', SKETCH_COMPRESSION))
+        sketch.means = np.array(data['means'], dtype=float)
+        sketch.weights = np.array(data['weights'], dtype=float)
+        sketch.count = data['count']
+        sketch.min = data['min'] if data['count'] else float('inf')
+        sketch.max = data['max'] if data['count'] else float('-inf')
+        return sketch
+
+
+class SegmentSketches:
+    """Quantile sketches per market segment over the whole listing history"""
+
+    def __init__(self, compression=SKETCH_COMPRESSION):
+        self.compression = compression
+        self.sketches = {}
+        self.shared = set()  # Keys whose sketch an older version still reads; copied before the first update
+        self.lock = threading.Lock()
+
+    def evolve(self, cars):
+        """Copy-on-write ingest: new sketches sharing every segment the listings don't touch with these"""
+        sketches = SegmentSketches(self.compression)
+        with self.lock:
+            sketches.sketches = dict(self.sketches)
+        sketches.shared = set(sketches.sketches)
+        sketches.ingest(cars)
+        return sketches
+
+    def ingest(self, cars):
+        """Stream scraped listings into every segment and roll-up they belong to; mock listings are skipped"""
+        touched = set()
+        with self.lock:
+            for car in cars:
+                # Mock listings are regenerated on every refresh and have no fingerprint to count them once
+                if car.get('is_mock_data'):
+                    continue
+                price = valid_price(car)
+                if price is None or not car.get('make'):
+                    continue
+                for key in MarketStatsIndex.segment_keys(car['make'], car.get('model'), car.get('year')):
+                    sketch = self.sketches.get(key)
+                    if sketch is None:
+                        sketch = self.sketches[key] = QuantileSketch(self.compression)
+                    elif key in self.shared:
+                        sketch = self.sketches[key] = sketch.copy()
+                        self.shared.discard(key)
+                    sketch.update(price)
+                    touched.add(key)
+            # Leave sketches compressed so readers never rebuild centroids on the request path
+            for key in touched:
+                self.sketches[key].compress()
+
+    def merge(self, other):
+        """Combine sketches from another shard or worker"""
+        with self.lock:
+            for key, sketch in other.sketches.items():
+                mine = self.sketches.get(key)
+                if mine is None:
+                    mine = self.sketches[key] = QuantileSketch(sketch.compression)
+                elif key in self.shared:
+                    mine = self.sketches[key] = mine.copy()
+                    self.shared.discard(key)
+                mine.merge(sketch)
+        return self
+
+    def lookup(self, make, model=None, year=None, min_count=SKETCH_MIN_COUNT):
+        """Most specific segment sketch with enough observations: (level, sketch) or (None, None)"""
+        for key in MarketStatsIndex.segment_keys(make, model, year):
+            sketch = self.sketches.get(key)
+            if sketch is not None and sketch.count >= min_count:
+                return key[0], sketch
+        return None, None
+
+    def distribution(self, car):
+        """Quantiles of the car's segment and where its price falls, or None if too sparse"""
+        with self.lock:
+            level, sketch = self.lookup(car['make'], car.get('model'), car.get('year'))
+            if sketch is None:
+                return None
+            distribution = {name: sketch.quantile(q) for name, q in SKETCH_QUANTILES}
+            distribution['userPercentile'] = sketch.percentile_of(car['price'])
+            distribution['segment'] = level
+            distribution['sampleSize'] = int(sketch.count)
+        return distribution
+
+    def to_dict(self):
+        with self.lock:
+            return [{'key': list(key), 'sketch': sketch.to_dict()} for key, sketch in self.sketches.items()]
+
+    @classmethod
+    def from_dict(cls, data):
+        sketches = cls()
+        for entry in data:
+            sketches.sketches[tuple(entry['key'])] = QuantileSketch.from_dict(entry['sketch'])
+        return sketches
+
+
+# Market trend configuration
+TREND_WINDOWS = (7, 30, 90)  # Rolling windows in days; the longest one bounds the history kept
+TREND_MIN_DAYS = 3  # Distinct listing days needed before a slope is reported
+TREND_MIN_LISTINGS = int(os.environ.get('TREND_MIN_LISTINGS', '10'))  # Below this, roll up to a broader segment
+TREND_STABLE_PCT = 2.0  # Monthly price change within +/- this is 'stable'
+TREND_CONFIDENCE_LISTINGS = 30  # Listings at which the sample-size part of confidence reaches 0.5
+TREND_CONFIDENCE_DAYS = 14  # Distinct listing days needed for full time coverage
+
+
+def listing_day(car, default):
+    """Ordinal day a listing was posted, or default when date_listed is missing or malformed"""
+    try:
+        return datetime.fromisoformat(str(car.get('date_listed'))[:10]).toordinal()
+    except ValueError:
+        return default
+
+
+def sorted_median(prices):
+    """Median of an already sorted sequence"""
+    middle = len(prices) // 2
+    if len(prices) % 2:
+        return float(prices[middle])
+    return (prices[middle - 1] + prices[middle]) / 2
+
+
+class TrendSeries:
+    """One segment's prices by day, with each rolling window's prices kept sorted as days enter and leave it"""
+
+    def __init__(self, today):
+        self.today = today
+        self.days = {}  # ordinal day -> sorted prices
+        self.ingested = {}  # ordinal day -> how many of its prices are dated by ingestion rather than by the listing
+        self.windows = {window: [] for window in TREND_WINDOWS}  # window -> sorted prices of the days inside it
+        self.summary = None
+
+    def copy(self):
+        series = TrendSeries(self.today)
+        series.days = {day: list(prices) for day, prices in self.days.items()}
+        series.ingested = dict(self.ingested)
+        series.windows = {window: list(prices) for window, prices in self.windows.items()}
+        series.summary = self.summary
+        return series
+
+    def add(self, day, price, ingested=False):
+        bisect.insort(self.days.setdefault(day, []), price)
+        if ingested:
+            self.ingested[day] = self.ingested.get(day, 0) + 1
+        for window, prices in self.windows.items():
+            if self.today - window < day <= self.today:
+                bisect.insort(prices, price)
+        self.summary = None
+
+    def roll(self, today):
+        """Move the windows to end at today, touching only the days that enter or leave each one"""
+        if today == self.today:
+            return
+        for window, prices in self.windows.items():
+            for day, day_prices in self.days.items():
+                was_in = self.today - window < day <= self.today
+                is_in = today - window < day <= today
+                if was_in and not is_in:
+                    for price in day_prices:
+                        del prices[bisect.bisect_left(prices, price)]
+                elif is_in and not was_in:
+                    for price in day_prices:
+                        bisect.insort(prices, price)
+        if today > self.today:
+            for day in [day for day in self.days if day <= today - TREND_WINDOWS[-1]]:
+                del self.days[day]
+                self.ingested.pop(day, None)
+        self.today = today
+        self.summary = None
+
+    def summarize(self):
+        """Rolling-window medians and volumes, monthly slope, volatility and date basis, cached until the series changes"""
+        if self.summary is None:
+            self.summary = self.compute()
+        return self.summary
+
+    def compute(self):
+        today, horizon = self.today, TREND_WINDOWS[-1]
+        recent = sorted(day for day in self.days if today - horizon < day <= today)
+        windows = {f'{window}d': {'median': sorted_median(prices) if prices else None, 'volume': len(prices)}
+                   for window, prices in self.windows.items()}
+        volume = windows[f'{horizon}d']['volume']
+
+        slope_pct = volatility = None
+        if len(recent) >= TREND_MIN_DAYS:
+            # Volume-weighted least squares of log daily median price against day
+            x = np.array(recent, dtype=float) - today
+            y = np.log([sorted_median(self.days[day]) for day in recent])
+            weights = np.array([len(self.days[day]) for day in recent], dtype=float)
+            root = np.sqrt(weights)
+            design = np.column_stack([x, np.ones_like(x)]) * root[:, None]
+            (slope, intercept), *_ = np.linalg.lstsq(design, y * root, rcond=None)
+            slope_pct = float(np.expm1(slope * 30) * 100)
+            # Spread of daily medians around the fitted trend, as a fraction of price
+            residuals = y - (slope * x + intercept)
+            volatility = float(np.sqrt(np.average(residuals ** 2, weights=weights)))
+
+        if slope_pct is None:
+            direction, confidence = 'stable', 0.0
+        else:
+            direction = 'stable' if abs(slope_pct) < TREND_STABLE_PCT else ('increasing' if slope_pct > 0 else 'decreasing')
+            confidence = volume / (volume + TREND_CONFIDENCE_LISTINGS) * min(1.0, len(recent) / TREND_CONFIDENCE_DAYS)
+
+        if volatility is None:
+            volatility_label = 'unknown'
+        elif volatility < 0.03:
+            volatility_label = 'low'
+        elif volatility < 0.08:
+            volatility_label = 'medium'
+        else:
+            volatility_label = 'high'
+
+        # Listings whose page gave no date are placed on the day they were ingested; say so rather than pass it off as a listing date
+        ingested = sum(self.ingested.get(day, 0) for day in recent)
+        if not volume:
+            date_basis = None
+        elif not ingested:
+            date_basis = 'listed'
+        elif ingested == volume:
+            date_basis = 'ingested'
+        else:
+            date_basis = 'mixed'
+
+        return {
+            'direction': direction,
+            'confidence': round(confidence, 2),
+            'volatility': volatility_label,
+            'volatilityValue': round(volatility, 4) if volatility is not None else None,
+            'slopePctPerMonth': round(slope_pct, 2) if slope_pct is not None else None,
+            'windows': windows,
+            'sample_size': volume,
+            'days': len(recent),
+            'dateBasis': date_basis,
+            'asOf': datetime.fromordinal(today).date().isoformat()
+        }
+
+
+class PriceTrends:
+    """Real listing prices by day per segment, with rolling-window aggregates kept up to date as listings arrive"""
+
+    def __init__(self):
+        self.series = {}  # segment key -> TrendSeries
+        self.shared = set()  # Keys whose series an older version still reads; copied before the first add
+        self.lock = threading.Lock()
+
+    def evolve(self, cars, today=None):
+        """Copy-on-write ingest: new trends sharing every segment the listings don't touch with these"""
+        trends = PriceTrends()
+        trends.lock = self.lock  # Shared series still roll forward on read, so every version rolls them under one lock
+        with self.lock:
+            trends.series = dict(self.series)
+        trends.shared = set(trends.series)
+        trends.ingest(cars, today)
+        return trends
+
+    def ingest(self, cars, today=None):
+        """Add listings to their segments' series; summaries are recomputed on the next read of a changed segment"""
+        today = today if today is not None else datetime.now().toordinal()
+        with self.lock:
+            for car in cars:
+                if car.get('is_mock_data'):
+                    continue  # Generated listings are dated today and would read as market movement
+                price = valid_price(car)
+                if price is None or not car.get('make'):
+                    continue
+                day = min(listing_day(car, today), today)
+                if day <= today - TREND_WINDOWS[-1]:
+                    continue  # Older than the longest window
+                ingested = car.get('date_basis') != 'listed'
+                for key in MarketStatsIndex.segment_keys(car['make'], car.get('model'), car.get('year')):
+                    series = self.series.get(key)
+                    if series is None:
+                        series = self.series[key] = TrendSeries(today)
+                    elif key in self.shared:
+                        series = self.series[key] = series.copy()
+                        self.shared.discard(key)
+                    series.roll(today)
+                    series.add(day, price, ingested)
+
+    def summary(self, key, today):
+        series = self.series.get(key)
+        if series is None:
+            return None
+        summary = series.summary
+        if summary is not None and series.today == today:
+            return summary
+        # Windows roll forward at most once per segment per day
+        with self.lock:
+            series.roll(today)
+            return series.summarize()
+
+    def trend(self, car, today=None):
+        """Trend for the most specific segment with enough recent listings"""
+        today = today if today is not None else datetime.now().toordinal()
+        best = None
+        for key in MarketStatsIndex.segment_keys(car['make'], car.get('model'), car.get('year')):
+            summary = self.summary(key, today)
+            if summary is None:
+                continue
+            best = dict(summary, segment=key[0])
+            if summary['sample_size'] >= TREND_MIN_LISTINGS:
+                break
+        return best if best is not None else dict(TrendSeries(today).summarize(), segment=None)
+
+    def to_dict(self):
+        with self.lock:
+            return [{'key': list(key),
+                     'days': {str(day): prices for day, prices in series.days.items()},
+                     'ingested': {str(day): count for day, count in series.ingested.items()}}
+                    for key, series in self.series.items()]
+
+    @classmethod
+    def from_dict(cls, data, today=None):
+        trends = cls()
+        today = today if today is not None else datetime.now().toordinal()
+        for entry in data:
+            series = trends.series[tuple(entry['key'])] = TrendSeries(today)
+            # Files written before the date basis was recorded only held ingest-dated listings
+            ingested = entry.get('ingested')
+            for day, prices in entry['days'].items():
+                count = len(prices) if ingested is None else ingested.get(day, 0)
+                day = int(day)
+                if today - TREND_WINDOWS[-1] < day <= today:
+                    for position, price in enumerate(prices):
+                        series.add(day, price, position < count)
+        return trends
+
+
+# Price model configuration
+MODEL_MIN_LISTINGS = int(os.environ.get('MODEL_MIN_LISTINGS', '50'))  # Below this, no model is fitted
+MODEL_MIN_LEVEL_COUNT = 5  # Listings a make or model needs for its own coefficient
+MODEL_RIDGE = float(os.environ.get('MODEL_RIDGE', '1.0'))  # L2 penalty keeping sparse makes/models near zero
+MODEL_INTERVAL_Z = 1.645  # Two-sided 90% prediction interval
+MODEL_REFIT_SECONDS = float(os.environ.get('MODEL_REFIT_SECONDS', '600'))  # Scheduled refit check
+MODEL_BACKGROUND_REFIT = os.environ.get('MODEL_BACKGROUND_REFIT', 'true').lower() == 'true'
+MODEL_NUMERIC_FEATURES = ('age', 'age_squared', 'log_mileage', 'owners', 'engine_litres')
+
+
+class PriceModel:
+    """Hedonic regression of log price on age, mileage, owners, engine size and make/model effects"""
+
+    def __init__(self, intercept, numeric, make_effects, model_effects, defaults, sigma, r_squared,
+                 reference_year, sample_size, version=None, trained_at=None):
+        self.intercept = intercept
+        self.numeric = numeric  # (mean, scale, weight) per MODEL_NUMERIC_FEATURES entry
+        self.make_effects = make_effects
+        self.model_effects = model_effects
+        self.defaults = defaults  # Training medians used for missing inputs
+        self.sigma = sigma  # Residual standard deviation of log price
+        self.r_squared = r_squared
+        self.reference_year = reference_year
+        self.sample_size = sample_size
+        self.version = version  # Snapshot version the model was fitted on
+        self.trained_at = trained_at
+
+    @staticmethod
+    def raw_features(car, reference_year, defaults):
+        """Unscaled numeric features for one listing, filling gaps with the given defaults"""
+        year = as_number(car.get('year'))
+        age = max(reference_year - year, 0.0) if year is not None else defaults['age']
+        mileage = as_number(car.get('mileage'))
+        mileage = max(mileage, 0.0) if mileage is not None else defaults['mileage']
+        owners = as_number(car.get('owners'))
+        owners = owners if owners is not None else defaults['owners']
+        engine_cc = as_number(car.get('engine_cc'))
+        engine_cc = engine_cc if engine_cc is not None and engine_cc > 0 else defaults['engine_cc']
+        return (age, age * age, math.log1p(mileage), owners, engine_cc / 1000)
+
+    @staticmethod
+    def keys(car):
+        make = canonical.make(car.get('make'))
+        return make, f"{make}|{canonical.model(car.get('make'), car.get('model'))}"
+
+    @classmethod
+    def fit(cls, listings, reference_year=None, version=None):
+        """Ridge least squares on the listings; None when there are too few priced listings
+
+        Listings are read in two passes (one for the defaults, one for the features), never held as dicts.
+        """
+        usable = [valid_price(car) is not None and bool(car.get('make')) for car in scan_listings(listings)]
+        if sum(usable) < MODEL_MIN_LISTINGS:
+            return None
+        reference_year = reference_year if reference_year is not None else datetime.now().year
+        
+        def median_of(field, fallback):
+            values = [value for value in (as_number(value) for value, used in zip(listing_values(listings, field), usable)
+                                          if used) if value is not None]
+            return float(np.median(values)) if values else fallback
+        
+        years = median_of('year', reference_year)
+        defaults = {
+            'age': max(reference_year - years, 0.0),
+            'mileage': median_of('mileage', 0.0),
+            'owners': median_of('owners', 1.0),
+            'engine_cc': median_of('engine_cc', 2000.0)
+        }
+        raw, keys, prices = [], [], []
+        for car, used in zip(scan_listings(listings), usable):
+            if used:
+                raw.append(cls.raw_features(car, reference_year, defaults))
+                keys.append(cls.keys(car))
+                prices.append(valid_price(car))
+        raw = np.array(raw)
+        mean = raw.mean(axis=0)
+        scale = raw.std(axis=0)
+        scale[scale == 0] = 1.0
+        
+        # One column per make and make/model with enough listings; rarer ones share the intercept
+        make_counts, model_counts = {}, {}
+        for make, model in keys:
+            make_counts[make] = make_counts.get(make, 0) + 1
+            model_counts[model] = model_counts.get(model, 0) + 1
+        makes = sorted(key for key, count in make_counts.items() if count >= MODEL_MIN_LEVEL_COUNT)
+        models = sorted(key for key, count in model_counts.items() if count >= MODEL_MIN_LEVEL_COUNT)
+        offset = 1 + len(MODEL_NUMERIC_FEATURES)
+        make_columns = {make: offset + i for i, make in enumerate(makes)}
+        model_columns = {model: offset + len(makes) + i for i, model in enumerate(models)}
+        
+        n = len(keys)
+        design = np.zeros((n, offset + len(makes) + len(models)))
+        design[:, 0] = 1.0
+        design[:, 1:offset] = (raw - mean) / scale
+        for row, (make, model) in enumerate(keys):
+            if make in make_columns:
+                design[row, make_columns[make]] = 1.0
+            if model in model_columns:
+                design[row, model_columns[model]] = 1.0
+        target = np.log(prices)
+        
+        penalty = np.full(design.shape[1], MODEL_RIDGE)
+        penalty[0] = 0.0  # Never shrink the intercept
+        coef = np.linalg.solve(design.T @ design + np.diag(penalty), design.T @ target)
+        residuals = target - design @ coef
+        sigma = float(np.sqrt(residuals @ residuals / max(n - design.shape[1], 1)))
+        total = float(((target - target.mean()) ** 2).sum())
+        r_squared = 1 - float(residuals @ residuals) / total if total > 0 else 0.0
+        
+        return cls(
+            intercept=float(coef[0]),
+            numeric=[(float(m), float(s), float(w)) for m, s, w in zip(mean, scale, coef[1:offset])],
+            make_effects={make: float(coef[column]) for make, column in make_columns.items()},
+            model_effects={model: float(coef[column]) for model, column in model_columns.items()},
+            defaults=defaults,
+            sigma=sigma,
+            r_squared=r_squared,
+            reference_year=reference_year,
+            sample_size=n,
+            version=version,
+            trained_at=datetime.now().isoformat()
+        )
+
+    def log_price(self, car):
+        values = self.raw_features(car, self.reference_year, self.defaults)
+        log_price = self.intercept
+        for value, (mean, scale, weight) in zip(values, self.numeric):
+            log_price += weight * (value - mean) / scale
+        make, model = self.keys(car)
+        return log_price + self.make_effects.get(make, 0.0) + self.model_effects.get(model, 0.0)
+
+    def predict(self, car):
+        """Point estimate and 90% prediction interval from cached coefficients"""
+        log_price = self.log_price(car)
+        spread = MODEL_INTERVAL_Z * self.sigma
+        make, model = self.keys(car)
+        return {
+            'price': round(math.exp(log_price)),
+            'low': round(math.exp(log_price - spread)),
+            'high': round(math.exp(log_price + spread)),
+            'interval': 0.9,
+            'matched': 'make_model' if model in self.model_effects else ('make' if make in self.make_effects else 'none'),
+            'rSquared': round(self.r_squared, 3),
+            'sampleSize': self.sample_size,
+            'trainedOnVersion': self.version
+        }
+
+    def to_dict(self):
+        return {
+            'intercept': self.intercept,
+            'numeric': [list(entry) for entry in self.numeric],
+            'make_effects': self.make_effects,
+            'model_effects': self.model_effects,
+            'defaults': self.defaults,
+            'sigma': self.sigma,
+            'r_squared': self.r_squared,
+            'reference_year': self.reference_year,
+            'sample_size': self.sample_size,
+            'version': self.version,
+            'trained_at': self.trained_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data['numeric'] = [tuple(entry) for entry in data['numeric']]
+        return cls(**data)
+
+
+class ModelRefitter:
+    """Background thread refitting the price model when the market snapshot changes"""
+
+    def __init__(self, analyzer, interval=MODEL_REFIT_SECONDS):
+        self.analyzer = analyzer
+        self.interval = interval
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.fitted_version = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='price-model-refit', daemon=True)
+            self.thread.start()
+        return self
+
+    def request(self):
+        """Ask for a refit soon; never blocks the caller"""
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.refit()
+            except Exception as e:
+                logger.warning(f"Price model refit failed: {e}")
+
+    def refit(self):
+        """Fit on the current snapshot if it changed since the last fit; returns the new model or None"""
+        snapshot = self.analyzer.snapshot
+        if snapshot.version == self.fitted_version or not snapshot.listings:
+            return None
+        model = PriceModel.fit(snapshot.listings, version=snapshot.version)
+        self.fitted_version = snapshot.version
+        if model is None:
+            return None
+        self.analyzer.price_model = model  # Swapped whole; readers use whichever model they picked up
+        if self.analyzer.store is not None:
+            self.analyzer.store.save_model(model)
+        logger.info(f"Refitted price model on snapshot v{snapshot.version}: "
+                    f"{model.sample_size} listings, R^2={model.r_squared:.3f}")
+        return model
+
+
+class ListingIndexBuilder:
+    """Background thread building each published snapshot's query index before /api/listings asks for it"""
+
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.built_version = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='listing-index', daemon=True)
+            self.thread.start()
+        return self
+
+    def request(self):
+        """Ask for the current snapshot's index; never blocks the caller"""
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait()
+            self.wake.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.build()
+            except Exception as e:
+                logger.warning(f"Listing index build failed: {e}")
+
+    def build(self):
+        """Index the current snapshot with every sort order unless already done; returns the index or None"""
+        snapshot = self.analyzer.snapshot
+        if snapshot.version == self.built_version or snapshot.listings is None:
+            return None
+        index = snapshot.index().warm()
+        self.built_version = snapshot.version
+        return index
+
+
+# Demand tracking and prewarming configuration
+DEMAND_HALF_LIFE_SECONDS = float(os.environ.get('DEMAND_HALF_LIFE_SECONDS', '21600'))  # Older queries count for less
+DEMAND_MAX_SEGMENTS = 2000  # Least-demanded segments are forgotten beyond this
+DEMAND_YEAR_BAND = 3  # Model years grouped into one segment
+PREWARM_ENABLED = os.environ.get('PREWARM_ENABLED', 'false').lower() == 'true'
+PREWARM_TOP_SEGMENTS = int(os.environ.get('PREWARM_TOP_SEGMENTS', '5'))  # Segments refreshed per cycle
+PREWARM_LEAD_SECONDS = float(os.environ.get('PREWARM_LEAD_SECONDS', '300'))  # Refresh this long before the TTL runs out
+PREWARM_JITTER_SECONDS = float(os.environ.get('PREWARM_JITTER_SECONDS', '120'))  # Random extra lead so processes spread out
+PREWARM_RETRY_SECONDS = 60  # Wait after a cycle that couldn't refresh anything
+CRAWL_BUDGET_PAGES_PER_HOUR = float(os.environ.get('CRAWL_BUDGET_PAGES_PER_HOUR', '60'))  # Shared by every scrape
+
+
+class DemandTracker:
+    """Exponentially decayed query counts per (make, model, year band) segment"""
+
+    def __init__(self, half_life_seconds=DEMAND_HALF_LIFE_SECONDS, max_segments=DEMAND_MAX_SEGMENTS,
+                 year_band=DEMAND_YEAR_BAND, clock=time.monotonic):
+        self.half_life_seconds = half_life_seconds
+        self.max_segments = max_segments
+        self.year_band = year_band
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Canonical (make, model, first year of the band) -> [score, when it was last updated, spelling]
+        self.segments = {}
+        self.queries = 0
+
+    def decayed(self, entry, now):
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life_seconds)
+
+    def record(self, car):
+        """Count one query for the car's segment; cars without a make, model or year are ignored"""
+        make, model = car.get('make'), car.get('model')
+        try:
+            year = int(car.get('year'))
+        except (TypeError, ValueError):
+            return
+        if not make or not model:
+            return
+        segment = (canonical.make(make), canonical.model(make, model), year - year % self.year_band)
+        now = self.clock()
+        with self.lock:
+            self.queries += 1
+            entry = self.segments.get(segment)
+            if entry is None:
+                self.segments[segment] = [1.0, now, canonical.spelling(make, model)]
+            else:
+                entry[0], entry[1] = self.decayed(entry, now) + 1, now
+            if len(self.segments) > self.max_segments:
+                del self.segments[min(self.segments, key=lambda key: self.decayed(self.segments[key], now))]
 
-    def parse_car_data(self, data):
-        """Parse car data - for compatibility with extended tests"""
-        # This is a simplified version for backward compatibility
-        if isinstance(data, str):
-            return self.extract_car_data_from_text(data)
-        elif isinstance(data, dict):
-            return data if data.get('make') and data.get('price') else None
+    def ranked(self, count):
+        """[(score, make, model, first year of the band)] for the count most-demanded segments"""
+        now = self.clock()
+        with self.lock:
+            scores = [(self.decayed(entry, now),) + entry[2] + (segment[2],) for segment, entry in self.segments.items()]
+        scores.sort(key=lambda item: -item[0])
+        return scores[:count]
+
+    def top(self, count):
+        """The count most-demanded (make, model, band) segments, hottest first, in preferred spelling"""
+        return [segment[1:] for segment in self.ranked(count)]
+
+    def stats(self, count=PREWARM_TOP_SEGMENTS):
+        with self.lock:
+            queries, tracked = self.queries, len(self.segments)
+        return {
+            'queries': queries,
+            'segments_tracked': tracked,
+            'top': [{'make': make, 'model': model, 'years': f'{band}-{band + self.year_band - 1}',
+                     'score': round(score, 2)} for score, make, model, band in self.ranked(count)]
+        }
+
+
+class CrawlBudget:
+    """Token bucket of 28car pages shared by live scrapes and prewarming"""
+
+    def __init__(self, pages_per_hour=CRAWL_BUDGET_PAGES_PER_HOUR, clock=time.monotonic):
+        self.rate = pages_per_hour / 3600.0
+        self.capacity = max(1.0, pages_per_hour)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.refilled_at = clock()
+        self.spent = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def try_spend(self, pages=1):
+        """Take pages from the budget if it has them; optional work (prewarming) asks first"""
+        with self.lock:
+            self.refill(self.clock())
+            if self.tokens < pages:
+                return False
+            self.tokens -= pages
+            self.spent += pages
+            return True
+
+    def has(self, pages=1):
+        """True when the budget holds pages; prewarming checks before a crawl and is charged for what it fetched"""
+        with self.lock:
+            self.refill(self.clock())
+            return self.tokens >= pages
+
+    def charge(self, pages=1):
+        """Record pages a scrape fetched; the budget can go negative, which holds back prewarming"""
+        with self.lock:
+            self.refill(self.clock())
+            self.tokens -= pages
+            self.spent += pages
+
+    def stats(self):
+        with self.lock:
+            self.refill(self.clock())
+            return {'pages_available': round(self.tokens, 1), 'pages_per_hour': round(self.rate * 3600, 1),
+                    'pages_spent': self.spent}
+
+
+demand_tracker = DemandTracker()
+crawl_budget = CrawlBudget()
+
+
+class PrewarmScheduler:
+    """Background thread refreshing the most-demanded segments shortly before the market snapshot expires"""
+
+    def __init__(self, analyzer, tracker=None, budget=None, top_segments=PREWARM_TOP_SEGMENTS,
+                 lead_seconds=PREWARM_LEAD_SECONDS, jitter_seconds=PREWARM_JITTER_SECONDS):
+        self.analyzer = analyzer
+        self.tracker = tracker if tracker is not None else demand_tracker
+        self.budget = budget if budget is not None else crawl_budget
+        self.top_segments = top_segments
+        self.lead_seconds = lead_seconds
+        self.jitter_seconds = jitter_seconds
+        self.stopped = threading.Event()
+        self.thread = None
+        self.refreshes = 0
+        self.segments_refreshed = 0
+        self.segments_skipped = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='market-prewarm', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def searches(self):
+        """(make, model) crawls for the top segments; a model's year bands share one, as the search has no year filter"""
+        return list(OrderedDict.fromkeys((make, model) for make, model, _ in self.tracker.top(self.top_segments)))
+
+    def age(self, snapshot, make, model):
+        """Seconds since the segment's listings were refreshed"""
+        updated_at = snapshot.segment_updated_at(MarketSnapshot.segment_key(make, model))
+        return (datetime.now() - updated_at).total_seconds()
+
+    def delay(self):
+        """Seconds until the next refresh: the stalest top segment's remaining TTL less the lead and some jitter"""
+        snapshot = self.analyzer.snapshot
+        if snapshot.listings is None or snapshot.updated_at is None:
+            return 0.0
+        ages = [self.age(snapshot, make, model) for make, model in self.searches()]
+        age = max(ages) if ages else (datetime.now() - snapshot.updated_at).total_seconds()
+        lead = self.lead_seconds + random.uniform(0, self.jitter_seconds)
+        return max(0.0, MARKET_DATA_TTL_SECONDS - lead - age)
+
+    def run(self):
+        while not self.stopped.wait(self.delay()):
+            try:
+                refreshed = self.refresh()
+            except Exception as e:
+                logger.warning(f"Market data prewarm failed: {e}")
+                refreshed = 0
+            if not refreshed and self.stopped.wait(PREWARM_RETRY_SECONDS):
+                break
+
+    def refresh(self):
+        """Scrape the top segments due within the crawl budget and merge them in; returns how many were scraped"""
+        listings = {}
+        segments = []
+        snapshot = self.analyzer.snapshot
+        due_age = MARKET_DATA_TTL_SECONDS - self.lead_seconds - self.jitter_seconds
+        for make, model in self.searches():
+            if snapshot.updated_at is not None and self.age(snapshot, make, model) < due_age:
+                continue  # Refreshed recently enough on its own
+            if upstream_breaker.is_open() or not self.budget.has(1):
+                self.segments_skipped += 1
+                continue
+            report = CrawlReport()
+            try:
+                cars = self.analyzer.scraper.search_cars_by_query(make=make, model=model, max_pages=1, report=report)
+            except Exception as e:
+                logger.warning(f"Prewarming {make} {model} failed: {e}")
+                continue
+            finally:
+                self.budget.charge(report.pages_fetched)
+            segments.append(MarketSnapshot.segment_key(make, model))
+            for car in cars:
+                listings.setdefault(car.get('fingerprint') or id(car), car)
+        self.segments_refreshed += len(segments)
+        if not listings:
+            return 0
+        if snapshot.listings is None:
+            # Nothing to merge into yet: publish like a live refresh, with mock data so other segments have comparables
+            mock_data = self.analyzer.scraper.generate_enhanced_mock_data()
+            snapshot = self.analyzer.publish(list(listings.values()) + mock_data, datetime.now(), 'prewarm')
         else:
+            snapshot = self.analyzer.publish(list(listings.values()), datetime.now(), 'prewarm', segments=segments)
+        self.refreshes += 1
+        logger.info(f"Prewarmed {len(segments)} segments into market snapshot v{snapshot.version}")
+        return len(segments)
+
+    def stats(self):
+        return {'refreshes': self.refreshes, 'segments_refreshed': self.segments_refreshed,
+                'segments_skipped': self.segments_skipped}
+
+
+# Snapshot persistence configuration
+MARKET_SNAPSHOT_DIR = os.environ.get('MARKET_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+MARKET_SNAPSHOT_PERSIST = os.environ.get('MARKET_SNAPSHOT_PERSIST', 'true').lower() == 'true'
+MARKET_SNAPSHOT_KEEP = 2  # Column files kept on disk so processes still mapping the previous one stay valid
+# Persisted listing fields and how they are encoded; text is dictionary-encoded, missing values round-trip as absent keys
+SNAPSHOT_COLUMNS = (
+    ('make', 'text'), ('model', 'text'), ('year', 'int'), ('mileage', 'int'), ('color', 'text'),
+    ('price', 'number'), ('owners', 'int'), ('transmission', 'text'), ('fuel_type', 'text'),
+    ('seats', 'int'), ('engine_cc', 'int'), ('date_listed', 'text'), ('date_basis', 'text'), ('is_mock_data', 'bool'),
+    ('fingerprint', 'text')
+)
+# Any other field gets a column of the first kind all its values fit; 'json' (dictionary-encoded JSON text) fits anything
+SNAPSHOT_DTYPES = {'text': '<i4', 'int': '<f8', 'number': '<f8', 'bool': '<i1', 'json': '<i4'}
+SNAPSHOT_SCAN_CHUNK = 4096  # Listings decoded per step when stored listings are scanned without caching rows
+
+
+# Ingestion configuration: 'inline' scrapes on the request path, 'worker' only reads what ingest_worker.py stores
+INGESTION_MODE = os.environ.get('INGESTION_MODE', 'inline').lower()
+INGEST_POLL_SECONDS = float(os.environ.get('INGEST_POLL_SECONDS', '10'))  # How often API processes look for new output
+INGEST_STALE_SECONDS = float(os.environ.get('INGEST_STALE_SECONDS', '5400'))  # Worker output older than this is degraded
+
+
+COLUMN_KIND_FITS = OrderedDict((
+    ('bool', lambda value: isinstance(value, bool)),
+    ('int', lambda value: isinstance(value, int) and not isinstance(value, bool)),
+    ('number', lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)),
+    ('text', lambda value: isinstance(value, str))
+))
+
+
+def encode_column(values, kind, codes=None):
+    """Stored form of a chunk of one field's values; codes is the text vocabulary, extended as new values appear"""
+    if kind == 'json':
+        values = [None if value is None else json.dumps(value, sort_keys=True, default=str) for value in values]
+    if kind in ('text', 'json'):
+        return [-1 if value is None else codes.setdefault(str(value), len(codes)) for value in values]
+    if kind == 'bool':
+        return [-1 if value is None else int(bool(value)) for value in values]
+    return [np.nan if value is None else value for value in values]
+
+
+class ListingSpool:
+    """Listings appended to an anonymous temporary file as they stream in, so none has to stay in memory
+
+    Iterating reads them back in order, as often as needed, once the last one has been added.
+    """
+
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile('w+', dir=directory, suffix='.jsonl')
+        self.count = 0
+
+    def add(self, car):
+        self.file.write(json.dumps(car, default=str) + '\n')
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.file.flush()
+        self.file.seek(0)
+        for line in self.file:
+            yield json.loads(line)
+
+    def close(self):
+        self.file.close()
+
+
+class StoredListings:
+    """Read-only listing sequence over a snapshot's mapped columns
+
+    Nothing is decoded when a snapshot is loaded. A listing's dict is built the first time it is read
+    and then kept, so it has one identity for the snapshot's lifetime; values() and scan() read whole
+    columns for aggregate passes without keeping a dict per listing.
+    """
+
+    def __init__(self, columns, fields, vocab, path=None):
+        self.columns = columns
+        self.fields = [(name, kind) for name, kind in fields]
+        self.kinds = dict(self.fields)
+        self.vocab = vocab
+        self.path = path  # The column file mapped, if any
+        self.rows = {}  # Position -> listing dict, for listings read so far
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[index] for index in range(*position.indices(len(self)))]
+        position = int(position)
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('listing position out of range')
+        row = self.rows.get(position)
+        if row is None:
+            row = self.rows.setdefault(position, self.decode(position, position + 1)[0])
+        return row
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def values(self, name, start=0, stop=None, positions=None):
+        """A field's values for a range of listings, or for the listings at positions, None where missing"""
+        kind = self.kinds.get(name)
+        stop = len(self) if stop is None else stop
+        if kind is None:
+            return [None] * (stop - start if positions is None else len(positions))
+        column = (self.columns[name][start:stop] if positions is None else self.columns[name][positions]).tolist()
+        if kind in ('text', 'json'):
+            words = self.vocab[name]
+            if kind == 'json':
+                return [json.loads(words[code]) if code >= 0 else None for code in column]
+            return [words[code] if code >= 0 else None for code in column]
+        if kind == 'bool':
+            return [bool(value) if value >= 0 else None for value in column]
+        # NaN marks a missing value
+        return [(int(value) if kind == 'int' or value.is_integer() else value) if value == value else None
+                for value in column]
+
+    def decode(self, start=0, stop=None, positions=None):
+        """Listing dicts for a range or for positions, built a column at a time; missing values are absent keys"""
+        stop = len(self) if stop is None else stop
+        cars = [{} for _ in range(stop - start if positions is None else len(positions))]
+        for name, _ in self.fields:
+            for car, value in zip(cars, self.values(name, start, stop, positions)):
+                if value is not None:
+                    car[name] = value
+        return cars
+
+    def scan(self):
+        """Every listing in order, reusing dicts already read and decoding the rest in chunks without keeping them"""
+        for start in range(0, len(self), SNAPSHOT_SCAN_CHUNK):
+            stop = min(start + SNAPSHOT_SCAN_CHUNK, len(self))
+            for position, car in enumerate(self.decode(start, stop), start):
+                yield self.rows.get(position, car)
+
+
+class ListingRows:
+    """Listings at some positions of a snapshot's listings, read through to them"""
+
+    __slots__ = ('listings', 'positions')
+
+    def __init__(self, listings, positions):
+        self.listings = listings
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        return self.listings[self.positions[index]]
+
+    def __iter__(self):
+        for position in self.positions.tolist():
+            yield self.listings[position]
+
+
+class SplicedListings:
+    """Stored listings at some positions followed by listings added since, read through to the stored ones
+
+    What a segment refresh publishes over a loaded snapshot: the stored listings it keeps are referenced
+    by position instead of decoded, and a listing read here is the stored listings' dict for it.
+    """
+
+    def __init__(self, stored, positions, added):
+        self.stored = stored
+        self.positions = positions  # Ascending positions in stored
+        self.added = tuple(added)
+
+    def __len__(self):
+        return len(self.positions) + len(self.added)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[index] for index in range(*position.indices(len(self)))]
+        position = int(position)
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('listing position out of range')
+        if position < len(self.positions):
+            return self.stored[int(self.positions[position])]
+        return self.added[position - len(self.positions)]
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def values(self, name):
+        return self.stored.values(name, positions=self.positions) + [car.get(name) for car in self.added]
+
+    def scan(self):
+        """Every listing in order; stored ones are decoded in chunks without keeping them, as StoredListings.scan"""
+        rows = self.stored.rows
+        for start in range(0, len(self.positions), SNAPSHOT_SCAN_CHUNK):
+            positions = self.positions[start:start + SNAPSHOT_SCAN_CHUNK]
+            for position, car in zip(positions.tolist(), self.stored.decode(positions=positions)):
+                yield rows.get(position, car)
+        yield from self.added
+
+    def locate(self, positions):
+        """Positions here of listings at positions in stored, all of which must have been kept"""
+        return np.searchsorted(self.positions, positions)
+
+
+def splice_segments(listings, segments, fresh):
+    """(listings, dropped): every listing in segments replaced by the fresh listings, and the listings that were in them
+
+    A (make, None) segment covers every model of the make. Stored listings are only read a column at a
+    time to find the segments' listings; the ones kept are spliced in by position without being decoded.
+    """
+    segments = set(segments)
+    keys = map(MarketSnapshot.segment_key, listing_values(listings, 'make'), listing_values(listings, 'model'))
+    keep = np.array([key not in segments and (key[0], None) not in segments for key in keys], dtype=bool)
+    dropped = [listings[position] for position in np.flatnonzero(~keep).tolist()]
+    if isinstance(listings, SplicedListings):
+        stored = len(listings.positions)
+        added = [car for car, kept in zip(listings.added, keep[stored:].tolist()) if kept]
+        return SplicedListings(listings.stored, listings.positions[keep[:stored]], added + list(fresh)), dropped
+    if isinstance(listings, StoredListings):
+        return SplicedListings(listings, np.flatnonzero(keep), fresh), dropped
+    return [car for car, kept in zip(listings, keep.tolist()) if kept] + list(fresh), dropped
+
+
+def scan_listings(listings):
+    """Iterate listings for an aggregate pass; stored listings are decoded in chunks instead of cached"""
+    return listings.scan() if isinstance(listings, (StoredListings, SplicedListings)) else iter(listings)
+
+
+def listing_values(listings, name):
+    """One field of every listing, None where missing"""
+    if isinstance(listings, (StoredListings, SplicedListings)):
+        return listings.values(name)
+    return [car.get(name) for car in listings]
+
+
+def listing_positions(listings):
+    """id(listing) -> position for the listings that exist as dicts; stored listings only have the ones read so far"""
+    if isinstance(listings, StoredListings):
+        return {id(car): position for position, car in listings.rows.items()}
+    if isinstance(listings, SplicedListings):
+        kept = {position: index for index, position in enumerate(listings.positions.tolist())}
+        positions = {id(car): kept[position] for position, car in listings.stored.rows.items() if position in kept}
+        positions.update((id(car), len(kept) + index) for index, car in enumerate(listings.added))
+        return positions
+    return {id(car): position for position, car in enumerate(listings)}
+
+
+class SnapshotStore:
+    """Columnar on-disk copy of the latest market snapshot, memory-mapped read-only on startup"""
+
+    META_FILE = 'market-snapshot.json'
+    MODEL_FILE = 'price-model.json'
+
+    def __init__(self, directory=MARKET_SNAPSHOT_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.saved_version = None
+
+    def save(self, snapshot, sketches=None, trends=None):
+        """Write listings as a structured .npy and their indexes as an .npz, then atomically point the metadata at them
+
+        Listings already written to this store's column files (write_listings) are not written again.
+        """
+        listings = snapshot.listings or ()
+        # Derived indexes are stored with positions into the column file, so loading never rebuilds them
+        index_meta, arrays = {}, {}
+        for name, (meta, stored) in (('stats', snapshot.stats.to_arrays()),
+                                     ('comparables', snapshot.comparables.to_arrays(listings)),
+                                     ('postings', snapshot.postings.to_arrays())):
+            index_meta[name] = meta
+            arrays.update(stored)
+
+        with self.lock:
+            # Concurrent refreshes may finish out of order; never overwrite a newer snapshot
+            if self.saved_version is not None and snapshot.version <= self.saved_version:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            if self.holds(listings):
+                stem = os.path.basename(listings.path)[:-len('.npy')]
+                fields, vocab = listings.fields, listings.vocab
+            else:
+                stem = f'market-snapshot-{snapshot.version}-{os.getpid()}'
+                fields, vocab = self.write_columns(os.path.join(self.directory, f'{stem}.npy'),
+                                                   lambda: scan_listings(listings))
+            np.savez(os.path.join(self.directory, f'{stem}.npz'), **arrays)
+            meta = {
+                'version': snapshot.version,
+                'updated_at': snapshot.updated_at.isoformat() if snapshot.updated_at else None,
+                'source': snapshot.source,
+                'count': len(listings),
+                'data_file': f'{stem}.npy',
+                'index_file': f'{stem}.npz',
+                'columns': [[name, kind] for name, kind in fields],
+                'vocab': vocab,
+                'index': index_meta,
+                'sketches': sketches.to_dict() if sketches is not None else None,
+                'trends': trends.to_dict() if trends is not None else None
+            }
+            meta_path = os.path.join(self.directory, self.META_FILE)
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+            self.saved_version = snapshot.version
+            self.prune(stem)
+
+    @staticmethod
+    def write_columns(path, scan):
+        """Encode listings into a structured .npy at path; returns its (fields, vocab)
+
+        scan() iterates the listings afresh. The first pass settles every field's column kind, the
+        second fills the file through a writable mapping a chunk at a time, so memory doesn't grow
+        with the listings. The file is written under a temporary name and renamed into place.
+        """
+        kinds = OrderedDict((name, [kind]) for name, kind in SNAPSHOT_COLUMNS)
+        count = 0
+        for car in scan():
+            count += 1
+            for name, value in car.items():
+                candidates = kinds.get(name)
+                if candidates is None:
+                    candidates = kinds[name] = list(COLUMN_KIND_FITS)
+                if value is not None and candidates:
+                    kinds[name] = [kind for kind in candidates if COLUMN_KIND_FITS[kind](value)]
+        fields = [(name, candidates[0] if candidates else 'json') for name, candidates in kinds.items()]
+
+        dtype = np.dtype([(name, SNAPSHOT_DTYPES[kind]) for name, kind in fields])
+        columns = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=(count,))
+        codes = {name: {} for name, kind in fields if kind in ('text', 'json')}
+        cars = scan()
+        for start in range(0, count, SNAPSHOT_SCAN_CHUNK):
+            chunk = list(islice(cars, SNAPSHOT_SCAN_CHUNK))
+            for name, kind in fields:
+                columns[name][start:start + len(chunk)] = encode_column([car.get(name) for car in chunk], kind,
+                                                                        codes.get(name))
+        columns.flush()
+        del columns
+        os.replace(path + '.tmp', path)  # A new file: processes mapping an older one at this path keep their pages
+        return fields, {name: list(words) for name, words in codes.items()}
+
+    def write_listings(self, listings, version):
+        """Write streamed listings (e.g. a ListingSpool) straight to a column file here; returns them mapped read-only
+
+        Publishing the result saves it without writing the columns a second time.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'market-snapshot-{version}-{os.getpid()}.npy')
+        fields, vocab = self.write_columns(path, lambda: iter(listings))
+        return StoredListings(np.load(path, mmap_mode='r', allow_pickle=False), fields, vocab, path)
+
+    def holds(self, listings):
+        """True when the listings are mapped from one of this store's column files"""
+        return (isinstance(listings, StoredListings) and listings.path is not None
+                and os.path.dirname(os.path.abspath(listings.path)) == os.path.abspath(self.directory))
+
+    def save_model(self, model):
+        """Persist fitted price model coefficients"""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, self.MODEL_FILE)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(model.to_dict(), f)
+            os.replace(path + '.tmp', path)
+
+    def load_model(self):
+        """Return the persisted PriceModel, or None"""
+        try:
+            with open(os.path.join(self.directory, self.MODEL_FILE)) as f:
+                return PriceModel.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.info(f"No persisted price model loaded: {e}")
             return None
-    
-    def scrape_cars(self, pages=1):
-        """Scrape cars - for compatibility with extended tests"""
-        # This is a simplified version for backward compatibility
+
+    def stamp(self):
+        """Modification times of the metadata and model files, to notice writes by another process"""
+        stamps = []
+        for name in (self.META_FILE, self.MODEL_FILE):
+            try:
+                stamps.append(os.stat(os.path.join(self.directory, name)).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def prune(self, current):
+        """Remove column and index files beyond the most recent few"""
+        stems = {name.rsplit('.', 1)[0] for name in os.listdir(self.directory)
+                 if name.startswith('market-snapshot-') and name.endswith(('.npy', '.npz'))} - {current}
+        stems = sorted(stems, key=lambda stem: self.written_at(stem), reverse=True)
+        for stem in stems[MARKET_SNAPSHOT_KEEP - 1:]:
+            for suffix in ('.npy', '.npz'):
+                try:
+                    os.remove(os.path.join(self.directory, stem + suffix))
+                except OSError:
+                    pass  # Another process already pruned it, or the stem has no index file
+
+    def written_at(self, stem):
+        for suffix in ('.npy', '.npz'):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, stem + suffix))
+            except OSError:
+                continue
+        return 0.0
+
+    def load(self):
+        """Return (snapshot, sketches, trends) from disk, or None when nothing usable is stored
+
+        Listings stay on the read-only mapping and are decoded as they are read. Snapshots written with
+        an index file get their stats, postings and comparables back without a rebuild.
+        """
+        meta_path = os.path.join(self.directory, self.META_FILE)
         try:
-            return self.search_cars_by_query(max_pages=pages)
-        except Exception as e:
-            logger.error(f"Error in scrape_cars: {e}")
-            return self.generate_mock_data()[:50]  # Fallback to mock data
+            with open(meta_path) as f:
+                meta = json.load(f)
+            # Read-only mapping: pages come from the OS page cache and are shared between processes
+            columns = np.load(os.path.join(self.directory, meta['data_file']), mmap_mode='r', allow_pickle=False)
+            arrays = None
+            if meta.get('index_file'):
+                with np.load(os.path.join(self.directory, meta['index_file']), allow_pickle=False) as stored:
+                    arrays = {name: stored[name] for name in stored.files}
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f"No persisted market snapshot loaded: {e}")
+            return None
+
+        fields = meta.get('columns') or [(name, kind) for name, kind in SNAPSHOT_COLUMNS if name in columns.dtype.names]
+        listings = StoredListings(columns, fields, meta['vocab'], os.path.join(self.directory, meta['data_file']))
+        updated_at = datetime.fromisoformat(meta['updated_at']) if meta.get('updated_at') else None
+        if arrays is not None:
+            index = meta['index']
+            stats = MarketStatsIndex.from_arrays(index['stats'], arrays)
+            comparables = ComparablesIndex.from_arrays(index['comparables'], arrays, listings)
+            postings = ListingPostings.from_arrays(index['postings'], arrays)
+        else:
+            # Written before indexes were stored: build them once from the columns
+            stats = MarketStatsIndex()
+            stats.apply(added=listings.scan())
+            comparables = ComparablesIndex.from_listings(listings)
+            postings = None
+        snapshot = MarketSnapshot(meta['version'], listings, stats, updated_at, meta.get('source'), comparables, postings)
+        sketches = SegmentSketches.from_dict(meta['sketches']) if meta.get('sketches') is not None else None
+        trends = PriceTrends.from_dict(meta['trends']) if meta.get('trends') is not None else None
+        return snapshot, sketches, trends
+
+
+class StoreWatcher:
+    """Background thread adopting snapshots and price models the ingestion worker writes to the store"""
+
+    def __init__(self, analyzer, interval=INGEST_POLL_SECONDS):
+        self.analyzer = analyzer
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stamp = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='snapshot-store-watch', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning(f"Loading ingested market data failed: {e}")
+
+    def poll(self):
+        """Load whatever changed on disk since the last poll; returns True when something was adopted"""
+        store = self.analyzer.store
+        stamp = store.stamp()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        model = store.load_model()
+        if model is not None:
+            self.analyzer.price_model = model
+        loaded = store.load()
+        if loaded is not None:
+            self.analyzer.adopt(*loaded)
+            logger.info(f"Adopted ingested market snapshot v{loaded[0].version} ({len(loaded[0].listings)} listings)")
+        return model is not None or loaded is not None
+
 
 class CarAnalyzer:
-    def __init__(self):
+    def __init__(self, store=None, ingestion_mode=INGESTION_MODE):
         self.scraper = CarDataScraper()
-        self.market_data = None
-        self.last_update = None
+        # Readers take one reference to the current snapshot per request; only publish() replaces it
+        self.snapshot = MarketSnapshot()
+        self.publish_lock = threading.Lock()
+        self.store = store  # Optional SnapshotStore written after every refresh
+        self.price_model = None  # Replaced wholesale by the background refitter
+        self.refitter = None
+        self.indexer = None
+        self.seen = SeenFingerprints()  # Scraped listings already counted in sketches and trends
+        self.ingestion_mode = ingestion_mode  # In 'worker' mode this process never scrapes or writes the store
+        self.watcher = None
+        self.mock_snapshot = None  # Worker mode: mock data served until the first ingested snapshot, never published
+        self.prewarmer = None
+    
+    def warm_start(self):
+        """Adopt the persisted snapshot, if any, so the first request doesn't wait on a refresh"""
+        if self.store is None:
+            return False
+        self.price_model = self.store.load_model()
+        loaded = self.store.load()
+        if loaded is None:
+            return False
+        snapshot = self.adopt(*loaded)
+        logger.info(f"Loaded persisted market snapshot v{snapshot.version} ({len(snapshot.listings)} listings)")
+        return True
+    
+    def adopt(self, snapshot, sketches=None, trends=None):
+        """Swap in a snapshot loaded from the store, with its persisted sketches and trends when present"""
+        with self.publish_lock:
+            current = self.snapshot
+            if sketches is None:
+                sketches = current.sketches.evolve(scan_listings(snapshot.listings))
+            if trends is None:
+                trends = current.trends.evolve(scan_listings(snapshot.listings))
+            for fingerprint in listing_values(snapshot.listings, 'fingerprint'):
+                if fingerprint is not None:
+                    self.seen.add(fingerprint)
+            snapshot = MarketSnapshot(snapshot.version, snapshot.listings, snapshot.stats, snapshot.updated_at,
+                                      snapshot.source, snapshot.comparables, snapshot.postings, sketches, trends)
+            self.snapshot = snapshot
+        if self.indexer is not None:
+            self.indexer.request()
+        return snapshot
+    
+    def can_scrape(self):
+        """False in worker ingestion mode, where only ingest_worker.py talks to 28car"""
+        return self.ingestion_mode != 'worker'
+    
+    def watch_store(self):
+        """Serve what the ingestion worker stores: load it now, then poll for newer output"""
+        if self.watcher is None:
+            self.watcher = StoreWatcher(self)
+            self.watcher.poll()
+            self.watcher.start()
+        return self.watcher
+    
+    @property
+    def market_data(self):
+        return self.snapshot.listings
+    
+    @market_data.setter
+    def market_data(self, listings):
+        self.publish(listings, updated_at=self.snapshot.updated_at)
+    
+    @property
+    def last_update(self):
+        return self.snapshot.updated_at
+    
+    @last_update.setter
+    def last_update(self, value):
+        with self.publish_lock:
+            current = self.snapshot
+            self.snapshot = MarketSnapshot(current.version + 1, current.listings, current.stats, value, current.source,
+                                           current.comparables, current.postings, current.sketches, current.trends,
+                                           current.segment_updates)
+    
+    @property
+    def segment_stats(self):
+        return self.snapshot.stats
+    
+    @property
+    def sketches(self):
+        return self.snapshot.sketches
+    
+    @property
+    def trends(self):
+        return self.snapshot.trends
+    
+    def publish(self, listings, updated_at=None, source=None, segments=None):
+        """Build a new snapshot from listings and swap it in; aggregates only change for listings that changed
+
+        With segments, listings are a refresh of just those (make, model) segments: they replace every current
+        listing in those segments, so listings gone from the refresh are dropped, the rest are kept, and only
+        those segments are marked refreshed at updated_at. Every other segment keeps its age.
+        """
+        with self.publish_lock:
+            current = self.snapshot
+            segment_updates = None
+            spliced = None
+            if segments is not None and current.listings is not None:
+                added = list(listings or ())
+                listings, removed = splice_segments(current.listings, segments, added)
+                spliced = (added, removed)
+                segment_updates = dict(current.segment_updates)
+                segment_updates.update((segment, updated_at) for segment in segments)
+                updated_at = current.updated_at
+            if isinstance(listings, StoredListings):
+                # Streamed straight to columns (the ingestion worker): every listing is new, so index them by
+                # scanning the columns rather than diffing against the current snapshot dict by dict
+                stats = MarketStatsIndex()
+                stats.apply(added=listings.scan())
+                comparables = ComparablesIndex.from_listings(listings)
+                fresh = [self.first_seen(car) for car in listings.scan()]
+                scraped = sum(1 for fingerprint, new in zip(listings.values('fingerprint'), fresh)
+                              if new and fingerprint is not None)
+                scrape_metrics.record(listings_new=scraped, listings_repeated=len(fresh) - sum(fresh))
+                sketches = current.sketches.evolve(car for car, new in zip(listings.scan(), fresh) if new)
+                trends = current.trends.evolve(car for car, new in zip(listings.scan(), fresh) if new)
+            else:
+                if spliced is not None:
+                    added, removed = spliced
+                else:
+                    old = current.listings or ()
+                    new = listings or ()
+                    old_ids = {id(car) for car in old}
+                    new_ids = {id(car) for car in new}
+                    added = [car for car in new if id(car) not in old_ids]
+                    removed = [car for car in old if id(car) not in new_ids]
+                stats = current.stats.evolve(added=added, removed=removed)
+                comparables = current.comparables.evolve(added=added, removed=removed)
+                # Sketches and trends keep the listing history, so expired listings stay counted; a listing
+                # re-scraped in a later refresh is a new object but must not be counted twice
+                fresh = [car for car in added if self.first_seen(car)]
+                scraped = sum(1 for car in fresh if car.get('fingerprint') is not None)
+                scrape_metrics.record(listings_new=scraped, listings_repeated=len(added) - len(fresh))
+                sketches = current.sketches.evolve(fresh)
+                trends = current.trends.evolve(fresh)
+            snapshot = MarketSnapshot(current.version + 1, listings, stats, updated_at, source, comparables,
+                                      sketches=sketches, trends=trends, segment_updates=segment_updates)
+            self.snapshot = snapshot  # Single reference assignment: readers see the old or new snapshot, never a mix
+        
+        # Persist refreshed data outside the publish lock; readers never wait on disk
+        if self.store is not None and source is not None and self.ingestion_mode != 'worker':
+            try:
+                self.store.save(snapshot, snapshot.sketches, snapshot.trends)
+            except Exception as e:
+                logger.warning(f"Failed to persist market snapshot: {e}")
+        if self.refitter is not None:
+            self.refitter.request()
+        if self.indexer is not None:
+            self.indexer.request()
+        return snapshot
+    
+    def first_seen(self, car):
+        """True unless the listing's fingerprint was seen in an earlier snapshot"""
+        fingerprint = car.get('fingerprint')
+        return fingerprint is None or self.seen.add(fingerprint)
+    
+    def start_background_refits(self):
+        """Refit the price model off the request path whenever a new snapshot is published"""
+        if self.refitter is None:
+            self.refitter = ModelRefitter(self).start()
+            if self.price_model is None or self.price_model.version != self.snapshot.version:
+                self.refitter.request()
+        return self.refitter
+    
+    def start_index_builds(self):
+        """Build each published snapshot's /api/listings index in the background instead of on the first query"""
+        if self.indexer is None:
+            self.indexer = ListingIndexBuilder(self).start()
+            self.indexer.request()
+        return self.indexer
     
-    def get_market_data(self, user_car=None, force_refresh=False):
+    def start_prewarming(self):
+        """Refresh the most-queried segments ahead of the snapshot's expiry"""
+        if self.prewarmer is None:
+            self.prewarmer = PrewarmScheduler(self).start()
+        return self.prewarmer
+    
+    def get_market_data(self, user_car=None, force_refresh=False, deadline=None):
         """Get market data, refresh if needed"""
-        if (self.market_data is None or force_refresh or 
-            (self.last_update and (datetime.now() - self.last_update).total_seconds() > 1800)):  # 30 minutes
+        listings = self.load_market_data(user_car, force_refresh, deadline)[0].listings
+        return list(listings) if listings is not None else None
+    
+    def load_market_data(self, user_car=None, force_refresh=False, deadline=None, report=None):
+        """Get the market snapshot plus the path it came from: (snapshot, path, degradation_reason)
+
+        A live scrape fills in report, a CrawlReport, when one is passed.
+        """
+        if self.ingestion_mode == 'worker':
+            return self.load_ingested_data(user_car, force_refresh)
+        snapshot = self.snapshot
+        segment = MarketSnapshot.segment_key(user_car.get('make'), user_car.get('model')) if user_car else None
+        if force_refresh or snapshot.is_stale(segment=segment):  # 30 minutes
             
             logger.info("Fetching market data...")
             
+            # Fail fast while 28car is known to be down instead of waiting on timeouts
+            if upstream_breaker.is_open():
+                return self.use_cached_or_mock_data(user_car, 'circuit_open', snapshot)
+            
+            # Not enough budget left to scrape without overrunning the client's deadline
+            if user_car and deadline is not None and deadline.remaining() < MIN_SCRAPE_BUDGET_SECONDS:
+                return self.use_cached_or_mock_data(user_car, 'deadline', snapshot)
+            
             # Try scraping first (this allows network errors to propagate for tests)
             try:
                 if user_car:
-                    scraped_data = self.scraper.search_cars_by_query(
-                        make=user_car.get('make'),
-                        model=user_car.get('model'), 
-                        year=user_car.get('year'),
-                        max_pages=1
-                    )
+                    report = report if report is not None else CrawlReport()
+                    try:
+                        # Pages are fetched until there are enough comparables, within the page budget
+                        scraped_data = self.scraper.search_cars_by_query(
+                            make=user_car.get('make'),
+                            model=user_car.get('model'), 
+                            year=user_car.get('year'),
+                            max_pages=SCRAPE_MAX_PAGES,
+                            deadline=deadline,
+                            target_comparables=SCRAPE_TARGET_COMPARABLES,
+                            report=report
+                        )
+                    finally:
+                        crawl_budget.charge(report.pages_fetched)
                     if scraped_data:
                         logger.info(f"Successfully scraped {len(scraped_data)} cars")
                         # Supplement with mock data for better analysis
                         mock_data = self.scraper.generate_enhanced_mock_data(user_car)
-                        self.market_data = scraped_data + mock_data
-                        self.last_update = datetime.now()
-                        return self.market_data
-            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                        return self.publish(scraped_data + mock_data, datetime.now(), 'live'), 'live', None
+            except CircuitOpenError:
+                return self.use_cached_or_mock_data(user_car, 'circuit_open', snapshot)
+            except requests.exceptions.Timeout:
+                # A timeout caused by our own shortened budget degrades instead of failing the request
+                if deadline is not None and deadline.expired():
+                    return self.use_cached_or_mock_data(user_car, 'deadline', snapshot)
+                # Re-raise network errors for proper test handling
+                raise
+            except requests.exceptions.ConnectionError:
                 # Re-raise network errors for proper test handling
                 raise
             except Exception as e:
@@ -758,23 +4471,77 @@ class CarAnalyzer:
             
             # Fall back to enhanced mock data
             logger.info("Using enhanced mock data based on Hong Kong market research")
-            self.market_data = self.scraper.generate_enhanced_mock_data(user_car)
-            self.last_update = datetime.now()
+            mock_data = self.scraper.generate_enhanced_mock_data(user_car)
+            return self.publish(mock_data, datetime.now(), 'mock_data'), 'mock_data', None
+        
+        return snapshot, 'cache', None
+    
+    def load_ingested_data(self, user_car=None, force_refresh=False):
+        """Market data written by the ingestion worker; never touches the network"""
+        if force_refresh and self.watcher is not None:
+            self.watcher.poll()
+        snapshot = self.snapshot
+        if not snapshot.listings:
+            # Nothing ingested yet: mock data, regenerated on the usual cache TTL. It is kept beside the current
+            # snapshot rather than published, so versions only advance when the worker writes a new one
+            mock = self.mock_snapshot
+            if mock is None or mock.is_stale():
+                mock_data = self.scraper.generate_enhanced_mock_data(user_car)
+                mock = MarketSnapshot(snapshot.version, mock_data, MarketStatsIndex().evolve(added=mock_data),
+                                      datetime.now(), 'mock_data', ComparablesIndex().evolve(added=mock_data))
+                self.mock_snapshot = mock
+            return mock, 'mock_data', 'ingestion_pending'
+        self.mock_snapshot = None
+        if snapshot.is_stale(INGEST_STALE_SECONDS):
+            return snapshot, 'stale_cache', 'ingestion_lag'
+        return snapshot, 'cache', None
+    
+    def use_cached_or_mock_data(self, user_car=None, reason='circuit_open', snapshot=None):
+        """Serve market data without touching 28car: stale cache if we have one, otherwise mock data"""
+        snapshot = snapshot if snapshot is not None else self.snapshot
+        if snapshot.listings:
+            logger.warning(f"Serving cached market data without scraping ({reason})")
+            return snapshot, 'stale_cache', reason
         
-        return self.market_data
+        logger.warning(f"Using enhanced mock data without scraping ({reason})")
+        mock_data = self.scraper.generate_enhanced_mock_data(user_car)
+        return self.publish(mock_data, datetime.now(), 'mock_data'), 'mock_data', reason
     
-    def find_similar_cars(self, user_car, market_data):
+    def find_similar_cars(self, user_car, market_data, postings=None):
         """Find similar cars in the market with flexible matching"""
+        # Posting lists narrow each pass to listings that can reach its threshold
+        if postings is None and market_data is self.snapshot.listings:
+            postings = self.snapshot.postings
+        
+        # Makes and models compare as canonical ids: postings store them per listing, otherwise they're memoized
+        def scan():
+            make_id, model_id = canonical.make_id, canonical.model_id
+            for car in market_data:
+                make = make_id(car.get('make'))
+                # Model ids only matter once the make matches
+                yield car, make, model_id(car.get('make'), car.get('model')) if make == user_make else None
+        
+        def candidates(tier):
+            if postings is None:
+                return scan()
+            positions = postings.candidates(user_car, tier)
+            if positions is None:
+                return zip(scan_listings(market_data), postings.make_ids.tolist(), postings.model_ids.tolist())
+            return zip([market_data[position] for position in positions.tolist()],
+                       postings.make_ids[positions].tolist(), postings.model_ids[positions].tolist())
+        
+        user_make = canonical.make_id(user_car['make'])
+        user_model = canonical.model_id(user_car['make'], user_car['model'])
         similar_cars = []
         
         # First pass - strict matching
-        for car in market_data:
+        for car, make_id, model_id in candidates(1):
             similarity_score = 0
             
             # Make and model match (high weight)
-            if car['make'].lower() == user_car['make'].lower():
+            if make_id == user_make:
                 similarity_score += 40
-                if car['model'].lower() == user_car['model'].lower():
+                if model_id == user_model:
                     similarity_score += 30
             
             # Year similarity (medium weight)
@@ -800,17 +4567,16 @@ class CarAnalyzer:
             
             # If similarity is high enough, include the car
             if similarity_score >= 60:
-                car['similarity_score'] = similarity_score
-                similar_cars.append(car)
+                similar_cars.append((similarity_score, car))
         
         # If not enough similar cars found, lower the threshold
         if len(similar_cars) < 10:
             similar_cars = []
-            for car in market_data:
+            for car, make_id, model_id in candidates(2):
                 similarity_score = 0
                 
                 # Make match only (more lenient)
-                if car['make'].lower() == user_car['make'].lower():
+                if make_id == user_make:
                     similarity_score += 50
                 
                 # Year similarity (more lenient)
@@ -837,19 +4603,19 @@ class CarAnalyzer:
                 
                 # Lower threshold for second pass
                 if similarity_score >= 40:
-                    car['similarity_score'] = similarity_score
-                    similar_cars.append(car)
+                    similar_cars.append((similarity_score, car))
         
         # If still not enough, use very lenient matching
         if len(similar_cars) < 5:
             similar_cars = []
-            for car in market_data:
+            luxury_brands = ["BMW", "Mercedes-Benz", "Audi", "Lexus", "Porsche", "Tesla", "Jaguar", "Land Rover"]
+            luxury_ids = {canonical.make_id(make) for make in luxury_brands}
+            user_is_luxury = user_make in luxury_ids
+            for car, make_id, model_id in candidates(3):
                 similarity_score = 0
                 
                 # Any luxury vs non-luxury brand match
-                luxury_brands = ["BMW", "Mercedes-Benz", "Audi", "Lexus", "Porsche", "Tesla", "Jaguar", "Land Rover"]
-                user_is_luxury = user_car['make'] in luxury_brands
-                car_is_luxury = car['make'] in luxury_brands
+                car_is_luxury = make_id in luxury_ids
                 
                 if user_is_luxury == car_is_luxury:
                     similarity_score += 30
@@ -865,14 +4631,14 @@ class CarAnalyzer:
                 
                 # Very low threshold for third pass
                 if similarity_score >= 20:
-                    car['similarity_score'] = similarity_score
-                    similar_cars.append(car)
+                    similar_cars.append((similarity_score, car))
         
         # Sort by similarity score
-        similar_cars.sort(key=lambda x: x['similarity_score'], reverse=True)
+        similar_cars.sort(key=lambda x: x[0], reverse=True)
         
-        # Return top 50 similar cars, or all if less than 50
-        return similar_cars[:50]
+        # Return top 50 similar cars, or all if less than 50; scores go on copies so
+        # listings shared through the market snapshot are never written to
+        return [dict(car, similarity_score=score) for score, car in similar_cars[:50]]
     
     def calculate_enhanced_price_rating(self, user_car, base_percent_diff):
         """Calculate price rating considering owners, mileage, and base price difference"""
@@ -941,46 +4707,87 @@ class CarAnalyzer:
         
         return rating
     
-    def analyze_price(self, user_car):
+    def analyze_price(self, user_car, deadline=None):
         """Analyze the price of a user's car against market data"""
+        report = CrawlReport()
         try:
             # Get market data with user car context for better scraping
-            market_data = self.get_market_data(user_car=user_car)
+            snapshot, data_path, degradation_reason = self.load_market_data(user_car=user_car, deadline=deadline,
+                                                                            report=report)
             
             # Ensure we have market data
-            if not market_data:
+            if not snapshot.listings:
                 logger.warning("No market data available, generating fresh mock data")
-                market_data = self.scraper.generate_mock_data()
-                self.market_data = market_data
-                self.last_update = datetime.now()
+                snapshot = self.publish(self.scraper.generate_mock_data(), datetime.now(), 'mock_data')
+                data_path = 'mock_data'
             
-            # Find similar cars
-            similar_cars = self.find_similar_cars(user_car, market_data)
+            # Everything below reads this one snapshot, even if a refresh publishes a newer one meanwhile
+            market_data = snapshot.listings
+            version = snapshot.version
+            price_model = self.price_model
             
-            # If still no similar cars, use fallback analysis
-            if not similar_cars:
-                logger.warning("No similar cars found, using fallback analysis")
-                return self.fallback_analysis(user_car, market_data)
+            # Out of budget: the estimate-based analysis is constant time
+            if deadline is not None and deadline.remaining() < MIN_ANALYSIS_BUDGET_SECONDS:
+                logger.warning("Deadline nearly exhausted, using fallback analysis")
+                return self.with_degradation(self.fallback_analysis(user_car, market_data),
+                                             'fallback_analysis', 'deadline', deadline, version, report)
             
-            # Calculate market statistics
-            prices = [car['price'] for car in similar_cars if car['price'] is not None and not np.isnan(car['price']) and car['price'] > 0]
+            # A well-populated segment is answered from its precomputed aggregates in O(1)
+            segment = snapshot.stats.lookup(user_car['make'], user_car['model'], user_car['year'])
             
-            if not prices:
-                logger.warning("No valid price data found, using fallback analysis")
-                return self.fallback_analysis(user_car, market_data)
+            neighbours = None
+            if segment is None or segment.count < SEGMENT_MIN_LISTINGS:
+                # Sparse segment: the make/model's nearest listings from its k-d tree, located
+                # by the model's estimate rather than the asking price being judged
+                reference_price = price_model.predict(user_car)['price'] if price_model is not None else None
+                neighbours = snapshot.comparables.nearest(user_car, KNN_K, reference_price)
             
-            market_stats = {
-                'average': float(np.mean(prices)),
-                'median': float(np.median(prices)),
-                'min': float(np.min(prices)),
-                'max': float(np.max(prices)),
-                'count': len(prices)
-            }
+            if segment is not None and segment.count >= SEGMENT_MIN_LISTINGS:
+                comparables = segment
+                comparable_source = 'segment_stats'
+            elif neighbours:
+                priced_cars = [car for _, car in neighbours]
+                scraped_count = sum(1 for car in priced_cars if not car.get('is_mock_data', False))
+                comparables = SegmentStats.from_prices([car['price'] for car in priced_cars], scraped_count)
+                comparable_source = 'nearest_neighbours'
+            else:
+                # No make/model partition large enough: score the whole market for similar cars
+                similar_cars = self.find_similar_cars(user_car, market_data, snapshot.postings)
+                
+                # If still no similar cars, use fallback analysis
+                if not similar_cars:
+                    logger.warning("No similar cars found, using fallback analysis")
+                    return self.with_degradation(self.fallback_analysis(user_car, market_data),
+                                                 'fallback_analysis', 'insufficient_data', deadline, version, report)
+                
+                priced_cars = [car for car in similar_cars if valid_price(car) is not None]
+                
+                if not priced_cars:
+                    logger.warning("No valid price data found, using fallback analysis")
+                    return self.with_degradation(self.fallback_analysis(user_car, market_data),
+                                                 'fallback_analysis', 'insufficient_data', deadline, version, report)
+                
+                # Sort the candidate prices once; every statistic and rank query reads from that order
+                scraped_count = sum(1 for car in priced_cars if not car.get('is_mock_data', False))
+                comparables = SegmentStats.from_prices([car['price'] for car in priced_cars], scraped_count)
+                comparable_source = 'similarity_scan'
+            
+            market_stats = comparables.summary()
+            
+            # Market comparison
+            lower_priced, higher_priced = comparables.rank(user_car['price'])
+            percentile_rank = comparables.percentile_rank(user_car['price'])
+            
+            # Data source information
+            scraped_count = comparables.scraped_count
+            mock_count = comparables.count - scraped_count
+            sample_size = comparables.count
             
             # Verify market stats are valid
             if np.isnan(market_stats['average']) or np.isinf(market_stats['average']):
                 logger.warning("Invalid market statistics, using fallback analysis")
-                return self.fallback_analysis(user_car, market_data)
+                return self.with_degradation(self.fallback_analysis(user_car, market_data),
+                                             'fallback_analysis', 'insufficient_data', deadline, version, report)
             
             # Calculate price difference
             price_diff = float(user_car['price'] - market_stats['average'])
@@ -989,24 +4796,17 @@ class CarAnalyzer:
             # Determine price rating considering owners and mileage
             rating = self.calculate_enhanced_price_rating(user_car, percent_diff)
             
-            # Market comparison
-            lower_priced = sum(1 for p in prices if p < user_car['price'])
-            higher_priced = sum(1 for p in prices if p > user_car['price'])
-            similar_priced = len(prices) - lower_priced - higher_priced
+            similar_priced = market_stats['count'] - lower_priced - higher_priced
             
             # Generate recommendations
             recommendations = self.generate_recommendations(user_car, market_stats, rating)
             
-            # Add data source information
-            scraped_count = sum(1 for car in similar_cars if not car.get('is_mock_data', False))
-            mock_count = sum(1 for car in similar_cars if car.get('is_mock_data', False))
-            
             if scraped_count > 0:
                 recommendations.insert(0, f"Analysis based on {scraped_count} real listings from 28car.com and {mock_count} market data points")
             else:
                 recommendations.insert(0, f"Analysis based on {mock_count} Hong Kong market data points with realistic pricing models")
             
-            return {
+            return self.with_degradation({
                 'user_car': user_car,
                 'marketPrice': market_stats,
                 'priceRating': rating,
@@ -1015,20 +4815,19 @@ class CarAnalyzer:
                 'marketComparison': {
                     'lowerPriced': lower_priced,
                     'higherPriced': higher_priced,
-                    'similarPriced': similar_priced
-                },
-                'marketTrends': {
-                    'direction': 'stable' if abs(percent_diff) < 10 else ('increasing' if percent_diff > 0 else 'decreasing'),
-                    'confidence': 0.85,
-                    'volatility': 'low',
-                    'sample_size': len(similar_cars)
+                    'similarPriced': similar_priced,
+                    'percentileRank': percentile_rank
                 },
-                'similar_cars_count': len(similar_cars),
+                'marketTrends': snapshot.trends.trend(user_car),
+                'similar_cars_count': sample_size,
                 'scraped_cars_count': scraped_count,
                 'mock_cars_count': mock_count,
+                'comparableSource': comparable_source,
+                'priceDistribution': snapshot.sketches.distribution(user_car),
+                'modelEstimate': price_model.predict(user_car) if price_model is not None else None,
                 'owners': user_car.get('owners', 1),
                 'recommendations': recommendations
-            }
+            }, data_path, degradation_reason, deadline, version, report)
             
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
             logger.error(f"Network error analyzing price: {e}")
@@ -1038,10 +4837,25 @@ class CarAnalyzer:
             logger.error(f"Error analyzing price: {e}")
             # Return fallback analysis instead of raising error for other exceptions
             try:
-                return self.fallback_analysis(user_car, self.market_data or [])
+                snapshot = self.snapshot
+                return self.with_degradation(self.fallback_analysis(user_car, snapshot.listings or ()),
+                                             'fallback_analysis', 'error', deadline, snapshot.version, report)
             except:
                 raise Exception(f"Critical error in price analysis: {e}")
     
+    def with_degradation(self, analysis, path, reason, deadline=None, version=None, report=None):
+        """Record which data path and snapshot version an analysis used, whether it was degraded and what it scraped"""
+        analysis['marketDataVersion'] = version
+        analysis['crawl'] = (report if report is not None else CrawlReport()).to_dict()
+        remaining = deadline.remaining() if deadline is not None else float('inf')
+        analysis['degradation'] = {
+            'path': path,  # live, cache, stale_cache, mock_data or fallback_analysis
+            'degraded': reason is not None,
+            'reason': reason,  # circuit_open, deadline, ingestion_pending, ingestion_lag, insufficient_data, error or None
+            'deadlineRemainingMs': None if remaining == float('inf') else int(remaining * 1000)
+        }
+        return analysis
+    
     def fallback_analysis(self, user_car, market_data):
         """Provide fallback analysis when normal analysis fails"""
         logger.info("Using fallback analysis method")
@@ -1126,6 +4940,7 @@ class CarAnalyzer:
         lower_priced = 3 if rating in ['excellent', 'good'] else 6
         higher_priced = 6 if rating in ['high', 'very_high'] else 3
         similar_priced = 10 - lower_priced - higher_priced
+        percentile_rank = (lower_priced + similar_priced / 2) / 10 * 100
         
         # Generate recommendations
         recommendations = self.generate_recommendations(user_car, market_stats, rating)
@@ -1140,7 +4955,8 @@ class CarAnalyzer:
             'marketComparison': {
                 'lowerPriced': lower_priced,
                 'higherPriced': higher_priced,
-                'similarPriced': similar_priced
+                'similarPriced': similar_priced,
+                'percentileRank': percentile_rank
             },
             'marketTrends': {
                 'direction': 'stable',
@@ -1261,39 +5077,64 @@ class CarAnalyzer:
                 'factors': ['Limited market data available']
             }
         
-        prices = [car['price'] for car in similar_cars if car.get('price')]
-        if len(prices) < 2:
+        today = datetime.now().toordinal()
+        series = TrendSeries(today)
+        for car in similar_cars:
+            price = valid_price(car)
+            if price is not None:
+                series.add(min(listing_day(car, today), today), price, car.get('date_basis') != 'listed')
+        prices = sum(len(prices) for prices in series.days.values())
+        if prices < 2:
             return {
                 'trend': 'insufficient_data',
                 'confidence': 'low',
                 'factors': ['Limited price data available']
             }
         
-        # Simple trend analysis
-        avg_price = np.mean(prices)
-        median_price = np.median(prices)
-        
-        if avg_price > median_price * 1.1:
-            trend = 'rising'
-        elif avg_price < median_price * 0.9:
-            trend = 'falling'
-        else:
-            trend = 'stable'
+        # Fit the price trend over the listing dates of the comparables
+        summary = series.summarize()
+        if summary['slopePctPerMonth'] is None:
+            return {
+                'trend': 'insufficient_data',
+                'confidence': 'low',
+                'factors': [f'Based on {prices} comparable vehicles listed on {summary["days"]} distinct days']
+            }
         
+        trend = {'increasing': 'rising', 'decreasing': 'falling'}.get(summary['direction'], 'stable')
+        confidence = 'high' if summary['confidence'] >= 0.6 else ('medium' if summary['confidence'] >= 0.3 else 'low')
         return {
             'trend': trend,
-            'confidence': 'medium',
-            'factors': [f'Based on {len(prices)} comparable vehicles']
+            'confidence': confidence,
+            'factors': [
+                f'Based on {prices} comparable vehicles',
+                f'{summary["slopePctPerMonth"]:+.1f}% per month over {summary["days"]} listing days'
+            ]
         }
 
-# Initialize analyzer
-analyzer = CarAnalyzer()
+# Initialize analyzer, starting from the last persisted snapshot when there is one
+analyzer = CarAnalyzer(store=SnapshotStore() if MARKET_SNAPSHOT_PERSIST or INGESTION_MODE == 'worker' else None)
+if multiprocessing.parent_process() is not None:
+    pass  # A parser process imports this module only to parse pages; it serves nothing and loads nothing
+elif INGESTION_MODE == 'worker':
+    if LISTING_INDEX_BACKGROUND:
+        analyzer.start_index_builds()
+    analyzer.watch_store()  # ingest_worker.py scrapes and fits the price model; this process only reads
+else:
+    analyzer.warm_start()
+    if LISTING_INDEX_BACKGROUND:
+        analyzer.start_index_builds()
+    if MODEL_BACKGROUND_REFIT:
+        analyzer.start_background_refits()
+    if PREWARM_ENABLED:
+        analyzer.start_prewarming()
 
 def get_car_data(make=None, model=None, year=None):
     """Global function for compatibility with extended tests"""
+    if not analyzer.can_scrape():
+        logger.warning("get_car_data called in worker ingestion mode, not scraping")
+        return []
     try:
-        scraper = CarDataScraper()
-        return scraper.search_cars_by_query(make, model, year, max_pages=1)
+        return analyzer.scraper.search_cars_by_query(make, model, year, max_pages=1)
     except Exception as e:
         logger.error(f"Error in get_car_data: {e}")
         return []
@@ -1356,8 +5197,11 @@ def analyze_car():
             'engine_cc': engine_cc
         }
         
-        # Analyze the car
-        analysis = analyzer.analyze_price(user_car)
+        demand_tracker.record(user_car)
+        
+        # Analyze the car within the client's deadline (header in seconds, else the configured default)
+        deadline = Deadline.from_header(request.headers.get(DEADLINE_HEADER))
+        analysis = analyzer.analyze_price(user_car, deadline=deadline)
         
         return jsonify(analysis)
         
@@ -1377,22 +5221,53 @@ def analyze_car_legacy():
 def get_market_data_endpoint():
     """Get current market data"""
     try:
-        market_data = analyzer.get_market_data()
+        snapshot = analyzer.load_market_data()[0]
         # Return the actual market data as expected by tests
-        return jsonify(market_data if market_data else [])
+        response = jsonify(list(scan_listings(snapshot.listings)) if snapshot.listings else [])
+        response.headers['X-Market-Data-Version'] = str(snapshot.version)
+        return response
     except Exception as e:
         logger.error(f"Error getting market data: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/listings', methods=['GET'])
+def query_listings():
+    """Filtered, sorted page of market listings with a cursor for the next page"""
+    try:
+        filters, sort, limit, cursor = parse_listing_query(request.args)
+        snapshot = analyzer.snapshot  # A read never scrapes or publishes; it pages through whatever is current
+        index = snapshot.index()
+        after = decode_listing_cursor(cursor, snapshot.version, sort) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        positions, more = index.query(filters, sort, limit, after)
+        next_cursor = None
+        if more and positions:
+            last = positions[-1]
+            next_cursor = encode_listing_cursor(snapshot.version, sort, index.sort_key(sort, last), last)
+        response = jsonify({
+            'listings': [snapshot.listings[position] for position in positions],
+            'count': len(positions),
+            'nextCursor': next_cursor,
+            'marketDataVersion': snapshot.version
+        })
+        response.headers['X-Market-Data-Version'] = str(snapshot.version)
+        return response
+    except Exception as e:
+        logger.error(f"Error querying listings: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/refresh-data', methods=['POST'])
 def refresh_market_data():
     """Force refresh of market data"""
     try:
-        market_data = analyzer.get_market_data(force_refresh=True)
+        snapshot = analyzer.load_market_data(force_refresh=True)[0]
         return jsonify({
             'status': 'success',
             'message': 'Market data refreshed',
-            'data_count': len(market_data) if market_data else 0,
+            'data_count': len(snapshot.listings) if snapshot.listings else 0,
+            'marketDataVersion': snapshot.version,
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
@@ -1409,6 +5284,7 @@ def home():
             'analyze_car': '/api/analyze-car',
             'health': '/api/health',
             'market_data': '/api/market-data',
+            'listings': '/api/listings',
             'refresh_data': '/api/refresh-data'
         }
     })
@@ -1416,8 +5292,11 @@ def home():
 @app.route('/api/test-scrape', methods=['GET'])
 def test_scrape():
     """Test scraping endpoint to debug what we're getting from 28car.com"""
+    if not analyzer.can_scrape():
+        # Only ingest_worker.py talks to 28car; this process must stay off the network
+        return jsonify({'status': 'error', 'error': 'Scraping is disabled in worker ingestion mode'}), 409
     try:
-        url = "https://dj1jklak2e.28car.com/m_sell_lst.php"
+        url = f"{BASE_URL}/m_sell_lst.php"
         params = {
             'h_sort': '7',
             'h_page': 1,
@@ -1425,16 +5304,8 @@ def test_scrape():
             'h_f_mk': '36'
         }
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-        }
-        
-        response = requests.get(url, params=params, headers=headers, timeout=30)
-        response.encoding = 'big5'
+        response = get_http_session().get(url, params=params, timeout=30)
+        response.encoding = SCRAPE_PAGE_ENCODING
         
         # Get some sample content
         sample_text = response.text[:3000]  # First 3000 characters
@@ -1471,9 +5342,10 @@ def test_scrape():
 # Global functions for backward compatibility
 def get_car_data(*args, **kwargs):
     """Global function for backward compatibility with older tests"""
+    if not analyzer.can_scrape():
+        return {'error': 'Scraping is disabled in worker ingestion mode'}
     try:
-        scraper = CarDataScraper()
-        return scraper.search_cars_by_query(*args, **kwargs)
+        return analyzer.scraper.search_cars_by_query(*args, **kwargs)
     except Exception as e:
         return {'error': str(e)}
 
@@ -1483,16 +5355,24 @@ def analyze_market_trends(make=None, model=None, year=None, data=None):
         if not data and not make:
             return {'trends': [], 'summary': 'No data provided'}
         
+        if data:
+            trends = PriceTrends()
+            trends.ingest(data)
+            trend = trends.trend({'make': make or data[0].get('make'), 'model': model, 'year': year})
+        else:
+            trend = analyzer.trends.trend({'make': make, 'model': model, 'year': year})
+        
         return {
-            'trends': ['stable', 'increasing', 'competitive'],
+            'trends': [trend['direction']],
             'summary': f'Market analysis completed for {make} {model} {year}' if make else 'Market analysis completed',
-            'confidence': 0.85
+            'confidence': trend['confidence'],
+            'trend': trend
         }
     except Exception as e:
         return {'error': str(e)}
 
 def predict_price(make, model, year, mileage, car_data=None):
-    """Global function for backward compatibility with older tests"""
+    """Predict a listing price from the fitted market model, or a rough formula before one exists"""
     try:
         # Use provided parameters to create car_data if not provided
         if not car_data:
@@ -1503,6 +5383,24 @@ def predict_price(make, model, year, mileage, car_data=None):
                 'mileage': mileage
             }
         
+        price_model = analyzer.price_model
+        if price_model is not None:
+            estimate = price_model.predict(car_data)
+            # Contribution of age and mileage relative to a typical car in the training data
+            typical = dict(car_data, year=price_model.reference_year - price_model.defaults['age'],
+                           mileage=price_model.defaults['mileage'])
+            typical_price = math.exp(price_model.log_price(typical))
+            return {
+                'predicted_price': estimate['price'],
+                'confidence': round(max(0.0, min(1.0, price_model.r_squared)), 2),
+                'interval': {'low': estimate['low'], 'high': estimate['high'], 'level': estimate['interval']},
+                'factors': {
+                    'year_adjustment': round(math.exp(price_model.log_price(dict(typical, year=car_data.get('year')))) - typical_price),
+                    'mileage_adjustment': round(math.exp(price_model.log_price(dict(typical, mileage=car_data.get('mileage')))) - typical_price)
+                },
+                'model': 'hedonic'
+            }
+        
         # Simple price prediction based on year and mileage
         base_price = 20000
         year_factor = (year - 2000) * 1000 if year else 0
@@ -1516,7 +5414,8 @@ def predict_price(make, model, year, mileage, car_data=None):
             'factors': {
                 'year_adjustment': year_factor,
                 'mileage_adjustment': mileage_factor
-            }
+            },
+            'model': 'heuristic'
         }
     except Exception as e:
         return {'error': str(e)}
@@ -1524,11 +5423,22 @@ def predict_price(make, model, year, mileage, car_data=None):
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    snapshot = analyzer.snapshot
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'market_data_count': len(analyzer.market_data) if analyzer.market_data else 0
+        'market_data_count': len(snapshot.listings) if snapshot.listings else 0,
+        'market_data_version': snapshot.version,
+        'upstream': upstream_breaker.stats(),
+        'scrape': scrape_metrics.stats(),
+        'demand': demand_tracker.stats(),
+        'crawl_budget': crawl_budget.stats(),
+        'enrichment': enrichment_metrics.stats() if DETAIL_ENRICHMENT else None,
+        'prewarm': analyzer.prewarmer.stats() if analyzer.prewarmer is not None else None
     })
 
 if __name__ == '__main__':
+    # Warm the shared connection pool in the background so startup isn't blocked; worker mode never connects
+    if analyzer.can_scrape():
+        threading.Thread(target=prewarm_http_session, name='http-prewarm', daemon=True).start()
     app.run(debug=True, host='0.0.0.0', port=5001)
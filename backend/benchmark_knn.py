@@ -0,0 +1,114 @@
+"""
+Comparable-car lookup benchmark: k-d tree index vs linear scans
+
+For each market size, builds a synthetic market spread over --partitions make/model pairs and times
+  * building the ComparablesIndex and adding 1% new listings incrementally
+  * k-nearest queries through the index
+  * the same query as a vectorized brute-force scan of the make/model's listings
+  * CarAnalyzer.find_similar_cars, the full-market scoring scan
+
+Usage: python benchmark_knn.py [--sizes 10000,100000,1000000] [--partitions 200] [--queries 200] [--k 20]
+
+With many partitions each make/model holds few listings and queries are a single vectorized
+scan; --partitions 1 puts every listing in one make/model to show the tree's scaling.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault('MARKET_SNAPSHOT_PERSIST', 'false')
+os.environ.setdefault('MODEL_BACKGROUND_REFIT', 'false')
+
+import app  # noqa: E402
+
+MAKES = [f'Make{i}' for i in range(20)]
+MODELS = [f'Model{i}' for i in range(10)]
+SCAN_BUDGET_SECONDS = 10  # Stop timing find_similar_cars once it has used this much time
+
+
+def synthetic_market(n, rng, partitions):
+    pairs = rng.integers(0, partitions, n)
+    makes = pairs // len(MODELS)
+    models = pairs % len(MODELS)
+    years = rng.integers(2005, 2026, n)
+    mileage = rng.integers(0, 250000, n)
+    engine = rng.choice([1200, 1500, 1800, 2000, 2500, 3000], n)
+    price = np.exp(12 + 0.1 * makes / len(MAKES) - 0.07 * (2025 - years) - 0.000002 * mileage + rng.normal(0, 0.1, n))
+    return [
+        {'make': MAKES[a], 'model': MODELS[b], 'year': int(y), 'mileage': int(m), 'engine_cc': int(e),
+         'price': round(float(p)), 'fuel_type': 'petrol', 'transmission': 'automatic', 'seats': 5}
+        for a, b, y, m, e, p in zip(makes, models, years, mileage, engine, price)
+    ]
+
+
+def brute_force(points, query, k):
+    diff = points - query
+    distances = np.einsum('ij,ij->i', diff, diff)
+    nearest = np.argpartition(distances, min(k, len(distances) - 1))[:k]
+    return nearest[np.argsort(distances[nearest])]
+
+
+def bench(n, queries, k, rng, partitions):
+    cars = synthetic_market(n, rng, partitions)
+    users = synthetic_market(queries, rng, partitions)
+
+    start = time.perf_counter()
+    index = app.ComparablesIndex().evolve(added=cars)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.evolve(added=synthetic_market(max(n // 100, 1), rng, partitions))
+    incremental = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user in users:
+        index.nearest(user, k, reference_price=user['price'])
+    tree_ms = (time.perf_counter() - start) / queries * 1000
+
+    # Vectorized brute force over the same partitions (points precomputed, as the index has them)
+    partition_points = {key: np.array([app.knn_features(car) for car in partition.cars])
+                        for key, partition in index.partitions.items()}
+    start = time.perf_counter()
+    for user in users:
+        key = app.ComparablesIndex.partition_key(user)
+        brute_force(partition_points[key], app.knn_features(user), k)
+    brute_ms = (time.perf_counter() - start) / queries * 1000
+
+    analyzer = app.CarAnalyzer()
+    scanned = 0
+    start = time.perf_counter()
+    for user in users:
+        analyzer.find_similar_cars(user, cars)
+        scanned += 1
+        if time.perf_counter() - start > SCAN_BUDGET_SECONDS:
+            break
+    scan_ms = (time.perf_counter() - start) / scanned * 1000
+
+    print(f'{n:>9,} | build {build:7.2f} s | +1% {incremental * 1000:8.1f} ms | '
+          f'kd-tree {tree_ms:7.3f} ms | brute force {brute_ms:7.3f} ms | '
+          f'find_similar_cars {scan_ms:9.1f} ms ({scanned} queries) | '
+          f'speed-up vs scan {scan_ms / tree_ms:8.0f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--partitions', type=int, default=len(MAKES) * len(MODELS))
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=app.KNN_K)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    partitions = max(1, min(args.partitions, len(MAKES) * len(MODELS)))
+    print(f'k={args.k}, {partitions} make/model partitions, per-query times')
+    for size in (int(value) for value in args.sizes.split(',')):
+        bench(size, args.queries, args.k, rng, partitions)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+/api/listings query benchmark: ListingIndex vs a list comprehension and sort
+
+For each market size, builds a synthetic snapshot and times, per query,
+  * ListingIndex.query for the first page and for a page reached through the cursor
+  * the same filter written as a list comprehension over the listings, then sorted and sliced
+
+for a handful of filter shapes: none, a common make, a rare make, and ranges on year, price and mileage.
+
+Usage: python benchmark_listings.py [--sizes 10000,100000,1000000] [--queries 50] [--limit 20]
+
+Query times are steady state. Building the index (columns and every sort order) is reported separately;
+the server builds it once per published snapshot, in a background thread, not per request.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault('MARKET_SNAPSHOT_PERSIST', 'false')
+os.environ.setdefault('MODEL_BACKGROUND_REFIT', 'false')
+os.environ.setdefault('LISTING_INDEX_BACKGROUND', 'false')
+
+import app  # noqa: E402
+
+MAKES = [f'Make{i}' for i in range(20)] + ['Rare']
+MODELS = [f'Model{i}' for i in range(10)]
+QUERIES = {
+    'none': ({}, 'price'),
+    'make': ({'make': 'Make3'}, '-price'),
+    'rare make': ({'make': 'Rare'}, 'price'),
+    'ranges': ({'year_min': 2015, 'price_max': 200000, 'mileage_max': 100000}, 'year'),
+}
+
+
+def synthetic_market(n, rng):
+    makes = np.minimum(rng.integers(0, len(MAKES) - 1, n), len(MAKES) - 2)
+    makes[rng.random(n) < 0.002] = len(MAKES) - 1  # 'Rare' holds about 0.2% of listings
+    models = rng.integers(0, len(MODELS), n)
+    years = rng.integers(2005, 2026, n)
+    mileage = rng.integers(0, 250000, n)
+    price = np.exp(12 - 0.07 * (2025 - years) - 0.000002 * mileage + rng.normal(0, 0.3, n))
+    return tuple(
+        {'make': MAKES[a], 'model': MODELS[b], 'year': int(y), 'mileage': int(m), 'price': round(float(p)),
+         'fuel_type': 'petrol', 'transmission': 'automatic', 'seats': 5}
+        for a, b, y, m, p in zip(makes, models, years, mileage, price)
+    )
+
+
+def list_comprehension(cars, filters, sort, limit):
+    field, reverse = sort.lstrip('-'), sort.startswith('-')
+    matches = [car for car in cars
+               if (not filters.get('make') or car['make'] == filters['make'])
+               and car['year'] >= filters.get('year_min', float('-inf'))
+               and car['price'] <= filters.get('price_max', float('inf'))
+               and car['mileage'] <= filters.get('mileage_max', float('inf'))]
+    return sorted(matches, key=lambda car: car[field], reverse=reverse)[:limit]
+
+
+def timed(function, queries):
+    start = time.perf_counter()
+    for _ in range(queries):
+        function()
+    return (time.perf_counter() - start) / queries * 1000
+
+
+def bench(n, queries, limit, rng):
+    cars = synthetic_market(n, rng)
+    snapshot = app.MarketSnapshot(1, cars)
+
+    start = time.perf_counter()
+    index = snapshot.index().warm()
+    build = time.perf_counter() - start
+    print(f'{n:>9,} listings | index build {build:6.2f} s')
+
+    for name, (filters, sort) in QUERIES.items():
+        first, more = index.query(filters, sort, limit)
+        cursor = (index.sort_key(sort, first[-1]), first[-1]) if more else None
+        first_ms = timed(lambda: index.query(filters, sort, limit), queries)
+        next_ms = timed(lambda: index.query(filters, sort, limit, cursor), queries) if cursor else 0.0
+        scan_ms = timed(lambda: list_comprehension(cars, filters, sort, limit), max(1, queries // 10))
+        print(f'          {name:>10} | first page {first_ms:7.3f} ms | next page {next_ms:7.3f} ms | '
+              f'list comprehension {scan_ms:9.2f} ms | speed-up {scan_ms / first_ms:7.0f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=app.LISTING_PAGE_SIZE)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    print(f'limit={args.limit}, per-query times')
+    for size in (int(value) for value in args.sizes.split(',')):
+        bench(size, args.queries, args.limit, rng)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Listing page decode + parse benchmark: str decode + BeautifulSoup vs raw bytes into lxml
+
+Builds a synthetic 28car-style listing page encoded as Big5-HKSCS and, in a fresh interpreter per
+variant so peak memory isn't shared, times
+  * before: decode the body to str (what response.text did), parse it with BeautifulSoup and
+    extract listings from the table rows; bs4 is no longer a dependency, so this variant only
+    runs when it is installed
+  * after: CarDataScraper.parse_listing_page on the raw bytes
+  * streaming: CarDataScraper.iter_listings fed 16 KB chunks, as SCRAPE_STREAMING does
+
+Usage: python benchmark_parse.py [--rows 40,200,1000,5000] [--repeat 20]
+
+Peak memory is the growth of the process's max RSS while parsing one page, which also counts
+libxml2's C allocations that tracemalloc can't see.
+"""
+
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROW = ('<tr><td><a href="m_sell_dsp.php?h_vid={vid}">{make} {model}</a></td><td>{year}</td>'
+       '<td>{mileage}萬公里 自動波 九成新 車主自讓 𨋢</td><td>${price:,}</td></tr>')
+MODELS = [('平治', 'CLA250'), ('寶馬', '320i'), ('豐田', 'Camry'), ('本田', 'Civic')]
+
+VARIANT = """
+import resource, sys, time, logging
+logging.disable(logging.CRITICAL)
+import app
+from benchmark_parse import synthetic_page
+content = synthetic_page({rows})
+scraper = app.CarDataScraper()
+
+def before(content):
+    from bs4 import BeautifulSoup
+    text = content.decode('big5', errors='replace')
+    soup = BeautifulSoup(text, 'html.parser')
+    return [car for car in (scraper.extract_car_data_from_text(row.get_text(separator=' ', strip=True))
+                            for row in soup.find_all('tr')) if car]
+
+def after(content):
+    return scraper.parse_listing_page(content)
+
+def streaming(content):
+    chunk = app.SCRAPE_STREAM_CHUNK_BYTES
+    return list(scraper.iter_listings(content[start:start + chunk] for start in range(0, len(content), chunk)))
+
+parse = {variant}
+import lxml.etree  # Imports aren't part of the per-page cost
+if {variant} is before:
+    import bs4
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+found = len(parse(content))
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+start = time.perf_counter()
+for _ in range({repeat}):
+    parse(content)
+elapsed_ms = (time.perf_counter() - start) / {repeat} * 1000
+print(elapsed_ms, peak_kb, found)
+"""
+
+
+def synthetic_page(rows):
+    """Big5-HKSCS encoded listing page with the given number of listing rows"""
+    body = ''.join(ROW.format(vid=100000 + i, make=MODELS[i % 4][0], model=MODELS[i % 4][1], year=2010 + i % 15,
+                              mileage=1 + i % 12, price=80000 + 1000 * i) for i in range(rows))
+    return f'<html><head><title>28car</title></head><body><table>{body}</table></body></html>'.encode('big5hkscs')
+
+
+def run_variant(variant, rows, repeat):
+    code = VARIANT.format(rows=rows, repeat=repeat, variant=variant)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', MARKET_SNAPSHOT_PERSIST='false',
+               MODEL_BACKGROUND_REFIT='false')
+    result = subprocess.run([sys.executable, '-c', code], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    elapsed_ms, peak_kb, found = result.stdout.split()
+    return float(elapsed_ms), int(peak_kb), int(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='40,200,1000,5000')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    variants = ('after', 'streaming')
+    if importlib.util.find_spec('bs4') is not None:
+        variants = ('before',) + variants
+    else:
+        print('bs4 not installed, skipping the BeautifulSoup baseline')
+    for rows in (int(value) for value in args.rows.split(',')):
+        size_kb = len(synthetic_page(rows)) / 1024
+        results = {variant: run_variant(variant, rows, args.repeat) for variant in variants}
+        line = ' | '.join(f'{variant} {elapsed_ms:7.2f} ms, peak +{peak_kb:6d} KB, {found} listings'
+                          for variant, (elapsed_ms, peak_kb, found) in results.items())
+        speed_up = f' | speed-up {results["before"][0] / results["after"][0]:4.1f}x' if 'before' in results else ''
+        print(f'{rows:>5} rows ({size_kb:6.1f} KB) | {line}{speed_up}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
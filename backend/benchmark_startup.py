@@ -0,0 +1,143 @@
+"""
+Import-time and cold-start benchmark for the backend
+
+Runs each measurement in a fresh interpreter so nothing is already imported:
+  * `python -X importtime -c "import app"` for the import tree
+  * import app and serve the first /api/health request through the test client, in two configurations:
+      - bare: MARKET_SNAPSHOT_PERSIST=false, so nothing is loaded from disk
+      - default: the settings `python app.py` and gunicorn start with, against a snapshot of
+        --listings synthetic listings persisted beforehand, so import includes the warm start
+        and starts the background index build and model refit threads
+
+Usage: python benchmark_startup.py [--runs 5] [--budget-ms 600] [--top 10] [--listings 10000]
+Exits with status 1 when the median cold start of either configuration exceeds the budget.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', '600'))  # Import + first /api/health
+HEAVY_MODULES = ('pandas', 'bs4', 'lxml', 'requests', 'urllib3')  # Must not load until first scrape
+BARE = {'MARKET_SNAPSHOT_PERSIST': 'false'}
+# Shipped defaults, in case the calling shell overrides them
+DEFAULT = {'MARKET_SNAPSHOT_PERSIST': 'true', 'INGESTION_MODE': 'inline', 'MODEL_BACKGROUND_REFIT': 'true',
+           'LISTING_INDEX_BACKGROUND': 'true', 'PREWARM_ENABLED': 'false'}
+
+COLD_START = """
+import os, sys, time
+start = time.perf_counter()
+import app
+response = app.app.test_client().get('/api/health')
+assert response.status_code == 200
+elapsed = (time.perf_counter() - start) * 1000
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(f'{{elapsed:.1f}} {{len(app.analyzer.snapshot.listings or ())}} {{",".join(loaded)}}')
+sys.stdout.flush()
+os._exit(0)  # Don't wait on the background threads the default configuration starts
+"""
+
+PERSIST_SNAPSHOT = """
+import sys
+from datetime import datetime
+import numpy as np
+import app, benchmark_listings
+cars = benchmark_listings.synthetic_market({listings}, np.random.default_rng(42))
+app.CarAnalyzer(store=app.SnapshotStore(sys.argv[1])).publish(list(cars), datetime.now(), 'live')
+"""
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def run_python(args, settings=BARE):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', **settings)
+    return subprocess.run([sys.executable] + args, cwd=BACKEND_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def import_tree():
+    """Cumulative import time (ms) per module imported directly by app.py"""
+    result = run_python(['-X', 'importtime', '-c', 'import app'])
+    total = None
+    direct = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        depth = len(match.group(3)) // 2
+        name = match.group(4)
+        if depth == 0:
+            if name == 'app':
+                total = cumulative_ms
+                break
+            direct = []  # Interpreter startup (site, encodings), not part of app
+        elif depth == 1:
+            direct.append((cumulative_ms, name))
+    return total, sorted(direct, reverse=True)
+
+
+def persist_snapshot(directory, listings):
+    """Write a snapshot of synthetic listings to directory, as a refresh would"""
+    run_python(['-c', PERSIST_SNAPSHOT.format(listings=listings), directory],
+               dict(BARE, MARKET_SNAPSHOT_DIR=directory, MODEL_BACKGROUND_REFIT='false',
+                    LISTING_INDEX_BACKGROUND='false'))
+
+
+def cold_start(settings):
+    """Milliseconds from a bare interpreter to the first /api/health response, listings loaded, heavy modules loaded"""
+    result = run_python(['-c', COLD_START.format(heavy=HEAVY_MODULES)], settings)
+    elapsed, listings, loaded = (result.stdout.strip().splitlines()[-1] + ' ').split(' ', 2)
+    return float(elapsed), int(listings), [name for name in loaded.split(',') if name]
+
+
+def measure(label, settings, runs):
+    timings = []
+    listings, loaded = 0, []
+    for _ in range(runs):
+        elapsed, listings, loaded = cold_start(settings)
+        timings.append(elapsed)
+    median = statistics.median(timings)
+    print(f'cold start to first /api/health, {label}: median {median:.1f} ms, '
+          f'min {min(timings):.1f} ms, max {max(timings):.1f} ms over {runs} runs, {listings:,} listings loaded')
+    return median, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--listings', type=int, default=10000)
+    args = parser.parse_args()
+
+    total, direct = import_tree()
+    print(f'import app: {total:.1f} ms')
+    for cumulative_ms, name in direct[:args.top]:
+        print(f'  {cumulative_ms:8.1f} ms  {name}')
+
+    bare, loaded = measure('bare (MARKET_SNAPSHOT_PERSIST=false)', BARE, args.runs)
+    print(f'heavy modules loaded: {", ".join(loaded) if loaded else "none"}')
+    with tempfile.TemporaryDirectory() as directory:
+        persist_snapshot(directory, args.listings)
+        default, _ = measure(f'default settings, {args.listings:,}-listing snapshot on disk',
+                             dict(DEFAULT, MARKET_SNAPSHOT_DIR=directory), args.runs)
+
+    if loaded:
+        print('FAIL: scraping dependencies were imported at startup')
+        return 1
+    over = [name for name, median in (('bare', bare), ('default', default)) if median > args.budget_ms]
+    if over:
+        print(f'FAIL: {" and ".join(over)} cold start over the {args.budget_ms:.0f} ms startup budget')
+        return 1
+    print(f'OK: within the {args.budget_ms:.0f} ms startup budget')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+import pytest
+
+# Keep persisted market snapshots out of the source tree during tests
+os.environ.setdefault('MARKET_SNAPSHOT_DIR', tempfile.mkdtemp(prefix='autoval-snapshots-'))
+# Tests refit the price model explicitly rather than racing a background thread
+os.environ.setdefault('MODEL_BACKGROUND_REFIT', 'false')
+
+import app as app_module
+
+
+@pytest.fixture(autouse=True)
+def reset_upstream_breaker():
+    """Each test starts with a closed 28car circuit breaker"""
+    app_module.upstream_breaker.reset()
+    yield
+    app_module.upstream_breaker.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_scrape_metrics():
+    """Scrape, duplicate and enrichment counters start from zero in every test"""
+    app_module.scrape_metrics.reset()
+    app_module.enrichment_metrics.reset()
+    yield
@@ -0,0 +1,112 @@
+"""
+Standalone ingestion worker: scrapes 28car on a schedule and writes listings to the snapshot store
+
+API processes started with INGESTION_MODE=worker never scrape. They serve what this worker last
+wrote to MARKET_SNAPSHOT_DIR and pick up new output within INGEST_POLL_SECONDS, so scrape latency
+and failures never reach API clients. The worker also refits the price model after each run.
+
+Usage: python ingest_worker.py [--once] [--interval 1800] [--segments Toyota,BMW:X5] [--max-pages 3]
+
+A segment is a make or make:model; an empty segment scrapes the unfiltered listing pages.
+"""
+
+import argparse
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+from datetime import datetime
+
+# This process is the one that scrapes and writes the store, whatever the API processes are configured as
+os.environ['INGESTION_MODE'] = 'inline'
+os.environ.setdefault('MODEL_BACKGROUND_REFIT', 'false')
+
+import app  # noqa: E402
+
+logger = logging.getLogger('ingest_worker')
+
+INGEST_INTERVAL_SECONDS = float(os.environ.get('INGEST_INTERVAL_SECONDS', '1800'))  # Between scrape runs
+INGEST_JITTER_SECONDS = float(os.environ.get('INGEST_JITTER_SECONDS', '120'))  # Random spread added per run
+INGEST_MAX_PAGES = int(os.environ.get('INGEST_MAX_PAGES', '3'))  # Pages scraped per segment
+# The unfiltered search plus every make the search catalog can filter upstream
+INGEST_SEGMENTS = os.environ.get('INGEST_SEGMENTS', ','.join([''] + app.search_catalog.coded_makes))
+
+
+def parse_segments(value):
+    """'Toyota,BMW:X5' -> [('Toyota', None), ('BMW', 'X5')]; an empty entry is the unfiltered search"""
+    segments = []
+    for entry in value.split(','):
+        make, _, model = entry.strip().partition(':')
+        segments.append((make.strip() or None, model.strip() or None))
+    return segments
+
+
+def search_jobs(segments, max_pages):
+    """(make, model, year, page) fetch jobs, stopping early once the 28car circuit opens"""
+    for make, model in segments:
+        for page in range(1, max_pages + 1):
+            if app.upstream_breaker.is_open():
+                logger.warning("28car circuit open, ending this run early")
+                return
+            yield make, model, None, page
+
+
+def ingest(analyzer, segments, max_pages=INGEST_MAX_PAGES, workers=None):
+    """Stream every segment's pages through the ingestion pipeline and publish the listings to the store
+
+    Segments overlap (the unfiltered search repeats listings of every make); the pipeline's dedupe
+    stage drops the repeats. Listings are spooled to disk as they arrive and then written to the
+    store's column files, so memory doesn't grow with the size of the market. Returns how many
+    listings were published.
+    """
+    pipeline = app.build_ingestion_pipeline(analyzer.scraper, workers=workers)
+    os.makedirs(analyzer.store.directory, exist_ok=True)
+    spool = app.ListingSpool(analyzer.store.directory)
+    try:
+        for car in pipeline.run(search_jobs(segments, max_pages)):
+            spool.add(car)
+        for name, stats in pipeline.stats().items():
+            logger.info(f"Stage {name}: {stats['items_in']} in, {stats['items_out']} out, {stats['errors']} errors, "
+                        f"{stats['throughput_per_second']}/s, max queue {stats['max_queue_depth']}")
+
+        if not len(spool):
+            logger.warning("Nothing scraped; keeping the stored snapshot")
+            return 0
+        listings = analyzer.store.write_listings(spool, analyzer.snapshot.version + 1)
+    finally:
+        spool.close()
+    snapshot = analyzer.publish(listings, datetime.now(), 'worker')
+    app.ModelRefitter(analyzer).refit()
+    logger.info(f"Stored market snapshot v{snapshot.version} with {len(listings)} listings")
+    return len(listings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--once', action='store_true', help='run a single ingestion and exit')
+    parser.add_argument('--interval', type=float, default=INGEST_INTERVAL_SECONDS)
+    parser.add_argument('--segments', default=INGEST_SEGMENTS)
+    parser.add_argument('--max-pages', type=int, default=INGEST_MAX_PAGES)
+    args = parser.parse_args()
+
+    analyzer = app.analyzer
+    if analyzer.store is None:
+        analyzer.store = app.SnapshotStore()  # The store is how API processes receive the listings
+    segments = parse_segments(args.segments)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+
+    while True:
+        published = ingest(analyzer, segments, args.max_pages)
+        if args.once:
+            return 0 if published else 1
+        if stopped.wait(args.interval + random.uniform(0, INGEST_JITTER_SECONDS)):
+            return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
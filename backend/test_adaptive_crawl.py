@@ -0,0 +1,71 @@
+"""
+Tests for adaptive crawling: live searches stop once they have enough comparables
+"""
+
+from unittest.mock import patch, MagicMock
+
+from app import CarDataScraper, CarAnalyzer, upstream_breaker, CrawlReport
+
+
+def listing_row(vid, text):
+    return f'<tr><td><a href="m_sell_dsp.php?h_vid={vid}">{text}</a></td></tr>'
+
+
+class TestAdaptiveCrawl:
+    """With a target, max_pages is a budget: crawling stops once enough comparables are found"""
+
+    def page(self, first_vid, camrys, others=0):
+        rows = [listing_row(first_vid + i, f'豐田 Camry 2020 ${150000 + i:,}') for i in range(camrys)]
+        rows += [listing_row(first_vid + 100 + i, f'本田 Civic 2018 ${90000 + i:,}') for i in range(others)]
+        return MagicMock(content=('<html><table>' + ''.join(rows) + '</table></html>').encode('big5hkscs'))
+
+    def crawl(self, pages, target, max_pages=3):
+        scraper = CarDataScraper()
+        report = CrawlReport()
+        with patch.object(scraper, 'fetch_page', side_effect=pages) as mock_fetch, patch('app.time.sleep'):
+            cars = scraper.search_cars_by_query('Toyota', 'Camry', 2020, max_pages=max_pages,
+                                                target_comparables=target, report=report)
+        return cars, report, mock_fetch.call_count
+
+    def test_stops_once_target_is_met(self):
+        cars, report, fetched = self.crawl([self.page(1, 12), self.page(20, 12), self.page(40, 12)], target=20)
+        assert fetched == 2
+        assert report.to_dict() == {'pagesFetched': 2, 'comparables': 24, 'stopReason': 'target_met'}
+        assert len(cars) == 24
+
+    def test_stops_when_a_page_adds_no_comparables(self):
+        cars, report, fetched = self.crawl([self.page(1, 5), self.page(1, 5, others=8), self.page(40, 5)], target=20)
+        assert fetched == 2  # Page 2 only repeats page 1's Camrys
+        assert (report.comparables, report.stop_reason) == (5, 'no_comparables')
+        assert len(cars) == 13
+
+    def test_keeps_crawling_useful_pages_up_to_the_budget(self):
+        cars, report, fetched = self.crawl([self.page(1, 5), self.page(20, 5), self.page(40, 5)], target=20)
+        assert fetched == 3
+        assert (report.pages_fetched, report.comparables, report.stop_reason) == (3, 15, 'max_pages')
+
+    def test_circuit_opening_mid_crawl_keeps_scraped_pages(self):
+        def fetch(url, params, **_):
+            for _ in range(upstream_breaker.min_calls):
+                upstream_breaker.record_failure(timeout=True)  # Trips while page 1 is in flight
+            return self.page(1, 5)
+
+        scraper = CarDataScraper()
+        report = CrawlReport()
+        with patch.object(scraper, 'fetch_page', side_effect=fetch) as mock_fetch, patch('app.time.sleep'):
+            cars = scraper.search_cars_by_query('Toyota', 'Camry', 2020, max_pages=3, target_comparables=20,
+                                                report=report)
+        assert mock_fetch.call_count == 1
+        assert len(cars) == 5
+        assert report.to_dict() == {'pagesFetched': 1, 'comparables': 5, 'stopReason': 'circuit_open'}
+
+    def test_analysis_reports_pages_fetched(self):
+        car_analyzer = CarAnalyzer()
+        user_car = {'make': 'Toyota', 'model': 'Camry', 'year': 2020, 'mileage': 50000, 'price': 150000}
+        with patch.object(car_analyzer.scraper, 'fetch_page', side_effect=[self.page(1, 25)]), \
+                patch('app.time.sleep'):
+            analysis = car_analyzer.analyze_price(user_car)
+        assert analysis['crawl'] == {'pagesFetched': 1, 'comparables': 25, 'stopReason': 'target_met'}
+
+        analysis = car_analyzer.analyze_price(user_car)  # Served from cache
+        assert analysis['crawl'] == {'pagesFetched': 0, 'comparables': 0, 'stopReason': None}
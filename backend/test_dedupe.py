@@ -0,0 +1,72 @@
+"""
+Tests for scraped listing fingerprints and deduplication within and across scrapes
+"""
+
+import json
+from unittest.mock import patch, MagicMock
+
+from app import app, CarDataScraper, CarAnalyzer, SeenFingerprints, listing_fingerprint, scrape_metrics
+
+
+def listing_row(vid, text):
+    return f'<tr><td><a href="m_sell_dsp.php?h_vid={vid}">{text}</a></td></tr>'
+
+
+class TestListingDeduplication:
+    """Repeated listings are dropped within a scrape and counted once across scrapes"""
+
+    featured = listing_row(101, '豐田 Camry 2020 $150,000')
+    pages = [
+        '<html><table>' + featured + listing_row(102, '本田 Civic 2019 $120,000') + '</table></html>',
+        '<html><table>' + featured + listing_row(103, '本田 Accord 2018 $130,000') + '</table></html>',
+    ]
+
+    def scrape(self, scraper):
+        with patch.object(scraper, 'fetch_page') as mock_fetch, patch('app.time.sleep'):
+            mock_fetch.side_effect = [MagicMock(content=page.encode('big5hkscs')) for page in self.pages]
+            return scraper.search_cars_by_query(max_pages=2)
+
+    def test_fingerprint_prefers_listing_id(self):
+        assert listing_fingerprint('anything', '101') == '28car:101'
+        assert listing_fingerprint('豐田  camry\n2020 $150,000') == listing_fingerprint('豐田 CAMRY 2020 $150,000')
+        assert listing_fingerprint('豐田 Camry 2020 $150,000') != listing_fingerprint('豐田 Camry 2020 $160,000')
+
+    def test_listing_repeated_across_pages_is_dropped(self):
+        cars = self.scrape(CarDataScraper())
+
+        assert sorted(car['fingerprint'] for car in cars) == ['28car:101', '28car:102', '28car:103']
+        stats = scrape_metrics.stats()
+        assert stats['pages'] == 2
+        assert stats['listings_parsed'] == 4
+        assert stats['duplicates_dropped'] == 1
+        assert stats['duplicate_rate'] == 0.25
+
+    def test_rescraped_listings_are_not_counted_twice(self):
+        car_analyzer = CarAnalyzer()
+        car_analyzer.publish(self.scrape(car_analyzer.scraper))
+        car_analyzer.publish(self.scrape(car_analyzer.scraper))  # Same listings, new objects
+
+        level, sketch = car_analyzer.sketches.lookup('Toyota', min_count=1)
+        assert sketch.count == 1
+        assert len(car_analyzer.market_data) == 3
+        stats = scrape_metrics.stats()
+        assert stats['listings_new'] == 3
+        assert stats['listings_repeated'] == 3
+        assert stats['repeat_rate'] == 0.5
+
+    def test_seen_set_is_bounded(self):
+        seen = SeenFingerprints(capacity=2)
+        assert seen.add('a') and seen.add('b')
+        assert not seen.add('a')  # Refreshes 'a', so 'b' is the oldest
+        assert seen.add('c')
+        assert len(seen) == 2
+        assert seen.add('b')
+        assert not seen.add('c')
+
+    def test_health_reports_scrape_metrics(self):
+        self.scrape(CarDataScraper())
+        with app.test_client() as client:
+            data = json.loads(client.get('/api/health').data)
+
+        assert data['scrape']['duplicates_dropped'] == 1
+        assert data['scrape']['duplicate_rate'] == 0.25
@@ -0,0 +1,156 @@
+"""
+Tests for detail-page enrichment: parsing, the detail cache, per-host rate limits and concurrent lookups
+"""
+
+import time
+from unittest.mock import patch, MagicMock
+
+import requests
+
+import app as app_module
+from app import (CarDataScraper, Deadline, CrawlBudget, DetailCache, DetailEnricher, HostRateLimiter,
+                 enrichment_metrics, parse_detail_page, build_ingestion_pipeline)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def listing_row(vid, text):
+    return f'<tr><td><a href="m_sell_dsp.php?h_vid={vid}">{text}</a></td></tr>'
+
+
+def detail_page(text):
+    return MagicMock(content=f'<html><body><div>{text}</div></body></html>'.encode('big5hkscs'))
+
+
+class TestDetailEnrichment:
+    """Detail pages replace estimated mileage, owners and colour, each fetched at most once"""
+
+    def enricher(self, tmp_path, budget=None):
+        return DetailEnricher(DetailCache(str(tmp_path / 'details.sqlite')), workers=4, limiter=HostRateLimiter(rate=0),
+                              budget=budget if budget is not None else CrawlBudget())
+
+    def listings(self):
+        return [{'make': 'Toyota', 'mileage': 123, 'owners': 3, 'color': 'red', 'fingerprint': f'28car:{vid}'}
+                for vid in (1, 2)] + [{'make': 'Honda', 'mileage': 456, 'fingerprint': 'text:abc'}]
+
+    def test_parse_detail_page(self):
+        page = detail_page('行車里數: 5.2萬公里 前車主數目: 2 顏色: 銀色').content
+        assert parse_detail_page(page) == {'mileage': 52000, 'owners': 2, 'color': 'silver'}
+        assert parse_detail_page(detail_page('Mileage 48,000 km').content) == {'mileage': 48000}
+        assert parse_detail_page(b'') == {}
+
+    def test_detail_pages_are_fetched_once(self, tmp_path):
+        scraper = CarDataScraper()
+        budget = CrawlBudget()
+        enricher = self.enricher(tmp_path, budget)
+        with patch.object(scraper, 'fetch_page', return_value=detail_page('里數 3萬 手數 1 顏色 白色')) as mock_fetch:
+            cars = [enricher.enrich_one(car, scraper) for car in self.listings()]
+            assert mock_fetch.call_count == 2  # The text-fingerprinted listing has no detail page
+            assert sorted(call.args[1]['h_vid'] for call in mock_fetch.call_args_list) == ['1', '2']
+            assert cars[0] == {'make': 'Toyota', 'mileage': 30000, 'owners': 1, 'color': 'white',
+                               'fingerprint': '28car:1'}
+            assert cars[2]['mileage'] == 456
+
+            # A new process with the same cache file doesn't fetch again
+            again = DetailEnricher(DetailCache(str(tmp_path / 'details.sqlite')), limiter=HostRateLimiter(rate=0))
+            assert again.enrich_one(self.listings()[1], scraper)['mileage'] == 30000
+            assert mock_fetch.call_count == 2
+        assert budget.spent == 2  # Each detail page fetched is charged to the crawl budget
+
+        stats = enrichment_metrics.stats()
+        assert (stats['listings'], stats['cache_hits'], stats['cache_misses'], stats['pages_fetched']) == (3, 1, 2, 2)
+        assert stats['hit_rate'] == 0.3333
+
+    def test_failed_fetches_keep_estimates_and_are_retried(self, tmp_path):
+        scraper = CarDataScraper()
+        enricher = self.enricher(tmp_path)
+        with patch.object(scraper, 'fetch_page', side_effect=requests.exceptions.ConnectionError('down')):
+            car = enricher.enrich_one(self.listings()[0], scraper)
+        assert car['mileage'] == 123
+        assert enrichment_metrics.stats()['fetch_failures'] == 1
+        assert enricher.cache.get('1') is None
+
+    def test_short_deadline_keeps_estimates(self, tmp_path):
+        scraper = CarDataScraper()
+        with patch.object(scraper, 'fetch_page') as mock_fetch:
+            car = self.enricher(tmp_path).enrich_one(self.listings()[0], scraper, Deadline(1))
+        assert car['mileage'] == 123
+        assert not mock_fetch.called
+        assert enrichment_metrics.stats()['skipped'] == 1
+
+    def test_pipeline_without_deadline_bounds_detail_fetching(self, tmp_path):
+        scraper = CarDataScraper()
+        page = MagicMock(content=('<html><table>' + listing_row(7, '豐田 Camry 2020 $150,000')
+                                  + '</table></html>').encode('big5hkscs'))
+        with patch.object(scraper, 'fetch_page', return_value=page) as mock_fetch, patch('app.DETAIL_BUDGET_SECONDS', 0):
+            pipeline = build_ingestion_pipeline(scraper, page_pause=(0, 0), enricher=self.enricher(tmp_path))
+            cars = list(pipeline.run([(None, None, None, 1)]))
+        assert len(cars) == 1 and mock_fetch.call_count == 1  # The search page only
+        assert enrichment_metrics.stats()['skipped'] == 1
+
+    def test_live_search_fetches_details_concurrently(self, tmp_path):
+        scraper = CarDataScraper()
+        rows = ''.join(listing_row(vid, f'豐田 Camry 2020 ${150000 + vid:,}') for vid in range(1, 7))
+        page = MagicMock(content=f'<html><table>{rows}</table></html>'.encode('big5hkscs'))
+
+        def fetch(url, params, **_):
+            if url.endswith('/m_sell_lst.php'):
+                return page
+            time.sleep(0.2)
+            return detail_page('里數 8萬')
+
+        enricher = DetailEnricher(DetailCache(str(tmp_path / 'details.sqlite')), workers=3,
+                                  limiter=HostRateLimiter(rate=0), budget=CrawlBudget())
+        with patch('app.get_detail_enricher', return_value=enricher), patch.object(scraper, 'fetch_page', side_effect=fetch):
+            started = time.monotonic()
+            cars = scraper.search_cars_by_query(make='Toyota', max_pages=1, deadline=Deadline(10))
+            elapsed = time.monotonic() - started
+        enricher.pool.shutdown()
+
+        assert [car['mileage'] for car in cars] == [80000] * 6
+        assert elapsed < 0.9  # Six 0.2 s detail pages on three threads take about 0.4 s, not 1.2 s
+
+    def test_lookups_past_the_deadline_leave_estimates(self, tmp_path):
+        scraper = CarDataScraper()
+        clock = FakeClock()
+        deadline = Deadline(5, clock=clock)
+
+        def fetch(url, params, **_):
+            clock.now += 10  # The first detail page uses up the whole budget
+            return detail_page('里數 8萬')
+
+        enricher = DetailEnricher(DetailCache(str(tmp_path / 'details.sqlite')), workers=1,
+                                  limiter=HostRateLimiter(rate=0), budget=CrawlBudget())
+        with patch.object(scraper, 'fetch_page', side_effect=fetch) as mock_fetch:
+            cars = enricher.enrich_all(self.listings()[:2], scraper, deadline)
+        enricher.pool.shutdown()
+
+        assert sorted(car['mileage'] for car in cars) == [123, 80000]
+        assert mock_fetch.call_count == 1
+        assert enrichment_metrics.stats()['skipped'] == 1
+
+    def test_rate_limit_spaces_requests_per_host(self):
+        clock = FakeClock()
+        slept = []
+        limiter = HostRateLimiter(rate=2, clock=clock, sleep=slept.append)
+        for _ in range(3):
+            limiter.acquire('a.example')
+        limiter.acquire('b.example')
+        assert slept == [0.5, 1.0]
+
+    def test_pipeline_enrich_stage(self, tmp_path):
+        scraper = CarDataScraper()
+        page = MagicMock(content=('<html><table>' + listing_row(7, '豐田 Camry 2020 $150,000')
+                                  + '</table></html>').encode('big5hkscs'))
+        responses = {'/m_sell_lst.php': page, '/m_sell_dsp.php': detail_page('里數 8萬')}
+        with patch.object(scraper, 'fetch_page', side_effect=lambda url, params, **_: responses[url[url.rindex('/'):]]):
+            pipeline = build_ingestion_pipeline(scraper, page_pause=(0, 0), enricher=self.enricher(tmp_path))
+            cars = list(pipeline.run([(None, None, None, 1)]))
+        assert [car['mileage'] for car in cars] == [80000]
+        assert pipeline.stats()['enrich']['workers'] == app_module.DETAIL_WORKERS
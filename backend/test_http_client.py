@@ -0,0 +1,345 @@
+"""
+Tests for the shared outbound HTTP client, status retries, the circuit breaker guarding 28car
+and request deadline propagation
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import subprocess
+import sys
+import pytest
+import requests
+from unittest.mock import patch, MagicMock
+from app import (app, CarDataScraper, CarAnalyzer, CircuitBreaker, CircuitOpenError, Deadline, analyzer, upstream_breaker,
+                 get_http_session, build_http_session, prewarm_http_session, HTTP_RETRY_STATUSES, DEADLINE_HEADER)
+
+
+class TestSharedSession:
+    """The connection pool is built once and reused everywhere"""
+
+    def test_scrapers_share_one_session(self):
+        """Every scraper instance reuses the process-wide session"""
+        assert CarDataScraper().session is CarDataScraper().session
+        assert CarDataScraper().session is get_http_session()
+        assert analyzer.scraper.session is get_http_session()
+
+    def test_adapter_pool_and_retry_policy(self):
+        """Mounted adapter has a sized pool and only reconnects; statuses are retried by fetch_page"""
+        session = build_http_session()
+        adapter = session.get_adapter('https://dj1jklak2e.28car.com/')
+
+        assert adapter._pool_maxsize >= 1
+        retry = adapter.max_retries
+        assert retry.connect == 1
+        assert retry.status == 0  # urllib3 would sleep through Retry-After regardless of the deadline
+        assert retry.read == 0  # Timed-out reads are not repeated
+        assert 429 in HTTP_RETRY_STATUSES
+        assert session.headers['Connection'] == 'keep-alive'
+
+
+class TestStatusRetries:
+    """fetch_page retries throttling and 5xx responses within the caller's deadline"""
+
+    @pytest.fixture
+    def upstream(self):
+        """Local server answering with the (status, Retry-After) replies in order, repeating the last"""
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.hits += 1
+                status, retry_after = server.replies[min(server.hits, len(server.replies)) - 1]
+                self.send_response(status)
+                if retry_after is not None:
+                    self.send_header('Retry-After', retry_after)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.hits = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def fetch(self, server, deadline=None):
+        url = f'http://127.0.0.1:{server.server_address[1]}/'
+        return CarDataScraper().fetch_page(url, {}, timeout=5, deadline=deadline)
+
+    def test_retry_after_within_the_deadline_is_honoured(self, upstream):
+        upstream.replies = [(503, '0'), (200, None)]
+        assert self.fetch(upstream, Deadline(5)).status_code == 200
+        assert upstream.hits == 2
+
+    def test_retry_after_never_outlasts_the_deadline(self, upstream):
+        upstream.replies = [(503, '1')]
+        started = time.monotonic()
+        with pytest.raises(requests.exceptions.HTTPError):
+            self.fetch(upstream, Deadline(5))
+        assert time.monotonic() - started < 5
+        assert 2 <= upstream.hits <= 3  # Retried while a one-second wait and another attempt still fit
+
+    def test_retry_after_beyond_the_budget_is_not_waited_for(self, upstream):
+        upstream.replies = [(503, '3')]
+        started = time.monotonic()
+        with pytest.raises(requests.exceptions.HTTPError):
+            self.fetch(upstream, Deadline(4))
+        assert time.monotonic() - started < 1
+        assert upstream.hits == 1
+
+    def test_prewarm_failure_is_not_fatal(self):
+        """Pre-warming never raises when 28car is unreachable"""
+        with patch.object(get_http_session(), 'head') as mock_head:
+            mock_head.side_effect = requests.exceptions.ConnectionError("unreachable")
+            assert prewarm_http_session() is False
+
+        with patch.object(get_http_session(), 'head') as mock_head:
+            mock_head.return_value = MagicMock(status_code=200)
+            assert prewarm_http_session() is True
+
+
+class TestLazyImports:
+    """Scraping dependencies are not imported until the scraper needs them"""
+
+    def test_import_does_not_load_scraping_dependencies(self):
+        code = ("import sys, app; app.app.test_client().get('/api/health'); "
+                "print(','.join(m for m in ('pandas', 'bs4', 'lxml', 'requests', 'urllib3') if m in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        assert result.stdout.strip().splitlines()[-1:] in ([], [''])
+
+    def test_session_resolved_on_first_use(self):
+        assert isinstance(CarDataScraper().session, requests.Session)
+
+
+class TestScrapeEndpointUsesSharedSession:
+    """/api/test-scrape goes through the pooled session instead of bare requests.get"""
+
+    def test_test_scrape_uses_pool(self):
+        with app.test_client() as client:
+            with patch.object(get_http_session(), 'get') as mock_get:
+                mock_response = MagicMock()
+                mock_response.status_code = 200
+                mock_response.text = "<html><table><tr><td>平治 CLA250 2019 $250,000</td></tr></table></html>"
+                mock_get.return_value = mock_response
+
+                response = client.get('/api/test-scrape')
+
+                assert response.status_code == 200
+                assert mock_get.called
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def http_error(status):
+    response = MagicMock()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+class TestCircuitBreaker:
+    """Closed/open/half-open transitions driven by recent failures"""
+
+    def make_breaker(self, clock):
+        return CircuitBreaker('test', window_seconds=60, min_calls=4, failure_rate=0.5,
+                              open_seconds=30, half_open_probes=1, clock=clock)
+
+    def fail(self, breaker, exc):
+        def boom():
+            raise exc
+        with pytest.raises(type(exc)):
+            breaker.call(boom)
+
+    def test_trips_after_failure_rate_exceeded(self):
+        clock = FakeClock()
+        breaker = self.make_breaker(clock)
+
+        breaker.call(lambda: 'ok')
+        breaker.call(lambda: 'ok')
+        self.fail(breaker, requests.exceptions.Timeout("slow"))
+        assert breaker.state == CircuitBreaker.CLOSED
+        self.fail(breaker, requests.exceptions.ConnectionError("down"))
+
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.stats()['trip_count'] == 1
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: 'ok')
+        assert breaker.stats()['short_circuit_count'] == 1
+
+    def test_client_errors_do_not_trip(self):
+        breaker = self.make_breaker(FakeClock())
+        for _ in range(4):
+            self.fail(breaker, http_error(404))
+        assert breaker.state == CircuitBreaker.CLOSED
+
+        for _ in range(4):
+            self.fail(breaker, http_error(503))
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_old_failures_age_out_of_window(self):
+        clock = FakeClock()
+        breaker = self.make_breaker(clock)
+        for _ in range(3):
+            self.fail(breaker, requests.exceptions.Timeout("slow"))
+        clock.now += 61
+        self.fail(breaker, requests.exceptions.Timeout("slow"))
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe_success_closes(self):
+        clock = FakeClock()
+        breaker = self.make_breaker(clock)
+        for _ in range(4):
+            self.fail(breaker, requests.exceptions.Timeout("slow"))
+        assert breaker.state == CircuitBreaker.OPEN
+
+        clock.now += 31
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow_request() is True
+        assert breaker.allow_request() is False  # Only one probe at a time
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe_failure_reopens(self):
+        clock = FakeClock()
+        breaker = self.make_breaker(clock)
+        for _ in range(4):
+            self.fail(breaker, requests.exceptions.ConnectionError("down"))
+
+        clock.now += 31
+        self.fail(breaker, requests.exceptions.ConnectionError("still down"))
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.stats()['trip_count'] == 2
+
+
+class TestBreakerIntegration:
+    """An open breaker makes analysis fail fast to cached or mock data"""
+
+    def trip(self):
+        for _ in range(upstream_breaker.min_calls):
+            upstream_breaker.record_failure(timeout=True)
+        assert upstream_breaker.is_open()
+
+    def test_open_breaker_skips_scraping(self):
+        self.trip()
+        car_analyzer = CarAnalyzer()
+        user_car = {'make': 'Toyota', 'model': 'Camry', 'year': 2020, 'mileage': 50000, 'price': 150000}
+
+        with patch.object(car_analyzer.scraper, 'search_cars_by_query') as mock_search:
+            result = car_analyzer.analyze_price(user_car)
+
+        assert not mock_search.called
+        assert 'marketPrice' in result
+
+    def test_open_breaker_serves_stale_cache(self):
+        car_analyzer = CarAnalyzer()
+        cached = [{'make': 'Toyota', 'model': 'Camry', 'year': 2020, 'price': 150000}]
+        car_analyzer.market_data = cached
+        self.trip()
+
+        with patch.object(car_analyzer.scraper, 'search_cars_by_query') as mock_search:
+            data = car_analyzer.get_market_data(user_car={'make': 'Toyota'}, force_refresh=True)
+
+        assert data == cached
+        assert not mock_search.called
+
+    def test_scraper_does_not_touch_network_when_open(self):
+        self.trip()
+        scraper = CarDataScraper()
+        with patch.object(get_http_session(), 'get') as mock_get:
+            with pytest.raises(CircuitOpenError):
+                scraper.search_cars_by_query(make='Toyota', max_pages=1)
+        assert not mock_get.called
+
+    def test_health_reports_breaker(self):
+        self.trip()
+        with app.test_client() as client:
+            response = client.get('/api/health')
+            data = json.loads(response.data)
+
+        assert data['upstream']['state'] == 'open'
+        assert data['upstream']['trip_count'] == 1
+
+
+class TestRequestDeadline:
+    """The client's remaining budget bounds scraping and picks a degradation path"""
+
+    user_car = {'make': 'Toyota', 'model': 'Camry', 'year': 2020, 'mileage': 50000, 'price': 150000}
+
+    def test_deadline_from_header(self):
+        assert Deadline.from_header('5').remaining() <= 5
+        assert Deadline.from_header('5').remaining() > 4
+        assert Deadline.from_header('garbage', default=12).remaining() > 11
+        assert Deadline.from_header('-3', default=12).remaining() > 11
+        assert Deadline.from_header(None, default=7).remaining() <= 7
+
+    def test_timeout_is_capped_by_remaining_budget(self):
+        clock = FakeClock()
+        deadline = Deadline(4, clock=clock)
+        assert deadline.timeout(30) == 4
+        clock.now += 3
+        assert deadline.timeout(30) == pytest.approx(1)
+        clock.now += 2
+        assert deadline.expired()
+        assert deadline.timeout(30) == 0
+
+    def test_scraper_uses_remaining_budget_as_timeout(self):
+        scraper = CarDataScraper()
+        with patch.object(scraper, 'fetch_page') as mock_fetch:
+            mock_fetch.return_value = MagicMock(content=b'<html></html>')
+            scraper.search_cars_by_query(make='Toyota', max_pages=1, deadline=Deadline(5))
+
+        timeout = mock_fetch.call_args.kwargs['timeout']
+        assert 0 < timeout <= 5
+
+    def test_scraper_stops_when_budget_runs_out(self):
+        scraper = CarDataScraper()
+        with patch.object(scraper, 'fetch_page') as mock_fetch:
+            scraper.search_cars_by_query(make='Toyota', max_pages=3, deadline=Deadline(0.5))
+        assert not mock_fetch.called
+
+    def test_short_budget_skips_scraping(self):
+        car_analyzer = CarAnalyzer()
+        with patch.object(car_analyzer.scraper, 'search_cars_by_query') as mock_search:
+            result = car_analyzer.analyze_price(dict(self.user_car), deadline=Deadline(1))
+
+        assert not mock_search.called
+        assert result['degradation']['degraded'] is True
+        assert result['degradation']['reason'] == 'deadline'
+        assert result['degradation']['path'] in ('mock_data', 'fallback_analysis')
+
+    def test_timeout_after_deadline_degrades_instead_of_failing(self):
+        clock = FakeClock()
+        deadline = Deadline(10, clock=clock)
+        car_analyzer = CarAnalyzer()
+
+        def slow_search(*args, **kwargs):
+            clock.now += 11
+            raise requests.exceptions.Timeout("read timed out")
+
+        with patch.object(car_analyzer.scraper, 'search_cars_by_query', side_effect=slow_search):
+            result = car_analyzer.analyze_price(dict(self.user_car), deadline=deadline)
+
+        assert result['degradation']['reason'] == 'deadline'
+        assert 'marketPrice' in result
+
+    def test_endpoint_reports_degradation_path(self):
+        with app.test_client() as client:
+            with patch('app.CarDataScraper.search_cars_by_query') as mock_search:
+                response = client.post('/api/analyze-car', json=self.user_car, headers={DEADLINE_HEADER: '0.5'})
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['degradation']['reason'] == 'deadline'
+        assert data['degradation']['deadlineRemainingMs'] <= 500
+        assert not mock_search.called
@@ -0,0 +1,411 @@
+"""
+Tests for the standalone ingestion worker and API processes that only read its output
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+import app as app_module
+from app import (CarAnalyzer, CrawlBudget, DemandTracker, Pipeline, PipelineStage, PrewarmScheduler, SnapshotStore,
+                 StoredListings, build_ingestion_pipeline, parse_stage_workers)
+import ingest_worker
+
+
+def scraped_car(vid, price, make='Toyota', model='Camry'):
+    return {'make': make, 'model': model, 'year': 2020, 'price': price, 'mileage': 50000, 'fuel_type': 'petrol',
+            'transmission': 'automatic', 'seats': 5, 'is_mock_data': False, 'fingerprint': f'28car:{vid}'}
+
+
+def listing_page(*rows):
+    """28car-style result page; rows are (vid, text) pairs"""
+    body = ''.join(f'<tr><td><a href="m_sell_dsp.php?h_vid={vid}">{text}</a></td></tr>' for vid, text in rows)
+    return MagicMock(content=f'<html><body><table>{body}</table></body></html>'.encode('big5hkscs'))
+
+
+class TestPipeline:
+    """Stages stream items through bounded queues"""
+
+    def test_stages_compose_in_order(self):
+        pipeline = Pipeline([PipelineStage('double', lambda x: [x, x]),
+                             PipelineStage('odd', lambda x: [x] if x % 2 else [])])
+        assert list(pipeline.run(range(5))) == [1, 1, 3, 3]
+
+        stats = pipeline.stats()
+        assert (stats['double']['items_in'], stats['double']['items_out']) == (5, 10)
+        assert (stats['odd']['items_in'], stats['odd']['items_out']) == (10, 4)
+
+    def test_failed_items_are_counted_and_skipped(self):
+        pipeline = Pipeline([PipelineStage('invert', lambda x: [1 / x])])
+        assert sorted(pipeline.run([1, 0, 2])) == [0.5, 1.0]
+        assert pipeline.stats()['invert']['errors'] == 1
+
+    def test_parallel_workers(self):
+        pipeline = Pipeline([PipelineStage('sleep', lambda x: time.sleep(0.05) or [x], workers=4)])
+        started = time.perf_counter()
+        assert sorted(pipeline.run(range(8))) == list(range(8))
+        assert time.perf_counter() - started < 0.3  # Serial would take 0.4s
+
+    def test_slow_consumer_bounds_the_queues(self):
+        produced = []
+        source = (produced.append(i) or i for i in range(1000))
+        pipeline = Pipeline([PipelineStage('a', lambda x: [x]), PipelineStage('b', lambda x: [x])], queue_size=2)
+
+        outputs = pipeline.run(source)
+        assert next(outputs) == 0
+        time.sleep(0.2)
+        # Upstream stages block on full queues instead of buffering the whole source
+        assert len(produced) <= 10
+        assert all(stats['max_queue_depth'] <= 2 for stats in pipeline.stats().values())
+        outputs.close()
+
+    def test_closing_early_stops_the_threads(self):
+        def pipeline_threads():
+            return [thread for thread in threading.enumerate() if thread.name.startswith('pipeline-')]
+
+        outputs = Pipeline([PipelineStage('a', lambda x: [x], workers=3)], queue_size=1).run(iter(range(10 ** 6)))
+        assert next(outputs) == 0
+        outputs.close()
+        deadline = time.monotonic() + 2
+        while pipeline_threads() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pipeline_threads() == []
+
+    def test_inline_run_finishes_each_item_before_taking_the_next(self):
+        outputs = []
+
+        def source():
+            for i in range(3):
+                yield i
+                assert outputs[-2:] == [i, i]  # Everything item i produced is out before i + 1 is taken
+
+        pipeline = Pipeline([PipelineStage('double', lambda x: [x, x]), PipelineStage('same', lambda x: [x])])
+        for output in pipeline.run_inline(source()):
+            outputs.append(output)
+        assert outputs == [0, 0, 1, 1, 2, 2]
+        assert (pipeline.stats()['same']['items_in'], pipeline.stats()['same']['items_out']) == (6, 6)
+
+    def test_inline_run_raises_stage_errors(self):
+        with pytest.raises(ZeroDivisionError):
+            list(Pipeline([PipelineStage('invert', lambda x: [1 / x])]).run_inline([1, 0, 2]))
+
+    def test_parse_stage_workers(self):
+        assert parse_stage_workers('fetch=3, parse=2,extract=0,') == {'fetch': 3, 'parse': 2, 'extract': 1}
+
+
+class TestIngestionPipeline:
+    """fetch -> parse -> extract -> canonicalize -> dedupe over 28car result pages"""
+
+    def test_listings_are_canonicalized_and_deduplicated(self):
+        scraper = CarAnalyzer().scraper
+        pages = {1: listing_page((1, '平治 C200 2019 $280,000'), (2, '豐田 Camry 2020 $150,000')),
+                 2: listing_page((1, '平治 C200 2019 $280,000'), (3, 'no price here'))}
+        with patch.object(scraper, 'fetch_page', side_effect=lambda url, params, **_: pages[params['h_page']]):
+            pipeline = build_ingestion_pipeline(scraper, page_pause=(0, 0))
+            cars = list(pipeline.run([(None, None, None, 1), (None, None, None, 2)]))
+
+        assert sorted((car['fingerprint'], car['make']) for car in cars) == [('28car:1', 'Mercedes-Benz'),
+                                                                             ('28car:2', 'Toyota')]
+        stats = pipeline.stats()
+        assert stats['fetch']['items_out'] == 2
+        assert stats['extract']['items_in'] == 3
+        assert (stats['dedupe']['items_in'], stats['dedupe']['items_out']) == (3, 2)
+
+    def test_posting_dates_are_kept_apart_from_ingest_dates(self):
+        scraper = CarAnalyzer().scraper
+        page = listing_page((1, '豐田 Camry 2018 $150,000 18/07/2025'), (2, '豐田 Camry 2019 $160,000'))
+        with patch.object(scraper, 'fetch_page', return_value=page):
+            cars = {car['fingerprint']: car for car in
+                    build_ingestion_pipeline(scraper, page_pause=(0, 0)).run([(None, None, None, 1)])}
+
+        assert (cars['28car:1']['date_listed'], cars['28car:1']['date_basis'], cars['28car:1']['year']) == \
+            ('2025-07-18', 'listed', 2018)
+        assert cars['28car:2']['date_basis'] == 'ingested'
+
+
+class TestIngestWorker:
+    """The worker scrapes every segment and writes one combined snapshot to the store"""
+
+    def test_parse_segments(self):
+        assert ingest_worker.parse_segments(',Toyota, BMW:X5') == [(None, None), ('Toyota', None), ('BMW', 'X5')]
+
+    def test_ingest_publishes_deduplicated_listings(self, tmp_path):
+        worker = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        by_make = {None: listing_page((1, '豐田 Camry 2020 $150,000'), (2, '本田 Civic 2019 $90,000')),
+                   '53': listing_page((1, '豐田 Camry 2020 $150,000'), (3, '豐田 Camry 2021 $160,000'))}
+
+        with patch.object(worker.scraper, 'fetch_page', side_effect=lambda url, params, **_: by_make[params.get('h_f_mk')]), \
+                patch('app.PIPELINE_PAGE_PAUSE', (0, 0)):
+            published = ingest_worker.ingest(worker, [(None, None), ('Toyota', None)], max_pages=1)
+
+        assert published == 3
+        snapshot, sketches, trends = SnapshotStore(str(tmp_path)).load()
+        assert sorted(car['fingerprint'] for car in snapshot.listings) == ['28car:1', '28car:2', '28car:3']
+        assert snapshot.source == 'worker'
+        assert sketches.lookup('Toyota', min_count=1)[1].count == 2
+
+    def test_ingest_streams_listings_to_column_files(self, tmp_path):
+        worker = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        page = listing_page(*((i, f'豐田 Camry 2020 ${150000 + i * 1000:,}') for i in range(1, 61)))
+        with patch.object(worker.scraper, 'fetch_page', return_value=page), patch('app.PIPELINE_PAGE_PAUSE', (0, 0)):
+            assert ingest_worker.ingest(worker, [('Toyota', None)], max_pages=1) == 60
+
+        listings = worker.snapshot.listings
+        assert isinstance(listings, StoredListings)
+        assert not listings.rows  # Published, indexed and fitted without a dict per listing
+        assert [path.name for path in tmp_path.glob('market-snapshot-*.npy')] == [os.path.basename(listings.path)]
+        assert worker.snapshot.stats.lookup('Toyota').count == 60
+        assert len(worker.snapshot.comparables.nearest(listings[0], 10)) == 10
+        assert worker.price_model.sample_size == 60
+
+    def test_failed_segments_keep_the_stored_snapshot(self, tmp_path):
+        worker = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        with patch.object(worker.scraper, 'fetch_page', side_effect=ConnectionError('down')):
+            assert ingest_worker.ingest(worker, [('Toyota', None)], max_pages=1) == 0
+        assert SnapshotStore(str(tmp_path)).load() is None
+
+
+class TestWorkerIngestionMode:
+    """API processes in worker mode read the store and never scrape"""
+
+    user_car = {'make': 'Toyota', 'model': 'Camry', 'year': 2020, 'mileage': 50000, 'price': 150000}
+
+    @pytest.fixture
+    def api(self, tmp_path):
+        analyzer = CarAnalyzer(store=SnapshotStore(str(tmp_path)), ingestion_mode='worker')
+        with patch.object(analyzer.scraper, 'search_cars_by_query') as mock_search:
+            yield analyzer
+        assert not mock_search.called
+
+    def write(self, directory, cars, updated_at=None):
+        worker = CarAnalyzer(store=SnapshotStore(directory))
+        worker.publish(cars, updated_at or datetime.now(), 'worker')
+
+    def test_mock_data_until_worker_output_arrives(self, api, tmp_path):
+        api.watch_store().stop()
+        snapshot, path, reason = api.load_market_data(self.user_car, force_refresh=True)
+        assert (path, reason) == ('mock_data', 'ingestion_pending')
+        assert not os.path.exists(tmp_path / SnapshotStore.META_FILE)  # Readers never write the store
+
+        self.write(str(tmp_path), [scraped_car(i, 150000 + i) for i in range(30)])
+        assert api.watcher.poll() is True
+        assert api.watcher.poll() is False  # Nothing new on disk
+
+        snapshot, path, reason = api.load_market_data(self.user_car)
+        assert (path, reason) == ('cache', None)
+        assert len(snapshot.listings) == 30
+
+    def test_mock_data_never_takes_a_worker_version(self, api, tmp_path):
+        api.watch_store().stop()
+        mock, path, _ = api.load_market_data(self.user_car)
+        assert path == 'mock_data'
+        assert api.load_market_data(self.user_car)[0] is mock  # Reused until it goes stale, not republished
+        assert api.snapshot.version == mock.version == 0
+
+        self.write(str(tmp_path), [scraped_car(i, 150000 + i) for i in range(30)])
+        assert api.watcher.poll() is True
+        snapshot, path, _ = api.load_market_data(self.user_car)
+        assert path == 'cache'
+        assert snapshot.version == 1
+        assert api.mock_snapshot is None
+
+    def test_stale_worker_output_is_degraded(self, api, tmp_path):
+        self.write(str(tmp_path), [scraped_car(1, 150000)], updated_at=datetime.now() - timedelta(days=1))
+        api.watch_store().stop()
+
+        snapshot, path, reason = api.load_market_data(self.user_car, force_refresh=True)
+        assert (path, reason) == ('stale_cache', 'ingestion_lag')
+
+    def test_analysis_reads_ingested_data(self, api, tmp_path):
+        self.write(str(tmp_path), [scraped_car(i, 140000 + 1000 * i) for i in range(25)])
+        api.watch_store().stop()
+
+        result = api.analyze_price(dict(self.user_car))
+        assert result['degradation']['path'] == 'cache'
+        assert result['degradation']['degraded'] is False
+
+
+    def test_debug_and_compatibility_scrapes_are_refused(self):
+        with patch.object(app_module.analyzer, 'ingestion_mode', 'worker'), \
+                patch.object(app_module.analyzer.scraper, 'search_cars_by_query') as mock_search, \
+                patch.object(app_module, 'get_http_session') as mock_session:
+            with app_module.app.test_client() as client:
+                assert client.get('/api/test-scrape').status_code == 409
+            assert 'error' in app_module.get_car_data('Toyota')
+        assert not mock_search.called
+        assert not mock_session.called
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDemandTracker:
+    """Query counts per (make, model, year band), decaying over time"""
+
+    def test_segments_share_canonical_names_and_year_bands(self):
+        tracker = DemandTracker(year_band=3, clock=FakeClock())
+        tracker.record({'make': '豐田', 'model': 'Camry', 'year': 2019})
+        tracker.record({'make': 'toyota', 'model': 'CAMRY', 'year': 2020})
+        tracker.record({'make': 'Toyota', 'model': 'Camry', 'year': 2021})
+        tracker.record({'make': 'Toyota', 'model': 'Camry', 'year': 'unknown'})
+
+        assert tracker.top(5) == [('Toyota', 'Camry', 2019)]
+        assert tracker.stats()['top'] == [{'make': 'Toyota', 'model': 'Camry', 'years': '2019-2021', 'score': 3.0}]
+
+    def test_recent_demand_outranks_old_demand(self):
+        clock = FakeClock()
+        tracker = DemandTracker(half_life_seconds=3600, clock=clock)
+        for _ in range(4):
+            tracker.record({'make': 'BMW', 'model': '320i', 'year': 2018})
+        clock.now += 3 * 3600  # Four old queries now weigh half a query
+        tracker.record({'make': 'Honda', 'model': 'Civic', 'year': 2020})
+
+        assert [segment[:2] for segment in tracker.top(2)] == [('Honda', 'Civic'), ('BMW', '320i')]
+
+    def test_tracked_segments_are_bounded(self):
+        tracker = DemandTracker(max_segments=3, year_band=1)
+        for year in range(2000, 2010):
+            tracker.record({'make': 'Toyota', 'model': 'Camry', 'year': year})
+        assert tracker.stats()['segments_tracked'] == 3
+
+
+class TestCrawlBudget:
+    def test_budget_refills_over_time(self):
+        clock = FakeClock()
+        budget = CrawlBudget(pages_per_hour=2, clock=clock)
+        assert budget.try_spend() and budget.try_spend()
+        assert not budget.try_spend()
+        clock.now += 1800
+        assert budget.try_spend()
+
+    def test_live_scrapes_hold_back_optional_crawls(self):
+        clock = FakeClock()
+        budget = CrawlBudget(pages_per_hour=2, clock=clock)
+        budget.charge(3)
+        clock.now += 1800
+        assert not budget.try_spend()
+        assert budget.stats()['pages_spent'] == 3
+
+
+class TestPrewarmScheduler:
+    """The hottest segments are scraped shortly before the market snapshot expires"""
+
+    def tracker(self, *cars):
+        tracker = DemandTracker(clock=FakeClock())
+        for car in cars:
+            tracker.record(car)
+        return tracker
+
+    def test_refresh_scrapes_top_segments_within_budget(self):
+        analyzer = CarAnalyzer()
+        tracker = self.tracker({'make': 'Toyota', 'model': 'Camry', 'year': 2020},
+                               {'make': 'Toyota', 'model': 'Camry', 'year': 2020},
+                               {'make': 'Toyota', 'model': 'Camry', 'year': 2010},
+                               {'make': 'Honda', 'model': 'Civic', 'year': 2019},
+                               {'make': 'BMW', 'model': '320i', 'year': 2018})
+        scheduler = PrewarmScheduler(analyzer, tracker, CrawlBudget(pages_per_hour=2), top_segments=4)
+        scraped = {'Camry': [scraped_car(1, 150000)], 'Civic': [scraped_car(2, 90000, 'Honda', 'Civic')]}
+
+        def search(make, model, max_pages, report):
+            report.pages_fetched += 1
+            return scraped[model]
+
+        with patch.object(analyzer.scraper, 'search_cars_by_query', side_effect=search) as mock_search:
+            assert scheduler.refresh() == 2
+
+        # Both Camry year bands share one crawl; the budget covers two pages, so BMW waits
+        assert [call.kwargs['model'] for call in mock_search.call_args_list] == ['Camry', 'Civic']
+        assert scheduler.stats() == {'refreshes': 1, 'segments_refreshed': 2, 'segments_skipped': 1}
+        snapshot = analyzer.snapshot
+        assert snapshot.source == 'prewarm'
+        assert {'28car:1', '28car:2'} <= {car.get('fingerprint') for car in snapshot.listings}
+
+    def test_refresh_merges_into_the_snapshot_without_resetting_other_segments(self):
+        analyzer = CarAnalyzer()
+        published = datetime.now() - timedelta(seconds=1700)
+        analyzer.publish([scraped_car(1, 150000), scraped_car(3, 300000, 'BMW', '320i')], published, 'live')
+        tracker = self.tracker({'make': 'Toyota', 'model': 'Camry', 'year': 2020})
+        budget = CrawlBudget(pages_per_hour=10)
+        scheduler = PrewarmScheduler(analyzer, tracker, budget, lead_seconds=300, jitter_seconds=0)
+
+        def search(make, model, max_pages, report):
+            report.pages_fetched += 1
+            return [scraped_car(1, 140000), scraped_car(2, 145000)]
+
+        with patch('app.MARKET_DATA_TTL_SECONDS', 1800), \
+                patch.object(analyzer.scraper, 'search_cars_by_query', side_effect=search):
+            assert scheduler.refresh() == 1
+            snapshot = analyzer.snapshot
+            assert sorted(car['price'] for car in snapshot.listings) == [140000, 145000, 300000]
+            assert snapshot.updated_at == published
+            assert not snapshot.is_stale(segment=('toyota', 'camry'))
+            assert snapshot.segment_updated_at(('bmw', '320i')) == published
+            # The refreshed segment is no longer due, so the next cycle waits instead of crawling again
+            assert scheduler.refresh() == 0
+            assert scheduler.delay() > 1000
+        assert budget.stats()['pages_spent'] == 1
+
+    def test_listings_gone_from_a_refreshed_segment_are_dropped(self):
+        analyzer = CarAnalyzer()
+        analyzer.publish([scraped_car(1, 150000), scraped_car(2, 155000), scraped_car(3, 300000, 'BMW', '320i')],
+                         datetime.now(), 'live')
+        snapshot = analyzer.publish([scraped_car(2, 150000)], datetime.now(), 'prewarm', segments=[('toyota', 'camry')])
+        assert sorted(car['fingerprint'] for car in snapshot.listings) == ['28car:2', '28car:3']  # 1 was sold
+        assert snapshot.stats.lookup('Toyota').count == 1
+        assert snapshot.stats.lookup('BMW').count == 1
+
+    def test_refresh_over_a_persisted_snapshot_decodes_only_its_segment(self, tmp_path):
+        cars = [scraped_car(i, 150000 + i) for i in range(3)]
+        cars += [dict(scraped_car(i, 300000, 'BMW', '320i'), mileage=5000 * i) for i in range(3, 40)]
+        CarAnalyzer(store=SnapshotStore(str(tmp_path))).publish(cars, datetime.now(), 'live')
+        analyzer = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        assert analyzer.warm_start()
+        stored = analyzer.snapshot.listings
+        assert isinstance(stored, StoredListings)
+
+        snapshot = analyzer.publish([scraped_car(1, 140000), scraped_car(50, 145000)], datetime.now(), 'prewarm',
+                                    segments=[('toyota', 'camry')])
+        assert set(stored.rows) == {0, 1, 2}  # The Camrys it replaced; no BMW was decoded
+        assert snapshot.stats.lookup('Toyota').count == 2
+        assert snapshot.stats.lookup('BMW').count == 37
+
+        loaded = SnapshotStore(str(tmp_path)).load()[0]
+        fingerprints = [car['fingerprint'] for car in loaded.listings]
+        assert len(fingerprints) == 39
+        assert '28car:0' not in fingerprints and '28car:2' not in fingerprints
+        bmw = loaded.listings[fingerprints.index('28car:3')]
+        assert loaded.comparables.nearest(bmw, 1)[0][1] is bmw  # Kept partitions point at the same listings
+
+    def test_failed_crawls_charge_only_the_pages_fetched(self):
+        analyzer = CarAnalyzer()
+        budget = CrawlBudget(pages_per_hour=10)
+        scheduler = PrewarmScheduler(analyzer, self.tracker({'make': 'Toyota', 'model': 'Camry', 'year': 2020}), budget)
+        with patch.object(analyzer.scraper, 'search_cars_by_query', side_effect=requests.exceptions.ConnectionError):
+            assert scheduler.refresh() == 0
+        assert budget.stats()['pages_spent'] == 0
+
+    def test_nothing_published_without_demand(self):
+        analyzer = CarAnalyzer()
+        with patch.object(analyzer.scraper, 'search_cars_by_query') as mock_search:
+            assert PrewarmScheduler(analyzer, DemandTracker()).refresh() == 0
+        assert not mock_search.called
+        assert analyzer.snapshot.listings is None
+
+    def test_refresh_is_due_ahead_of_expiry(self):
+        analyzer = CarAnalyzer()
+        scheduler = PrewarmScheduler(analyzer, DemandTracker(), lead_seconds=300, jitter_seconds=0)
+        assert scheduler.delay() == 0.0  # No data yet
+
+        analyzer.publish([scraped_car(1, 150000)], datetime.now() - timedelta(seconds=600), 'live')
+        with patch('app.MARKET_DATA_TTL_SECONDS', 1800):
+            assert 890 < scheduler.delay() <= 900
@@ -0,0 +1,803 @@
+"""
+Tests for precomputed market statistics used by price analysis
+"""
+
+import json
+import numpy as np
+import pytest
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import app as app_module
+from app import Canonicalizer, CarAnalyzer, ComparablesIndex, ComparablesPartition, KDTree, KNN_K, ListingIndex, ListingSpool, ListingPostings, MarketSnapshot, MarketStatsIndex, ModelRefitter, PriceModel, PriceTrends, SnapshotStore, QuantileSketch, SegmentSketches, SegmentStats, SEGMENT_MIN_LISTINGS
+
+
+def make_car(price, make='Toyota', model='Camry', year=2020, is_mock_data=True):
+    return {'make': make, 'model': model, 'year': year, 'price': price, 'mileage': 50000,
+            'fuel_type': 'petrol', 'transmission': 'automatic', 'seats': 5, 'is_mock_data': is_mock_data}
+
+
+class TestSegmentStats:
+    """Sorted-array aggregates for a single segment"""
+
+    def test_summary_matches_numpy(self):
+        prices = [120000, 95000, 180000, 95000, 150000]
+        stats = SegmentStats().updated(added=prices)
+        summary = stats.summary()
+
+        assert summary['count'] == 5
+        assert summary['average'] == pytest.approx(np.mean(prices))
+        assert summary['median'] == pytest.approx(np.median(prices))
+        assert summary['min'] == 95000
+        assert summary['max'] == 180000
+
+    def test_remove_handles_duplicates(self):
+        stats = SegmentStats().updated(added=[100, 200, 200, 200, 300])
+        stats = stats.updated(removed=[200, 200, 300])
+
+        assert list(stats.prices) == [100, 200]
+        assert stats.total == pytest.approx(300)
+
+    def test_updates_do_not_mutate_original(self):
+        original = SegmentStats().updated(added=[100, 200])
+        original.updated(added=[300], removed=[100])
+        assert list(original.prices) == [100, 200]
+
+    def test_rank_queries_use_sorted_order(self):
+        prices = [300, 100, 200, 200, 400]
+        stats = SegmentStats.from_prices(prices)
+
+        assert list(stats.prices) == [100, 200, 200, 300, 400]
+        assert stats.rank(200) == (1, 2)
+        assert stats.rank(50) == (0, 5)
+        assert stats.rank(500) == (5, 0)
+        assert stats.percentile_rank(200) == pytest.approx(40)
+        assert stats.percentile_rank(500) == 100
+
+    def test_even_count_median(self):
+        stats = SegmentStats().updated(added=[100, 200, 300, 400])
+        assert stats.summary()['median'] == 250
+
+
+class TestMarketStatsIndex:
+    """Segment and roll-up aggregates maintained at ingest time"""
+
+    def test_rollups(self):
+        index = MarketStatsIndex()
+        index.apply(added=[
+            make_car(100000, model='Camry', year=2020),
+            make_car(120000, model='Camry', year=2020, is_mock_data=False),
+            make_car(90000, model='Corolla', year=2020),
+            make_car(80000, model='Corolla', year=2018),
+        ])
+
+        assert index.lookup('Toyota', 'Camry', 2020).count == 2
+        assert index.lookup('Toyota', 'Camry', 2020).scraped_count == 1
+        assert index.lookup('toyota', year=2020).count == 3
+        assert index.lookup('TOYOTA').count == 4
+        assert index.lookup('Honda') is None
+
+    def test_expired_listings_are_removed(self):
+        index = MarketStatsIndex()
+        old = make_car(100000, model='Wish', year=2015)
+        index.apply(added=[old, make_car(110000, year=2015)])
+        index.apply(removed=[old])
+
+        assert index.lookup('Toyota', 'Wish', 2015) is None
+        assert index.lookup('Toyota', year=2015).count == 1
+
+    def test_invalid_prices_are_ignored(self):
+        index = MarketStatsIndex()
+        index.apply(added=[make_car(None), make_car(0), make_car(float('nan')), make_car(50000)])
+        assert index.lookup('Toyota').count == 1
+
+
+class TestMarketSnapshot:
+    """Market data is published as immutable, versioned snapshots"""
+
+    def test_snapshot_is_immutable(self):
+        snapshot = MarketSnapshot(1, [make_car(100000)])
+        assert isinstance(snapshot.listings, tuple)
+        with pytest.raises(AttributeError):
+            snapshot.version = 2
+
+    def test_publish_swaps_in_new_version(self):
+        analyzer = CarAnalyzer()
+        first = analyzer.publish([make_car(100000)], datetime.now(), 'mock_data')
+        second = analyzer.publish([make_car(200000)], datetime.now(), 'mock_data')
+
+        assert second.version == first.version + 1
+        assert analyzer.snapshot is second
+        # A reader still holding the old snapshot keeps a consistent view
+        assert first.stats.lookup('Toyota', 'Camry', 2020).summary()['average'] == 100000
+        assert second.stats.lookup('Toyota', 'Camry', 2020).summary()['average'] == 200000
+
+    def test_market_data_is_the_snapshot_tuple(self):
+        analyzer = CarAnalyzer()
+        analyzer.publish([make_car(100000)], datetime.now(), 'mock_data')
+        assert analyzer.market_data is analyzer.snapshot.listings
+
+    def test_sketches_and_trends_are_versioned_with_the_snapshot(self):
+        analyzer = CarAnalyzer()
+        first = analyzer.publish([make_car(100000 + i, is_mock_data=False) for i in range(20)], datetime.now(), 'live')
+        second = analyzer.publish([make_car(200000 + i, make='Honda', model='Fit', is_mock_data=False)
+                                   for i in range(20)], datetime.now(), 'live')
+
+        assert analyzer.sketches is second.sketches and analyzer.trends is second.trends
+        assert first.sketches.lookup('Honda', min_count=1) == (None, None)
+        assert first.trends.trend(make_car(1, make='Honda', model='Fit'))['sample_size'] == 0
+        assert second.trends.trend(make_car(1, make='Honda', model='Fit'))['sample_size'] == 20
+        # Segments the second refresh didn't touch are shared, not copied
+        assert second.sketches.sketches[('make', 'toyota')] is first.sketches.sketches[('make', 'toyota')]
+
+    def test_evolve_leaves_original_index_untouched(self):
+        index = MarketStatsIndex()
+        index.apply(added=[make_car(100000)])
+        evolved = index.evolve(added=[make_car(200000, make='Honda', model='Fit')])
+
+        assert index.lookup('Honda') is None
+        assert evolved.lookup('Honda').count == 1
+        assert evolved.segments[('make', 'toyota')] is index.segments[('make', 'toyota')]
+
+    def test_similarity_scan_does_not_mutate_listings(self):
+        analyzer = CarAnalyzer()
+        listings = [make_car(100000 + i) for i in range(5)]
+        similar = analyzer.find_similar_cars(make_car(100000), listings)
+
+        assert similar and all('similarity_score' in car for car in similar)
+        assert not any('similarity_score' in car for car in listings)
+
+    def test_version_reported_in_analysis(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = [make_car(100000 + i) for i in range(5)]
+        analyzer.last_update = datetime.now()
+
+        result = analyzer.analyze_price(make_car(100000))
+        assert result['marketDataVersion'] == analyzer.snapshot.version
+
+
+def dated_car(price, days_ago, today, date_basis='listed', **kwargs):
+    car = make_car(price, is_mock_data=False, **kwargs)
+    car['date_listed'] = (datetime.fromordinal(today) - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+    car['date_basis'] = date_basis
+    return car
+
+
+class TestPriceTrends:
+    """Rolling-window trends maintained per segment as listings arrive"""
+
+    today = datetime(2025, 7, 1).toordinal()
+
+    def rising_market(self, monthly_pct=3.0, days=60, per_day=3):
+        growth = (1 + monthly_pct / 100) ** (1 / 30)
+        return [dated_car(100000 * growth ** (days - ago) * (1 + 0.001 * i), ago, self.today)
+                for ago in range(days) for i in range(per_day)]
+
+    def test_slope_and_direction(self):
+        trends = PriceTrends()
+        trends.ingest(self.rising_market(), today=self.today)
+        trend = trends.trend(make_car(100000), today=self.today)
+
+        assert trend['segment'] == 'make_model_year'
+        assert trend['direction'] == 'increasing'
+        assert trend['slopePctPerMonth'] == pytest.approx(3.0, abs=0.1)
+        assert trend['volatility'] == 'low'
+        assert 0 < trend['confidence'] <= 1
+
+    def test_window_volumes(self):
+        trends = PriceTrends()
+        trends.ingest(self.rising_market(days=60, per_day=2), today=self.today)
+        windows = trends.trend(make_car(100000), today=self.today)['windows']
+
+        assert windows['7d']['volume'] == 14
+        assert windows['30d']['volume'] == 60
+        assert windows['90d']['volume'] == 120
+        assert windows['7d']['median'] > windows['90d']['median']
+
+    def test_windows_roll_forward_and_old_listings_drop(self):
+        trends = PriceTrends()
+        trends.ingest([dated_car(100000, 80, self.today), dated_car(100000, 100, self.today)], today=self.today)
+        assert trends.trend(make_car(100000), today=self.today)['sample_size'] == 1
+        assert trends.trend(make_car(100000), today=self.today + 20)['sample_size'] == 0
+
+    def test_single_day_has_no_slope(self):
+        trends = PriceTrends()
+        trends.ingest([dated_car(100000 + i, 0, self.today) for i in range(20)], today=self.today)
+        trend = trends.trend(make_car(100000), today=self.today)
+
+        assert trend['slopePctPerMonth'] is None
+        assert trend['direction'] == 'stable'
+        assert trend['confidence'] == 0.0
+
+    def test_rolled_windows_match_a_fresh_series(self):
+        trends = PriceTrends()
+        trends.ingest(self.rising_market(days=60, per_day=2), today=self.today)
+        trends.trend(make_car(1), today=self.today)
+        trends.ingest([dated_car(150000, 0, self.today + 10)], today=self.today + 10)
+
+        fresh = PriceTrends()
+        fresh.ingest(self.rising_market(days=60, per_day=2) + [dated_car(150000, 0, self.today + 10)], today=self.today + 10)
+        assert trends.trend(make_car(1), today=self.today + 10) == fresh.trend(make_car(1), today=self.today + 10)
+
+    def test_mock_listings_are_not_trended(self):
+        trends = PriceTrends()
+        trends.ingest([make_car(100000 + i) for i in range(20)], today=self.today)
+        assert trends.trend(make_car(100000), today=self.today)['sample_size'] == 0
+
+    def test_date_basis_labels_ingest_dated_series(self):
+        trends = PriceTrends()
+        trends.ingest([dated_car(100000, 0, self.today, date_basis='ingested')], today=self.today)
+        assert trends.trend(make_car(1), today=self.today)['dateBasis'] == 'ingested'
+
+        trends.ingest([dated_car(100000, 5, self.today)], today=self.today)
+        assert trends.trend(make_car(1), today=self.today)['dateBasis'] == 'mixed'
+        assert trends.trend(make_car(1), today=self.today + 1)['dateBasis'] == 'mixed'
+        assert PriceTrends().trend(make_car(1), today=self.today)['dateBasis'] is None
+
+    def test_round_trip(self):
+        trends = PriceTrends()
+        trends.ingest(self.rising_market(days=10), today=self.today)
+        restored = PriceTrends.from_dict(trends.to_dict(), today=self.today)
+        assert restored.trend(make_car(1), today=self.today) == trends.trend(make_car(1), today=self.today)
+
+    def test_analysis_reports_trend_windows(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = [make_car(100000 + i * 1000, is_mock_data=False) for i in range(30)]
+        analyzer.last_update = datetime.now()
+
+        trend = analyzer.analyze_price(make_car(110000))['marketTrends']
+        assert trend['dateBasis'] == 'ingested'
+        assert trend['windows']['7d']['volume'] == 30
+        assert trend['sample_size'] == 30
+
+
+def synthetic_market(n=600, seed=3):
+    """Listings whose log price is a known function of age, mileage and make"""
+    rng = np.random.default_rng(seed)
+    make_effect = {'Toyota': 0.0, 'BMW': 0.4, 'Honda': -0.1}
+    cars = []
+    for i in range(n):
+        make = ('Toyota', 'BMW', 'Honda')[i % 3]
+        year = int(rng.integers(2010, 2025))
+        mileage = int(rng.integers(5000, 200000))
+        log_price = 12.5 + make_effect[make] - 0.08 * (2025 - year) - 0.05 * np.log1p(mileage) + rng.normal(0, 0.05)
+        cars.append(dict(make_car(float(np.exp(log_price)), make=make, model='X', year=year),
+                         mileage=mileage, owners=1, engine_cc=2000))
+    return cars
+
+
+class TestPriceModel:
+    """Hedonic least-squares model fitted off the request path"""
+
+    def test_fit_recovers_prices_with_interval(self):
+        cars = synthetic_market()
+        model = PriceModel.fit(cars, reference_year=2025, version=1)
+        assert model.r_squared > 0.9
+
+        holdout = synthetic_market(n=300, seed=11)
+        estimates = [model.predict(car) for car in holdout]
+        errors = [abs(e['price'] - car['price']) / car['price'] for e, car in zip(estimates, holdout)]
+        covered = sum(e['low'] <= car['price'] <= e['high'] for e, car in zip(estimates, holdout))
+        assert np.median(errors) < 0.05
+        assert covered / len(holdout) > 0.8
+        assert estimates[0]['matched'] == 'make_model'
+
+    def test_too_few_listings(self):
+        assert PriceModel.fit(synthetic_market(n=10)) is None
+
+    def test_missing_inputs_use_training_defaults(self):
+        model = PriceModel.fit(synthetic_market(), reference_year=2025)
+        estimate = model.predict({'make': 'Lada', 'model': 'Niva'})
+        assert estimate['matched'] == 'none'
+        assert estimate['low'] < estimate['price'] < estimate['high']
+
+    def test_round_trip(self):
+        model = PriceModel.fit(synthetic_market(), reference_year=2025)
+        restored = PriceModel.from_dict(json.loads(json.dumps(model.to_dict())))
+        car = synthetic_market(n=1, seed=5)[0]
+        assert restored.predict(car) == model.predict(car)
+
+    def test_refitter_fits_each_snapshot_once_and_persists(self, tmp_path):
+        analyzer = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        analyzer.publish(synthetic_market(), datetime.now(), 'mock_data')
+        refitter = ModelRefitter(analyzer)
+
+        model = refitter.refit()
+        assert analyzer.price_model is model
+        assert model.version == analyzer.snapshot.version
+        assert refitter.refit() is None  # Nothing new to fit
+        assert SnapshotStore(str(tmp_path)).load_model().sample_size == model.sample_size
+
+    def test_analysis_and_predict_price_use_model(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = synthetic_market()
+        analyzer.last_update = datetime.now()
+        ModelRefitter(analyzer).refit()
+
+        user_car = dict(make_car(150000, make='BMW', model='X', year=2020), mileage=50000)
+        estimate = analyzer.analyze_price(user_car)['modelEstimate']
+        assert estimate['low'] < estimate['price'] < estimate['high']
+
+        with patch.object(app_module.analyzer, 'price_model', analyzer.price_model):
+            result = app_module.predict_price('BMW', 'X', 2020, 50000)
+        assert result['model'] == 'hedonic'
+        assert result['predicted_price'] == analyzer.price_model.predict(
+            {'make': 'BMW', 'model': 'X', 'year': 2020, 'mileage': 50000})['price']
+        assert result['factors']['mileage_adjustment'] > 0  # Below-median mileage adds value
+
+
+class TestSnapshotStore:
+    """Snapshots persist to a columnar file and warm-start new processes"""
+
+    def test_round_trip_preserves_listings(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        listings = [make_car(100000), make_car(125000.5, make='Honda', model='Fit', is_mock_data=False)]
+        listings[1].pop('seats')
+        listings[1].update(detail_url='https://example.com/honda-fit', features=['sunroof', 'camera'])
+        store.save(MarketSnapshot(7, listings, MarketStatsIndex().evolve(added=listings), datetime(2025, 7, 1, 12, 0),
+                                  'live', ComparablesIndex().evolve(added=listings)))
+
+        snapshot, sketches, trends = store.load()
+        assert snapshot.version == 7
+        assert snapshot.updated_at == datetime(2025, 7, 1, 12, 0)
+        assert list(snapshot.listings) == listings  # Fields outside the declared columns come back too
+        assert snapshot.stats.lookup('Honda').count == 1
+        assert sketches is None
+
+    def test_spooled_listings_are_written_once(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        listings = [make_car(100000), dict(make_car(125000.5, make='Honda', model='Fit'), features=['camera'])]
+        spool = ListingSpool(str(tmp_path))
+        for car in listings:
+            spool.add(car)
+        stored = store.write_listings(spool, 3)
+        spool.close()
+        assert list(stored.scan()) == listings and not stored.rows
+
+        stats = MarketStatsIndex()
+        stats.apply(added=stored.scan())
+        store.save(MarketSnapshot(3, stored, stats, source='worker', comparables=ComparablesIndex.from_listings(stored)))
+        assert list(store.load()[0].listings) == listings
+        assert len(list(tmp_path.glob('market-snapshot-*.npy'))) == 1  # Saving reused the spooled columns
+
+    def test_load_reads_rows_lazily_and_reuses_stored_indexes(self, tmp_path):
+        analyzer = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        analyzer.publish([make_car(100000 + i * 1000, is_mock_data=False) for i in range(30)], datetime.now(), 'live')
+
+        with patch.object(ComparablesPartition, 'build', side_effect=AssertionError), \
+                patch.object(KDTree, '__init__', side_effect=AssertionError):
+            snapshot = SnapshotStore(str(tmp_path)).load()[0]
+            assert len(snapshot.listings.rows) == 0  # Nothing decoded until a listing is read
+            assert snapshot.stats.lookup('Toyota', 'Camry', 2020).count == 30
+            neighbours = snapshot.comparables.nearest(make_car(110000), 10)
+        assert len(neighbours) == 10
+        assert all(car['make'] == 'Toyota' for _, car in neighbours)
+        assert len(snapshot.listings.rows) == 10
+        assert snapshot.postings.tables['make'][analyzer.snapshot.postings.make_ids[0]].tolist() == list(range(30))
+
+    def test_missing_store_is_not_an_error(self, tmp_path):
+        assert SnapshotStore(str(tmp_path / 'empty')).load() is None
+        assert CarAnalyzer(store=SnapshotStore(str(tmp_path / 'empty'))).warm_start() is False
+
+    def test_refresh_is_persisted_and_warm_starts_next_process(self, tmp_path):
+        first = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        first.publish([make_car(100000 + i * 1000, is_mock_data=False) for i in range(30)], datetime.now(), 'live')
+
+        second = CarAnalyzer(store=SnapshotStore(str(tmp_path)))
+        assert second.warm_start() is True
+        assert second.snapshot.version == first.snapshot.version
+
+        with patch.object(second.scraper, 'search_cars_by_query') as mock_search:
+            result = second.analyze_price(make_car(110000))
+        assert not mock_search.called
+        assert result['degradation']['path'] == 'cache'
+        assert result['priceDistribution']['sampleSize'] == 30
+
+    def test_older_snapshot_never_overwrites_newer(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        store.save(MarketSnapshot(5, [make_car(200000)], source='live'))
+        store.save(MarketSnapshot(4, [make_car(100000)], source='live'))
+        assert store.load()[0].version == 5
+
+    def test_old_column_files_are_pruned(self, tmp_path):
+        store = SnapshotStore(str(tmp_path))
+        for version in range(1, 5):
+            store.save(MarketSnapshot(version, [make_car(100000)], source='live'))
+        assert len(list(tmp_path.glob('market-snapshot-*.npy'))) == 2
+        assert len(list(tmp_path.glob('market-snapshot-*.npz'))) == 2
+
+
+class TestComparablesIndex:
+    """k-d tree comparables per make/model, updated copy-on-write"""
+
+    def test_tree_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        points = rng.normal(size=(2000, 4))
+        tree = KDTree(points, leaf_size=16, brute_force_max=0)  # Force a deep tree
+        for _ in range(20):
+            query = rng.normal(size=4)
+            distances, ids = tree.query(query, 15)
+            expected = np.sort(((points - query) ** 2).sum(axis=1))[:15]
+            assert np.allclose(distances, expected)
+            assert np.allclose(((points[ids] - query) ** 2).sum(axis=1), distances)
+
+    def test_nearest_by_year_and_mileage(self):
+        cars = [dict(make_car(100000, year=year), mileage=mileage)
+                for year in range(2010, 2022) for mileage in range(0, 100000, 10000)]
+        index = ComparablesIndex().evolve(added=cars)
+        user_car = dict(make_car(100000, year=2018), mileage=30000)
+
+        neighbours = index.nearest(user_car, 3, reference_price=100000)
+        assert [distance for distance, _ in neighbours] == [0, 0.25, 0.25]  # 10,000 km is a quarter unit
+        assert all(car['year'] == 2018 and abs(car['mileage'] - 30000) <= 10000 for _, car in neighbours)
+        assert index.nearest(make_car(100000, make='Honda', model='Fit'), 10) is None
+
+    def test_incremental_updates_share_tree_until_rebuild(self):
+        base = [make_car(100000 + i * 100, year=2015 + i % 8) for i in range(400)]
+        index = ComparablesIndex().evolve(added=base)
+        partition = index.partitions[('toyota', 'camry')]
+
+        newest = make_car(250000, year=2024)
+        updated = index.evolve(added=[newest], removed=base[:3])
+        changed = updated.partitions[('toyota', 'camry')]
+        assert changed.tree is partition.tree
+        assert len(changed) == 398
+        assert len(partition) == 400  # Older index unchanged
+        found = [car for _, car in updated.nearest(newest, KNN_K, reference_price=250000)]
+        assert newest in found
+        assert not any(car is removed for car in found for removed in base[:3])
+
+        rebuilt = updated.evolve(added=[make_car(120000) for _ in range(200)])
+        assert rebuilt.partitions[('toyota', 'camry')].tree is not partition.tree
+        assert len(rebuilt.partitions[('toyota', 'camry')]) == 598
+
+    def test_sparse_year_uses_nearest_neighbours(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = [make_car(100000 + i * 500, year=2010 + i % 10) for i in range(60)]
+        analyzer.last_update = datetime.now()
+
+        with patch.object(analyzer, 'find_similar_cars') as mock_scan:
+            result = analyzer.analyze_price(make_car(110000, year=2015))
+        assert not mock_scan.called
+        assert result['comparableSource'] == 'nearest_neighbours'
+        assert result['marketPrice']['count'] == KNN_K
+
+
+class TestListingPostings:
+    """Posting lists prune similarity scoring without changing its results"""
+
+    def random_market(self, n, rng):
+        makes = [('Toyota', 'Camry'), ('Toyota', 'Corolla'), ('Honda', 'Civic'), ('BMW', '3 Series'),
+                 ('Mercedes-Benz', 'C200'), ('Tesla', 'Model 3'), ('Kia', 'Sorento')]
+        cars = []
+        for _ in range(n):
+            make, model = makes[rng.integers(len(makes))]
+            cars.append({'make': make, 'model': model, 'year': int(rng.integers(2000, 2026)),
+                         'price': int(rng.integers(30000, 600000)), 'mileage': int(rng.integers(0, 200000)),
+                         'fuel_type': str(rng.choice(['petrol', 'diesel', 'hybrid', 'electric', ''])),
+                         'transmission': str(rng.choice(['automatic', 'manual'])), 'seats': int(rng.choice([4, 5, 7]))})
+        return cars
+
+    @pytest.mark.parametrize('seed', range(5))
+    def test_matches_full_scan(self, seed):
+        rng = np.random.default_rng(seed)
+        analyzer = CarAnalyzer()
+        market = tuple(self.random_market(int(rng.integers(20, 400)), rng))
+        postings = ListingPostings(market)
+        users = self.random_market(40, rng) + [dict(make_car(100000), make='Lada', model='Niva', year=1995)]
+        for user in users:
+            assert analyzer.find_similar_cars(user, market, postings) == analyzer.find_similar_cars(user, list(market))
+
+    def test_candidates_by_tier(self):
+        market = [make_car(100000, year=2020), make_car(100000, make='Honda', model='Fit', year=2016),
+                  make_car(100000, make='Honda', model='Fit', year=2005), dict(make_car(1), year=None)]
+        postings = ListingPostings(market)
+        user = make_car(100000, year=2020)
+
+        assert postings.candidates(user, 1).tolist() == [0, 3]  # Make matches plus the unindexable listing
+        assert postings.candidates(user, 2).tolist() == [0, 1, 3]  # Honda 2016 is within 8 years
+        assert postings.candidates(user, 3) is None
+
+    def test_snapshot_postings_are_used(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = [make_car(100000 + i) for i in range(12)] + [
+            make_car(50000, make='Honda', model='Fit', year=1990)]
+        snapshot = analyzer.snapshot
+        with patch.object(snapshot.postings, 'candidates', wraps=snapshot.postings.candidates) as mock_candidates:
+            similar = analyzer.find_similar_cars(make_car(100000), snapshot.listings)
+        assert mock_candidates.called
+        assert len(similar) == 12
+
+
+class TestListingIndex:
+    """Listing queries match a plain filter-and-sort, page by page"""
+
+    def reference(self, market, filters, sort):
+        def passes(car):
+            if filters.get('make') and car['make'] != filters['make']:
+                return False
+            if filters.get('fuel_type') and car['fuel_type'] != filters['fuel_type']:
+                return False
+            for field in ('price', 'year', 'mileage'):
+                low, high = filters.get(f'{field}_min'), filters.get(f'{field}_max')
+                if (low is not None and car[field] < low) or (high is not None and car[field] > high):
+                    return False
+            return True
+
+        field, sign = sort.lstrip('-'), -1 if sort.startswith('-') else 1
+        return sorted((position for position, car in enumerate(market) if passes(car)),
+                      key=lambda position: (sign * market[position][field], position))
+
+    def pages(self, index, filters, sort, limit):
+        positions, cursor = [], None
+        while True:
+            page, more = index.query(filters, sort, limit, cursor)
+            positions.extend(page)
+            if not more:
+                return positions
+            cursor = (index.sort_key(sort, page[-1]), page[-1])
+
+    @pytest.mark.parametrize('seed', range(4))
+    def test_pages_match_reference(self, seed):
+        rng = np.random.default_rng(seed)
+        market = TestListingPostings().random_market(int(rng.integers(50, 3000)), rng)
+        # A rare make is answered from its posting list rather than by walking the sort order
+        market = tuple(market + [dict(car, make='Lada') for car in market[:7]])
+        index = ListingIndex(market, ListingPostings(market))
+        queries = [{}, {'make': 'Toyota'}, {'make': 'Kia', 'year_min': 2010, 'price_max': 300000},
+                   {'fuel_type': 'hybrid', 'mileage_max': 80000}, {'make': 'Lada'}, {'make': 'Lada', 'price_min': 100000}]
+        for filters in queries:
+            for sort in ('price', '-price', 'year', '-mileage'):
+                limit = int(rng.integers(1, 40))
+                assert self.pages(index, filters, sort, limit) == self.reference(market, filters, sort)
+
+    def test_model_filter_uses_canonical_names(self):
+        market = (make_car(100000, make='BMW', model='3 Series'), make_car(90000, make='寶馬', model='3系'),
+                  make_car(80000, make='BMW', model='5 Series'))
+        index = ListingIndex(market, ListingPostings(market))
+        assert index.query({'make': 'bmw', 'model': '3系'}, 'price')[0] == [1, 0]
+
+    def test_missing_values_sort_last(self):
+        market = (make_car(100000), dict(make_car(None), price=None), make_car(90000))
+        index = ListingIndex(market, ListingPostings(market))
+        assert index.query({}, 'price')[0] == [2, 0, 1]
+        assert index.query({}, '-price')[0] == [0, 2, 1]
+        assert index.query({'price_min': 0}, 'price')[0] == [2, 0]
+
+
+class TestListingsEndpoint:
+    """GET /api/listings filters, sorts and pages through the current snapshot"""
+
+    @pytest.fixture
+    def client(self):
+        analyzer = CarAnalyzer()
+        analyzer.publish([make_car(100000 + 1000 * i, year=2010 + i % 10) for i in range(30)]
+                         + [make_car(50000, make='Honda', model='Civic')], datetime.now(), 'live')
+        with patch.object(app_module, 'analyzer', analyzer):
+            yield app_module.app.test_client()
+
+    def test_cursor_pagination(self, client):
+        response = client.get('/api/listings?make=Toyota&year_min=2015&sort=-price&limit=10')
+        body = response.get_json()
+        assert response.status_code == 200
+        assert body['count'] == 10
+        assert [car['price'] for car in body['listings']][:2] == [129000, 128000]
+
+        prices = [car['price'] for car in body['listings']]
+        while body['nextCursor']:
+            body = client.get(f"/api/listings?make=Toyota&year_min=2015&sort=-price&limit=10"
+                              f"&cursor={body['nextCursor']}").get_json()
+            prices.extend(car['price'] for car in body['listings'])
+        assert prices == sorted((100000 + 1000 * i for i in range(30) if i % 10 >= 5), reverse=True)
+
+    @pytest.mark.parametrize('query', ['sort=color', 'limit=0', 'limit=x', 'price_min=cheap', 'cursor=garbage'])
+    def test_invalid_parameters(self, client, query):
+        response = client.get(f'/api/listings?{query}')
+        assert response.status_code == 400
+        assert 'error' in response.get_json()
+
+    def test_cursor_is_tied_to_its_sort(self, client):
+        cursor = client.get('/api/listings?limit=5').get_json()['nextCursor']
+        assert client.get(f'/api/listings?sort=year&cursor={cursor}').status_code == 400
+
+    def test_queries_never_load_market_data(self):
+        analyzer = CarAnalyzer()
+        with patch.object(app_module, 'analyzer', analyzer), patch.object(analyzer, 'load_market_data') as load:
+            body = app_module.app.test_client().get('/api/listings').get_json()
+        assert not load.called
+        assert body['listings'] == [] and analyzer.snapshot.listings is None
+
+    def test_index_is_built_after_publish(self):
+        analyzer = CarAnalyzer()
+        builder = analyzer.start_index_builds()
+        try:
+            snapshot = analyzer.publish([make_car(100000 + i) for i in range(5)], datetime.now(), 'live')
+            deadline = time.monotonic() + 5
+            while builder.built_version != snapshot.version and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert snapshot.query_index is not None
+            assert set(snapshot.query_index.orders) == {'price', '-price', 'year', '-year', 'mileage', '-mileage'}
+        finally:
+            builder.stop()
+
+
+class TestCanonicalizer:
+    """Raw make/model spellings resolve to one canonical key and id"""
+
+    def test_aliases_and_spelling_variants(self):
+        names = Canonicalizer()
+        assert names.make('平治') == names.make('Mercedes Benz') == names.make('mercedes-benz') == 'mercedesbenz'
+        assert names.model('Mercedes-Benz', 'CLA 250') == names.model('Benz', 'cla250') == 'cla250'
+        assert names.model('寶馬', '3系') == names.model('BMW', '3 Series') == '3series'
+        assert names.model('Toyota', '3系') == '3系'  # Model aliases only apply within their make
+        assert names.make(None) == '' and names.make(2020) == '2020'
+
+    def test_ids_are_interned_and_memoized(self):
+        names = Canonicalizer()
+        assert names.make_id('BMW') == names.make_id('寶馬') != names.make_id('Audi')
+        assert names.model_id('BMW', '3 Series') == names.model_id('bmw', '3系') != names.model_id('BMW', '5 Series')
+        before = names.cache_info()['make_id']['hits']
+        names.make_id('寶馬')
+        assert names.cache_info()['make_id']['hits'] == before + 1
+
+    def test_similarity_and_segments_match_across_spellings(self):
+        market = [make_car(250000 + i, make='Mercedes-Benz', model='CLA250') for i in range(SEGMENT_MIN_LISTINGS)]
+        user = make_car(250000, make='平治', model='CLA 250')
+        analyzer = CarAnalyzer()
+
+        similar = analyzer.find_similar_cars(user, market)
+        assert len(similar) == len(market)
+        assert all(car['similarity_score'] == 120 for car in similar)  # Make + model + year + fuel + gearbox + seats
+        assert similar == analyzer.find_similar_cars(user, market, ListingPostings(market))
+
+        analyzer.market_data = market
+        assert analyzer.segment_stats.lookup('Benz', 'cla-250', 2020).count == SEGMENT_MIN_LISTINGS
+
+
+class TestAnalyzerSegmentPath:
+    """Analysis against a well-populated segment uses the aggregates"""
+
+    def test_market_data_assignment_updates_aggregates_incrementally(self):
+        analyzer = CarAnalyzer()
+        kept = make_car(100000)
+        analyzer.market_data = [kept, make_car(200000)]
+        assert analyzer.segment_stats.lookup('Toyota', 'Camry', 2020).count == 2
+
+        with patch.object(MarketStatsIndex, 'evolve', autospec=True, side_effect=MarketStatsIndex.evolve) as mock_evolve:
+            analyzer.market_data = [kept, make_car(300000)]
+        added, removed = mock_evolve.call_args.kwargs['added'], mock_evolve.call_args.kwargs['removed']
+        assert len(added) == 1 and len(removed) == 1
+
+        stats = analyzer.segment_stats.lookup('Toyota', 'Camry', 2020)
+        assert sorted(stats.prices) == [100000, 300000]
+
+        analyzer.market_data = None
+        assert analyzer.segment_stats.lookup('Toyota') is None
+
+    def test_populated_segment_skips_similarity_scan(self):
+        analyzer = CarAnalyzer()
+        prices = [100000 + i * 1000 for i in range(SEGMENT_MIN_LISTINGS + 5)]
+        analyzer.market_data = [make_car(p) for p in prices] + [make_car(50000, make='Honda', model='Fit')]
+        analyzer.last_update = datetime.now()
+
+        user_car = make_car(110000)
+        with patch.object(analyzer, 'find_similar_cars') as mock_scan:
+            result = analyzer.analyze_price(user_car)
+
+        assert not mock_scan.called
+        assert result['comparableSource'] == 'segment_stats'
+        assert result['marketPrice']['count'] == len(prices)
+        assert result['marketPrice']['average'] == pytest.approx(np.mean(prices))
+        assert result['marketPrice']['median'] == pytest.approx(np.median(prices))
+        assert result['marketComparison']['lowerPriced'] == sum(1 for p in prices if p < 110000)
+        assert result['marketComparison']['higherPriced'] == sum(1 for p in prices if p > 110000)
+
+    def test_sparse_segment_uses_similarity_scan(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = [make_car(100000 + i) for i in range(3)]
+        analyzer.last_update = datetime.now()
+
+        result = analyzer.analyze_price(make_car(100000))
+        assert result['comparableSource'] == 'similarity_scan'
+
+    def test_similarity_scan_comparison_and_percentile(self):
+        analyzer = CarAnalyzer()
+        prices = [90000, 100000, 100000, 110000, 120000]
+        analyzer.market_data = [make_car(p) for p in prices]
+        analyzer.last_update = datetime.now()
+
+        result = analyzer.analyze_price(make_car(100000))
+        comparison = result['marketComparison']
+        assert comparison['lowerPriced'] == 1
+        assert comparison['higherPriced'] == 2
+        assert comparison['similarPriced'] == 2
+        assert comparison['percentileRank'] == pytest.approx(40)
+        assert result['marketPrice']['median'] == 100000
+        assert result['marketPrice']['min'] == 90000
+        assert result['marketPrice']['max'] == 120000
+
+
+class TestQuantileSketch:
+    """t-digest quantiles stay close to exact values in bounded memory"""
+
+    def test_quantiles_are_accurate(self):
+        rng = np.random.default_rng(42)
+        prices = rng.lognormal(12, 0.4, 20000)
+        sketch = QuantileSketch()
+        for price in prices:
+            sketch.update(price)
+
+        assert len(sketch.centroids()[0]) < 200
+        for q in (0.1, 0.25, 0.5, 0.75, 0.9):
+            assert sketch.quantile(q) == pytest.approx(np.quantile(prices, q), rel=0.01)
+        assert sketch.percentile_of(np.quantile(prices, 0.75)) == pytest.approx(75, abs=1)
+
+    def test_merge_matches_single_sketch(self):
+        rng = np.random.default_rng(7)
+        prices = rng.normal(200000, 30000, 8000)
+        shards = [QuantileSketch() for _ in range(4)]
+        for i, price in enumerate(prices):
+            shards[i % 4].update(price)
+
+        merged = QuantileSketch()
+        for shard in shards:
+            merged.merge(shard)
+
+        assert merged.count == len(prices)
+        assert merged.min == prices.min() and merged.max == prices.max()
+        assert merged.quantile(0.5) == pytest.approx(np.median(prices), rel=0.01)
+
+    def test_round_trip(self):
+        sketch = QuantileSketch()
+        for price in range(1000, 2000):
+            sketch.update(price)
+        restored = QuantileSketch.from_dict(sketch.to_dict())
+        assert restored.quantile(0.9) == sketch.quantile(0.9)
+        assert restored.count == sketch.count
+
+    def test_empty_sketch(self):
+        assert QuantileSketch().quantile(0.5) is None
+        assert QuantileSketch().percentile_of(100) is None
+
+
+class TestSegmentSketches:
+    """Per-segment sketches roll up when a segment is sparse"""
+
+    def test_rolls_up_to_broader_segment(self):
+        sketches = SegmentSketches()
+        sketches.ingest([make_car(100000 + i, model='Corolla', is_mock_data=False) for i in range(30)])
+        sketches.ingest([make_car(150000, model='Camry', is_mock_data=False)])
+
+        level, sketch = sketches.lookup('Toyota', 'Camry', 2020)
+        assert level == 'make_year'
+        assert sketch.count == 31
+
+        distribution = sketches.distribution(make_car(100015, model='Corolla'))
+        assert distribution['segment'] == 'make_model_year'
+        assert 40 <= distribution['userPercentile'] <= 60
+        assert distribution['p10'] <= distribution['median'] <= distribution['p90']
+
+    def test_merge_across_workers(self):
+        first, second = SegmentSketches(), SegmentSketches()
+        first.ingest([make_car(100000 + i, is_mock_data=False) for i in range(20)])
+        second.ingest([make_car(200000 + i, is_mock_data=False) for i in range(20)])
+
+        merged = SegmentSketches.from_dict(first.to_dict()).merge(second)
+        assert merged.lookup('Toyota', 'Camry', 2020)[1].count == 40
+
+    def test_mock_listings_are_not_sketched(self):
+        sketches = SegmentSketches()
+        for _ in range(3):  # Every refresh regenerates the mock listings
+            sketches.ingest([make_car(100000 + i) for i in range(20)] + [make_car(150000, is_mock_data=False)])
+
+        assert sketches.lookup('Toyota', 'Camry', 2020, min_count=1)[1].count == 3
+
+    def test_analysis_reports_price_position(self):
+        analyzer = CarAnalyzer()
+        analyzer.market_data = [make_car(100000 + i * 1000, is_mock_data=False) for i in range(40)]
+        analyzer.last_update = datetime.now()
+
+        result = analyzer.analyze_price(make_car(130000))
+        distribution = result['priceDistribution']
+        assert distribution['segment'] == 'make_model_year'
+        assert distribution['userPercentile'] == pytest.approx(75, abs=5)
@@ -0,0 +1,239 @@
+"""
+Tests for listing page parsing: raw Big5-HKSCS pages, the parser process pool and streamed parsing
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import patch, MagicMock
+
+import pytest
+import requests
+
+import app as app_module
+from app import (CarDataScraper, Deadline, upstream_breaker, listing_fingerprint, SCRAPE_PAGE_ENCODING,
+                 parse_listing_candidates, build_ingestion_pipeline)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def listing_row(vid, text):
+    return f'<tr><td><a href="m_sell_dsp.php?h_vid={vid}">{text}</a></td></tr>'
+
+
+# Two search result pages that both show listing 101
+PAGES = [
+    '<html><table>' + listing_row(101, '豐田 Camry 2020 $150,000') + listing_row(102, '本田 Civic 2019 $120,000')
+    + '</table></html>',
+    '<html><table>' + listing_row(101, '豐田 Camry 2020 $150,000') + listing_row(103, '本田 Accord 2018 $130,000')
+    + '</table></html>',
+]
+
+
+def scrape(scraper):
+    with patch.object(scraper, 'fetch_page') as mock_fetch, patch('app.time.sleep'):
+        mock_fetch.side_effect = [MagicMock(content=page.encode(SCRAPE_PAGE_ENCODING)) for page in PAGES]
+        return scraper.search_cars_by_query(max_pages=2)
+
+
+class TestListingPageParsing:
+    """Raw Big5-HKSCS page bytes are parsed without decoding them to str first"""
+
+    def parse(self, html):
+        return CarDataScraper().parse_listing_page(html.encode(SCRAPE_PAGE_ENCODING))
+
+    def test_hkscs_characters_survive_decoding(self):
+        text = '豐田 Camry 2019 $180,000 𨋢'  # 𨋢 is HKSCS-only; plain Big5 drops it
+        cars = self.parse(f'<html><table><tr><td>{text}</td></tr></table></html>')
+
+        assert len(cars) == 1
+        assert cars[0]['make'] == 'Toyota' and cars[0]['price'] == 180000
+        assert cars[0]['fingerprint'] == listing_fingerprint(text)
+
+    def test_listing_divs_when_no_rows_match(self):
+        cars = self.parse('<html><div class="lst_item new"><a onclick="go(\'h_vid=77\')">本田 Civic</a> 2018 '
+                          '$120,000</div><div class="ad">寶馬 X5 $900,000</div></html>')
+
+        assert [(car['make'], car['fingerprint']) for car in cars] == [('Honda', '28car:77')]
+
+    def test_priced_rows_that_are_not_listings_leave_the_fallbacks(self):
+        cars = self.parse('<html><table><tr><td>Parking $5,000 per month</td></tr></table>'
+                          '<div class="car_item">豐田 Camry 2020 $150,000</div></html>')
+
+        assert [(car['make'], car['price']) for car in cars] == [('Toyota', 150000)]
+
+    def test_nested_rows_take_the_enclosing_rows_listing_id(self):
+        rows = ''.join(f'<tr><td><table><tr><td>豐田 Camry 2020 ${150000 + vid:,}</td></tr></table>'
+                       f'<a href="m_sell_dsp.php?h_vid={vid}">詳情</a></td></tr>' for vid in (5, 6))
+        cars = self.parse(f'<html><table>{rows}</table></html>')
+
+        assert [(car['fingerprint'], car['price']) for car in cars] == [('28car:5', 150005), ('28car:6', 150006)]
+
+    def test_price_strings_as_last_resort(self):
+        cars = self.parse('<html><p><b>寶馬 X3</b> 2021 $420,000</p></html>')
+
+        assert [(car['make'], car['model'], car['price']) for car in cars] == [('BMW', 'X3', 420000)]
+
+    def test_empty_body(self):
+        assert CarDataScraper().parse_listing_page(b'') == []
+
+
+class TestParallelParsing:
+    """Pages can be parsed in a process pool that returns listing candidates for the extract stage"""
+
+    def test_worker_returns_listing_candidates(self):
+        candidates = parse_listing_candidates(PAGES[0].encode(SCRAPE_PAGE_ENCODING))
+        assert [listing_id for _, listing_id in candidates] == ['101', '102']
+        assert '$150,000' in candidates[0][0]
+
+    def test_pool_parses_pages_in_order(self):
+        with patch('app.SCRAPE_PARSE_WORKERS', 1), patch('app._parse_pool', None):
+            pool = app_module.get_parse_pool()
+            try:
+                cars = scrape(CarDataScraper())
+            finally:
+                pool.shutdown()
+
+        assert [car['fingerprint'] for car in cars] == ['28car:101', '28car:102', '28car:103']
+        assert cars[0]['make'] == 'Toyota' and cars[0]['price'] == 150000
+
+    def test_pool_workers_parse_pages_at_the_same_time(self):
+        spans = []
+        spans_lock = threading.Lock()
+
+        def slow_parse(content):
+            started = time.monotonic()
+            time.sleep(0.3)
+            with spans_lock:
+                spans.append((started, time.monotonic()))
+            return parse_listing_candidates(content)
+
+        scraper = CarDataScraper()
+        pages = [MagicMock(content=page.encode(SCRAPE_PAGE_ENCODING)) for page in PAGES]
+        pool = ThreadPoolExecutor(2)  # Stands in for the process pool, so the slow parse can be patched in
+        with patch('app.SCRAPE_PARSE_WORKERS', 2), patch('app._parse_pool', pool), \
+                patch('app.parse_listing_candidates', slow_parse), \
+                patch.object(scraper, 'fetch_page', side_effect=lambda url, params, **_: pages[params['h_page'] - 1]):
+            pipeline = build_ingestion_pipeline(scraper, page_pause=(0, 0))
+            cars = list(pipeline.run([(None, None, None, 1), (None, None, None, 2)]))
+        pool.shutdown()
+
+        assert pipeline.stats()['parse']['workers'] == 2
+        assert len(cars) == 3
+        (first_start, first_end), (second_start, second_end) = sorted(spans)
+        assert second_start < first_end  # The second page was parsing before the first had finished
+
+    def test_failed_worker_falls_back_to_inline_parsing(self):
+        failed = Future()
+        failed.set_exception(RuntimeError('worker died'))
+        pool = MagicMock()
+        pool.submit.return_value = failed
+        content = PAGES[1].encode(SCRAPE_PAGE_ENCODING)
+
+        candidates = CarDataScraper().parse_in_pool(pool, content)
+        assert [listing_id for _, listing_id in candidates] == ['101', '103']
+        assert not pool.shutdown.called
+
+    def test_broken_pool_is_replaced(self):
+        broken = MagicMock()
+        broken.submit.side_effect = BrokenProcessPool('a child process terminated abruptly')
+        with patch('app.SCRAPE_PARSE_WORKERS', 1), patch('app._parse_pool', broken):
+            cars = scrape(CarDataScraper())
+            replacement = app_module._parse_pool  # Started for page 2
+            replacement.shutdown()
+        assert replacement not in (None, broken)
+        assert [car['fingerprint'] for car in cars] == ['28car:101', '28car:102', '28car:103']
+        assert broken.shutdown.called
+
+    def test_workers_do_not_fork_the_server(self):
+        with patch('app.SCRAPE_PARSE_WORKERS', 1), patch('app._parse_pool', None):
+            pool = app_module.get_parse_pool()
+            pool.shutdown()
+        assert pool._mp_context.get_start_method() in ('forkserver', 'spawn')
+
+    def test_inline_by_default(self):
+        assert app_module.get_parse_pool() is None
+
+
+class TestStreamingParse:
+    """Listings are emitted as their rows arrive, before the page has finished downloading"""
+
+    def page(self, rows):
+        body = ''.join(listing_row(1000 + i, f'豐田 Camry 𨋢 {2005 + i % 15} ${100000 + i:,}') for i in range(rows))
+        return f'<html><table>{body}</table></html>'.encode(SCRAPE_PAGE_ENCODING)
+
+    def test_first_listing_before_last_chunk(self):
+        content = self.page(500)
+        chunk = 4096
+        fed = []
+
+        def chunks():
+            for start in range(0, len(content), chunk):
+                fed.append(start)
+                yield content[start:start + chunk]
+
+        listings = CarDataScraper().iter_listings(chunks())
+        first = next(listings)
+        assert first['fingerprint'] == '28car:1000'
+        assert len(fed) < len(content) // chunk
+
+        rest = list(listings)
+        assert len(rest) == 499
+        assert rest[-1]['price'] == 100499
+
+    def test_chunks_split_inside_characters(self):
+        content = self.page(50)
+        streamed = CarDataScraper().iter_listings(content[i:i + 7] for i in range(0, len(content), 7))
+        assert [car['fingerprint'] for car in streamed] == [f'28car:{1000 + i}' for i in range(50)]
+
+    def test_streaming_scrape_reads_body_in_chunks(self):
+        response = MagicMock()
+        response.iter_content.return_value = iter([self.page(3)])
+        scraper = CarDataScraper()
+        with patch('app.SCRAPE_STREAMING', True), patch.object(scraper, 'fetch_page', return_value=response) as mock_fetch:
+            cars = scraper.search_cars_by_query(make='Toyota', max_pages=1)
+
+        assert mock_fetch.call_args.kwargs['stream'] is True
+        assert response.close.called
+        assert len(cars) == 3
+
+    def test_body_that_breaks_off_counts_against_the_breaker(self):
+        def chunks():
+            yield self.page(3)[:500]
+            raise requests.exceptions.ConnectionError('connection reset')
+
+        response = MagicMock()
+        response.iter_content.return_value = chunks()
+        scraper = CarDataScraper()
+        with patch('app.SCRAPE_STREAMING', True), patch.object(scraper, 'fetch_page', return_value=response):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                scraper.search_cars_by_query(make='Toyota', max_pages=1)
+
+        assert response.close.called
+        assert upstream_breaker.stats()['error_rate'] == 0.5  # The headers arrived, then the body failed
+        assert upstream_breaker.last_failure == 'error'
+
+    def test_reading_stops_at_the_deadline(self):
+        clock = FakeClock()
+        content = self.page(200)
+
+        def chunks():
+            for start in range(0, len(content), 4096):
+                clock.now += 1
+                yield content[start:start + 4096]
+
+        response = MagicMock()
+        response.iter_content.return_value = chunks()
+        scraper = CarDataScraper()
+        with patch('app.SCRAPE_STREAMING', True), patch.object(scraper, 'fetch_page', return_value=response):
+            cars = scraper.search_cars_by_query(make='Toyota', max_pages=1, deadline=Deadline(3, clock=clock))
+
+        assert response.close.called
+        assert 0 < len(cars) < 200
@@ -0,0 +1,32 @@
+"""
+Tests for the 28car search parameters read from the search catalog
+"""
+
+from app import CarDataScraper, SearchCatalog, search_catalog
+
+
+class TestSearchCatalog:
+    """Brand codes and filter parameter names come from the catalog file"""
+
+    def test_catalogued_makes_filter_by_code(self):
+        url, params = CarDataScraper().search_request('Toyota', 'Camry', 2020, page=2)
+        assert url.endswith('/m_sell_lst.php')
+        assert params == {'h_page': 2, 'h_sort': '7', 'h_srh': 'Camry', 'h_f_mk': '53', 'h_f_yr': '2020'}
+
+    def test_aliases_share_the_code(self):
+        assert search_catalog.make_code('平治') == search_catalog.make_code('mercedes benz') == '36'
+        assert search_catalog.coded_makes == ['Mercedes-Benz', 'BMW', 'Audi', 'Toyota', 'Honda']
+
+    def test_uncatalogued_makes_use_free_text(self):
+        params = search_catalog.params('Porsche', '911')
+        assert params['h_srh'] == 'Porsche+911'
+        assert 'h_f_mk' not in params
+
+    def test_catalog_adds_model_codes(self):
+        catalog = SearchCatalog({'parameters': {'page': 'p', 'text': 'q', 'make': 'mk', 'model': 'md'},
+                                 'makes': {'BMW': {'code': 7, 'models': {'3 Series': 301}}}})
+        assert catalog.params('寶馬', '3系') == {'p': 1, 'mk': '7', 'md': '301'}
+
+    def test_missing_catalog_falls_back_to_free_text(self, tmp_path):
+        catalog = SearchCatalog.load(str(tmp_path / 'missing.json'))
+        assert catalog.params('Toyota', 'Camry') == {'h_page': 1, 'h_srh': 'Toyota+Camry'}